@@ -18,14 +18,32 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 import sys
 import os
+import re
 import time
+import errno
+import random
+import socket
+import threading
+import Queue
+import base64
 import datetime
+import calendar
 import locale
+import codecs
+import inspect
 import httplib
 import urllib2
-from urllib import urlencode, quote_plus
+from urllib import urlencode, quote_plus, addinfourl
+from urlparse import urlsplit
 from StringIO import StringIO
 from pprint import pformat
+from collections import OrderedDict
+from rfc822 import parsedate_tz, mktime_tz
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 
 try:
@@ -69,12 +87,58 @@ DLCS_OK_MESSAGES = ('done', 'ok')
 "Known text values of positive del.icio.us <result/> answers"
 DLCS_WAIT_TIME = 4
 "Time to wait between API requests"
+DLCS_MIN_WAIT_TIME = 1
+"Shortest interval the adaptive throttle will ever wait between requests"
+DLCS_MAX_WAIT_TIME = 60
+"Longest throttle interval, and longest Retry-After honoured automatically"
+DLCS_THROTTLE_RETRIES = 3
+"Times a throttled (503) read-only request is retried"
+DLCS_RETRIES = 4
+"Times a request is tried before giving up on transient errors"
+DLCS_RETRY_BUDGET = .2
+"Fraction of requests that may be retried, see RetryPolicy"
+DLCS_CONNECT_TIMEOUT = 10
+"Seconds to wait for a connection to the server"
+DLCS_READ_TIMEOUT = 60
+"Seconds to wait for data from the server"
 DLCS_REQUEST_TIMEOUT = 444
-"Seconds before socket triggers timeout"
+"Seconds to wait for data from the slow paths in DLCS_READ_TIMEOUTS"
+DLCS_POOL_SIZE = 4
+"Idle connections kept per host for reuse"
+DLCS_CLIENT_POOL_SIZE = 100
+"DeliciousAPI instances kept by DeliciousClientPool"
 DLCS_API_REALM = 'del.icio.us API'
 DLCS_API_HOST = 'api.del.icio.us'
 DLCS_API_PATH = 'v1'
 DLCS_API = "https://%s/%s" % (DLCS_API_HOST, DLCS_API_PATH)
+DLCS_READ_TIMEOUTS = {'posts/all': DLCS_REQUEST_TIMEOUT}
+"Read timeouts for API paths that may take the server long to answer"
+DLCS_IDEMPOTENT_PATHS = ('tags/get', 'posts/update', 'posts/dates',
+        'posts/get', 'posts/recent', 'posts/all', 'tags/bundles/all')
+"API paths that only read data, and are safe to repeat"
+API_REQUEST_KEYWORDS = ('retry_policy', 'waiter', 'timeout', 'api_url',
+        'stats')
+"Keywords passed to an ``api_request`` hook that takes them"
+DLCS_PARAM_TYPES = {
+    'tags/get': {},
+    'tags/delete': {'tag': 'text'},
+    'tags/rename': {'old': 'text', 'new': 'tags'},
+    'posts/update': {},
+    'posts/dates': {'tag': 'text'},
+    'posts/get': {'tag': 'tags', 'dt': 'text', 'url': 'text',
+        'hashes': 'tags', 'meta': 'bool'},
+    'posts/recent': {'tag': 'text', 'count': 'int'},
+    'posts/all': {'tag': 'text', 'start': 'int', 'results': 'int',
+        'fromdt': 'text', 'todt': 'text', 'meta': 'bool', 'hashes': 'bool'},
+    'posts/add': {'url': 'text', 'description': 'text', 'extended': 'text',
+        'tags': 'tags', 'dt': 'text', 'replace': 'bool', 'shared': 'bool'},
+    'posts/delete': {'url': 'text'},
+    'tags/bundles/all': {'bundle': 'text'},
+    'tags/bundles/set': {'bundle': 'text', 'tags': 'tags'},
+    'tags/bundles/delete': {'bundle': 'text'},
+}
+"Parameter types per API path, see `ParamSchema`"
+
 DLCS_RSS = 'http://previous.delicious.com/v2/rss/'
 "Old RSS feeds, formerly <http://del.icio.us/rss/>"
 DLCS_FEEDS = 'http://feeds.delicious.com/v2/'
@@ -103,23 +167,6 @@ if DEBUG and (HTTP_PROXY or HTTPS_PROXY):
     print >>sys.stderr, \
         "Set proxies to %s, %s from env." % (HTTP_PROXY, HTTPS_PROXY, )
 
-### Timeoutsocket hack taken from FeedParser.py
-
-# timeoutsocket allows feedparser to time out rather than hang forever on ultra-
-# slow servers. Python 2.3 now has this functionality available in the standard
-# socket library, so under 2.3 you don't need to install anything.  But you
-# probably should anyway, because the socket module is buggy and timeoutsocket
-# is better.
-try:
-    import timeoutsocket # http://www.timo-tasi.org/python/timeoutsocket.py
-    timeoutsocket.setDefaultSocketTimeout(DLCS_REQUEST_TIMEOUT)
-except ImportError:
-    import socket
-    if hasattr(socket, 'setdefaulttimeout'):
-        socket.setdefaulttimeout(DLCS_REQUEST_TIMEOUT)
-if DEBUG: print >>sys.stderr, \
-    "Set socket timeout to %s seconds" % DLCS_REQUEST_TIMEOUT
-
 
 ### Utility classes
 
@@ -131,35 +178,717 @@ class _Waiter:
     :last: time of last call
     :wait: the minimum time needed between calls
     :waited: the number of calls throttled
+    :slept: the total number of seconds slept
 
-    pydelicious.Waiter is an instance created when the module is loaded.
+    Waiters are thread-safe, concurrent callers are given successive
+    time slots. pydelicious.Waiter is an instance created when the module
+    is loaded.
     """
     def __init__(self, wait):
         self.wait = wait
         self.waited = 0
+        self.slept = 0
         self.lastcall = 0;
+        self.lock = threading.Lock()
 
     def __call__(self):
-        tt = time.time()
-        wait = self.wait
-
-        timeago = tt - self.lastcall
+        "Sleep until it is time for the next call, return the time slept."
+        self.lock.acquire()
+        try:
+            tt = time.time()
+            wait = self.next_call() - tt
+            if wait > 0:
+                # reserve the slot, then sleep without holding the lock
+                self.waited += 1
+                self.slept += wait
+                self.lastcall = tt + wait
+            else:
+                wait = 0
+                self.lastcall = tt
+        finally:
+            self.lock.release()
 
-        if timeago < wait:
-            wait = wait - timeago
+        if wait:
             if DEBUG>0: print >>sys.stderr, "Waiting %s seconds." % wait
             time.sleep(wait)
-            self.waited += 1
-            self.lastcall = tt + wait
+        return wait
+
+    def next_call(self):
+        "Return the earliest time at which the next call may be made."
+        return self.lastcall + self.wait
+
+
+class _AdaptiveWaiter(_Waiter):
+    """Waiter that adapts its interval to the server, using additive
+    increase and multiplicative decrease (AIMD) of the request rate.
+
+    Every throttled response (HTTP 503) multiplies the rate by `decrease`
+    and postpones the next call until after the advised Retry-After. Every
+    good response adds `increase` to the rate, unless it took longer than
+    `latency_limit` seconds. The interval stays between `min_wait` and
+    `max_wait`.
+
+    Some attributes besides those of `_Waiter`:
+    :rate: the current request rate, in requests per second
+    :throttled: the number of throttled responses seen
+    :until: time before which no new call is made (from Retry-After)
+    """
+    def __init__(self, wait, min_wait=DLCS_MIN_WAIT_TIME,
+            max_wait=DLCS_MAX_WAIT_TIME, increase=.05, decrease=.5,
+            latency_limit=10):
+        _Waiter.__init__(self, wait)
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_limit = latency_limit
+        self.throttled = 0
+        self.until = 0
+
+    def next_call(self):
+        return max(_Waiter.next_call(self), self.until)
+
+    def get_rate(self):
+        if not self.wait:
+            return float('inf')
+        return 1.0 / self.wait
+    rate = property(get_rate)
+
+    def backoff(self, retry_after=None):
+        """Multiplicatively decrease the rate after a throttled response and
+        respect the delay advised by the server, if any.
+        """
+        self.lock.acquire()
+        try:
+            self.throttled += 1
+            self.wait = min(max(self.wait, self.min_wait) / self.decrease,
+                    self.max_wait)
+            if retry_after:
+                self.until = max(self.until, time.time() + retry_after)
+        finally:
+            self.lock.release()
+        if DEBUG>0: print >>sys.stderr, \
+            "Throttled, rate is now %.3f/s." % self.rate
+
+    def recover(self, latency=None):
+        """Additively increase the rate after a successful response, unless
+        the response was slow (`latency` in seconds).
+        """
+        if not self.wait or \
+                (latency is not None and latency > self.latency_limit):
+            return
+        self.lock.acquire()
+        try:
+            rate = min(self.rate + self.increase, 1.0 / self.min_wait)
+            self.wait = 1.0 / rate
+        finally:
+            self.lock.release()
+
+Waiter = _AdaptiveWaiter(DLCS_WAIT_TIME)
+
+
+class RetryPolicy:
+    """Decides if and when `http_request` repeats a failed request.
+
+    Only transient errors are retried: time-outs, dropped or refused
+    connections and 5xx server errors (see `retryable()`). The n-th retry
+    sleeps a random time between zero and ``min(cap, base * 2**n)`` seconds
+    (exponential backoff with full jitter), so workers that fail together
+    do not retry together.
+
+    Retries are paid from a budget: every request deposits `budget_ratio`
+    tokens, every retry withdraws one, and no more than `budget_max` tokens
+    are kept. When the server is down this limits the extra load to about
+    `budget_ratio` times the regular requests. Use one policy per client,
+    policies are thread-safe.
+
+    A `deadline` (seconds) limits the time spent on one call, retries
+    included.
+
+    Some attributes:
+    :tokens: the current retry budget
+    :retried: the number of retries done
+    :exhausted: the number of retries denied by the budget
+    """
+    retryable_codes = (500, 502, 503, 504)
+    retryable_errnos = (errno.ECONNRESET, errno.ECONNREFUSED,
+            errno.ECONNABORTED, errno.ETIMEDOUT, errno.EPIPE)
+
+    def __init__(self, tries=DLCS_RETRIES, base=.5, cap=30, deadline=None,
+            budget_ratio=DLCS_RETRY_BUDGET, budget_max=10):
+        self.tries = tries
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+        self.budget_ratio = budget_ratio
+        self.budget_max = budget_max
+        self.tokens = budget_max
+        self.retried = 0
+        self.exhausted = 0
+        self.lock = threading.Lock()
+
+    def retryable(self, error):
+        "Return True if ``error`` is likely to go away when tried again."
+        if isinstance(error, urllib2.HTTPError):
+            return error.code in self.retryable_codes
+        if isinstance(error, urllib2.URLError):
+            error = error.reason
+        if isinstance(error, socket.timeout):
+            return True
+        if isinstance(error, socket.error):
+            return error.errno in self.retryable_errnos
+        if isinstance(error, httplib.HTTPException):
+            # BadStatusLine, IncompleteRead: connection was dropped
+            return True
+        if isinstance(error, basestring):
+            return 'timed out' in error
+        return False
+
+    def delay(self, attempt):
+        "Return a jittered backoff time for retry number ``attempt``."
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def deposit(self):
+        "Credit the budget for one request."
+        self.lock.acquire()
+        try:
+            self.tokens = min(self.budget_max,
+                    self.tokens + self.budget_ratio)
+        finally:
+            self.lock.release()
+
+    def withdraw(self):
+        "Take one retry from the budget, returns False if it is spent."
+        self.lock.acquire()
+        try:
+            if self.tokens < 1:
+                self.exhausted += 1
+                return False
+            self.tokens -= 1
+            self.retried += 1
+            return True
+        finally:
+            self.lock.release()
+
+Retry = RetryPolicy()
+
+
+class Timeout:
+    """Time limits for a request, in seconds. None means no limit.
+
+    :connect: to establish a connection to the server
+    :read: to wait for (more) data on the connection
+    :total: for the entire call, retries included
+
+    The `connect` and `read` limits are only told apart by openers with
+    `TimeoutHTTPHandler` or `TimeoutHTTPSHandler` (see `build_api_opener()`),
+    other openers apply the larger of the two to both.
+    """
+    def __init__(self, connect=DLCS_CONNECT_TIMEOUT, read=DLCS_READ_TIMEOUT,
+            total=None):
+        self.connect = connect
+        self.read = read
+        self.total = total
+
+    def replace(self, **kwds):
+        "Return a copy with some of the limits replaced."
+        limits = dict(connect=self.connect, read=self.read, total=self.total)
+        limits.update(kwds)
+        return Timeout(**limits)
+
+    def __repr__(self):
+        return "Timeout(connect=%r, read=%r, total=%r)" % (self.connect,
+                self.read, self.total)
+
+
+class _TimeoutHTTPConnection(httplib.HTTPConnection):
+    """HTTPConnection that sets a different timeout on the socket once it is
+    connected.
+    """
+    def __init__(self, host, read_timeout=None, connect_timeout=None, **kwds):
+        httplib.HTTPConnection.__init__(self, host, **kwds)
+        self.read_timeout = read_timeout
+        if connect_timeout is not None:
+            self.timeout = connect_timeout
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        self.sock.settimeout(self.read_timeout)
+
+
+class _TimeoutHTTPSConnection(httplib.HTTPSConnection):
+    "See _TimeoutHTTPConnection."
+    def __init__(self, host, read_timeout=None, connect_timeout=None, **kwds):
+        httplib.HTTPSConnection.__init__(self, host, **kwds)
+        self.read_timeout = read_timeout
+        if connect_timeout is not None:
+            self.timeout = connect_timeout
+
+    def connect(self):
+        httplib.HTTPSConnection.connect(self)
+        self.sock.settimeout(self.read_timeout)
+
+
+def _timeout_connection(connection_class, req):
+    "Bind the timeouts set by `http_request()` on ``req`` to a connection."
+    def build(host, **kwds):
+        return connection_class(host,
+                connect_timeout=getattr(req, 'connect_timeout', None),
+                read_timeout=getattr(req, 'read_timeout', req.timeout),
+                **kwds)
+    return build
+
+
+class TimeoutHTTPHandler(urllib2.HTTPHandler):
+    "Handler that applies separate connect and read timeouts, see Timeout."
+
+    def http_open(self, req):
+        return self.do_open(
+                _timeout_connection(_TimeoutHTTPConnection, req), req)
+
+
+class TimeoutHTTPSHandler(urllib2.HTTPSHandler):
+    "Handler that applies separate connect and read timeouts, see Timeout."
+
+    def https_open(self, req):
+        return self.do_open(
+                _timeout_connection(_TimeoutHTTPSConnection, req), req,
+                context=self._context)
+
+
+class ConnectionPool:
+    """Keeps idle HTTP/1.1 connections per scheme and host for reuse, so
+    successive requests skip the TCP (and TLS) handshakes. Thread-safe, one
+    pool may be shared by the openers of many clients.
+
+    Some attributes:
+    :maxsize: the number of idle connections kept per host
+    :created: the number of connections opened
+    :reused: the number of requests served from an idle connection
+    """
+    def __init__(self, maxsize=DLCS_POOL_SIZE):
+        self.maxsize = maxsize
+        self.idle = {}
+        self.created = 0
+        self.reused = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        "Return an idle connection for ``key`` or None."
+        self.lock.acquire()
+        try:
+            if self.idle.get(key):
+                self.reused += 1
+                return self.idle[key].pop()
+        finally:
+            self.lock.release()
+
+    def put(self, key, conn):
+        "Return a connection to the pool, or close it if the pool is full."
+        self.lock.acquire()
+        try:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.maxsize:
+                conns.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def clear(self):
+        "Close all idle connections."
+        self.lock.acquire()
+        try:
+            idle, self.idle = self.idle, {}
+        finally:
+            self.lock.release()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+class _PooledHandlerMixin:
+    """Opens requests on connections from a `ConnectionPool` instead of a new
+    connection per request. Responses are read entirely, after which the
+    connection goes back to the pool unless the server closes it.
+    """
+    def pooled_open(self, connection_class, req, **kwds):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        if req._tunnel_host:
+            # don't keep proxy tunnels around
+            return self.do_open(_timeout_connection(connection_class, req),
+                    req, **kwds)
+
+        key = (req.get_type(), host)
+        connect_timeout = getattr(req, 'connect_timeout', None)
+        read_timeout = getattr(req, 'read_timeout', req.timeout)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        while True:
+            conn = self.pool.get(key)
+            reused = conn is not None
+            if reused:
+                conn.sock.settimeout(read_timeout)
+            else:
+                conn = connection_class(host, timeout=req.timeout,
+                        connect_timeout=connect_timeout,
+                        read_timeout=read_timeout, **kwds)
+                conn.set_debuglevel(self._debuglevel)
+                self.pool.created += 1
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.data,
+                        headers)
+                r = conn.getresponse()
+            except (socket.error, httplib.HTTPException), err:
+                conn.close()
+                if reused:
+                    # the server closed the idle connection, try another
+                    continue
+                raise urllib2.URLError(err)
+            break
+
+        try:
+            data = r.read()
+        except:
+            conn.close()
+            raise
+        if r.will_close:
+            conn.close()
         else:
-            self.lastcall = tt
+            self.pool.put(key, conn)
+
+        resp = addinfourl(StringIO(data), r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+
+class PooledHTTPHandler(_PooledHandlerMixin, TimeoutHTTPHandler):
+    "Handler with persistent connections from a `ConnectionPool`."
+
+    def __init__(self, pool=None, debuglevel=0):
+        TimeoutHTTPHandler.__init__(self, debuglevel)
+        if not pool:
+            pool = ConnectionPool()
+        self.pool = pool
+
+    def http_open(self, req):
+        return self.pooled_open(_TimeoutHTTPConnection, req)
+
+
+class PooledHTTPSHandler(_PooledHandlerMixin, TimeoutHTTPSHandler):
+    "Handler with persistent connections from a `ConnectionPool`."
+
+    def __init__(self, pool=None, debuglevel=0, context=None):
+        TimeoutHTTPSHandler.__init__(self, debuglevel, context)
+        if not pool:
+            pool = ConnectionPool()
+        self.pool = pool
+
+    def https_open(self, req):
+        return self.pooled_open(_TimeoutHTTPSConnection, req,
+                context=self._context)
+
+
+class PreemptiveBasicAuthHandler(urllib2.BaseHandler):
+    """Sends HTTP Basic credentials with the first request, instead of
+    waiting for a 401 challenge as urllib2.HTTPBasicAuthHandler does. This
+    saves a round trip per request and keeps no state between requests.
+    """
+    def __init__(self, password_manager, realm=DLCS_API_REALM):
+        self.passwd = password_manager
+        self.realm = realm
+
+    def http_request(self, req):
+        user, passwd = self.passwd.find_user_password(self.realm,
+                req.get_full_url())
+        if user is not None and not req.has_header('Authorization'):
+            raw = "%s:%s" % (user, passwd)
+            req.add_unredirected_header('Authorization',
+                    'Basic %s' % base64.b64encode(raw))
+        return req
+
+    https_request = http_request
+
+
+class RequestEvent:
+    """A request made by `http_request()`. It is passed to the functions in
+    `before_request_hooks` before the request is made, and to those in
+    `after_request_hooks` once it is done or has failed.
+
+    Attributes:
+    :url: the requested URL
+    :path: the API path, or the host for other URLs
+    :started: time the request was started
+    :status: HTTP status of the last response, None if there was none
+    :bytes: size of the response body, None if unknown
+    :latency: seconds taken, including retries
+    :retries: number of retries after transient errors
+    :retry_wait: seconds slept between retries
+    :waited: seconds slept before the request to avoid throttling
+    :error: the exception raised, if any
+    """
+    def __init__(self, url, path=None, waited=0):
+        self.url = url
+        if not path:
+            path = urlsplit(url)[1]
+        self.path = path
+        self.waited = waited
+        self.started = None
+        self.status = None
+        self.bytes = None
+        self.latency = 0
+        self.retries = 0
+        self.retry_wait = 0
+        self.error = None
+
+    def __repr__(self):
+        return "<RequestEvent %s %s %.3fs>" % (self.path, self.status,
+                self.latency)
 
-Waiter = _Waiter(DLCS_WAIT_TIME)
+
+class RequestMetrics:
+    """Request counters and latency histograms per path, for use as an
+    after-request hook. pydelicious.Metrics is an instance created and
+    registered when the module is loaded.
+
+    Export the collected data with `as_dict()` or `prometheus()`, or
+    `write()` it to a file, i.e. for the textfile collector of the
+    Prometheus node exporter.
+    """
+    buckets = (.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+    "Upper bounds of the latency histogram buckets in seconds"
+
+    prefix = 'pydelicious'
+
+    def __init__(self, buckets=None):
+        if buckets:
+            self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.paths = {}
+        finally:
+            self.lock.release()
+
+    def __call__(self, event):
+        self.lock.acquire()
+        try:
+            stats = self.paths.get(event.path)
+            if not stats:
+                stats = self.paths[event.path] = {'requests': 0,
+                        'errors': 0, 'status': {}, 'bytes': 0, 'retries': 0,
+                        'waited': 0.0, 'latency': 0.0,
+                        'histogram': [0] * (len(self.buckets) + 1)}
+            stats['requests'] += 1
+            if event.error:
+                stats['errors'] += 1
+            status = str(event.status or 'none')
+            stats['status'][status] = stats['status'].get(status, 0) + 1
+            stats['bytes'] += event.bytes or 0
+            stats['retries'] += event.retries
+            stats['waited'] += event.waited
+            stats['latency'] += event.latency
+            for i, bound in enumerate(self.buckets):
+                if event.latency <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+            stats['histogram'][i] += 1
+        finally:
+            self.lock.release()
+
+    def as_dict(self):
+        "Return a copy of the statistics by path, i.e. to export as JSON."
+        self.lock.acquire()
+        try:
+            paths = {}
+            for path, stats in self.paths.items():
+                stats = dict(stats)
+                stats['status'] = dict(stats['status'])
+                stats['histogram'] = zip(self.buckets + ('+Inf',),
+                        stats['histogram'])
+                paths[path] = stats
+            return paths
+        finally:
+            self.lock.release()
+
+    def json(self):
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+    def prometheus(self):
+        "Return the statistics in the Prometheus text exposition format."
+        paths = self.as_dict()
+        lines = []
+        def metric(name, type, help, values):
+            name = "%s_%s" % (self.prefix, name)
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, type))
+            for suffix, labels, value in values:
+                labels = ",".join(['%s="%s"' % (k, str(v).replace('"', '\\"'))
+                    for k, v in labels])
+                lines.append("%s%s{%s} %s" % (name, suffix, labels, value))
+        metric('requests_total', 'counter', "Requests by path and status.",
+            [('', (('path', path), ('status', status)), count)
+                for path in sorted(paths)
+                for status, count in sorted(paths[path]['status'].items())])
+        for key, name, help in (
+                ('errors', 'errors_total', "Failed requests."),
+                ('bytes', 'response_bytes_total', "Bytes read."),
+                ('retries', 'retries_total', "Retries after transient errors."),
+                ('waited', 'throttle_wait_seconds_total',
+                    "Time slept to avoid throttling.")):
+            metric(name, 'counter', help, [('', (('path', path),),
+                paths[path][key]) for path in sorted(paths)])
+        values = []
+        for path in sorted(paths):
+            count = 0
+            for bound, n in paths[path]['histogram']:
+                count += n
+                values.append(('_bucket', (('path', path), ('le', bound)),
+                    count))
+            values.append(('_sum', (('path', path),),
+                paths[path]['latency']))
+            values.append(('_count', (('path', path),), count))
+        metric('request_seconds', 'histogram', "Request latency.", values)
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename, format='prometheus'):
+        "Write the statistics to a file as 'prometheus' text or 'json'."
+        tmpfile = filename + '.tmp'
+        fl = open(tmpfile, 'w')
+        try:
+            fl.write(getattr(self, format)())
+        finally:
+            fl.close()
+        os.rename(tmpfile, filename)
+
+    def __str__(self):
+        paths = self.as_dict()
+        return "\n".join(["%s: %i requests, %i errors, %.3fs avg" % (path,
+            paths[path]['requests'], paths[path]['errors'],
+            paths[path]['latency'] / paths[path]['requests'])
+            for path in sorted(paths)])
+
+
+class ClientStats:
+    """Where the time of a `DeliciousAPI` instance went, as ``stats`` on the
+    instance. Reset it at the start of a job to account for that job only.
+
+    Attributes:
+    :requests: number of HTTP requests made
+    :errors: number of requests that failed
+    :throttled: number of requests answered with 503
+    :retries: number of retries after transient errors
+    :bytes: bytes read
+    :wait_time: seconds slept by the rate limiter
+    :retry_time: seconds slept between retries
+    :network_time: seconds spent on requests, without retry sleeps
+    :parse_time: seconds spent parsing responses
+    :started: time of creation or the last reset
+    """
+    counters = ('requests', 'errors', 'throttled', 'retries', 'bytes',
+        'wait_time', 'retry_time', 'network_time', 'parse_time')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        "Start counting from zero, return the totals so far."
+        self.lock.acquire()
+        try:
+            totals = self.as_dict(_locked=True)
+            for name in self.counters:
+                setattr(self, name, 0)
+            self.started = time.time()
+            return totals
+        finally:
+            self.lock.release()
+
+    def add_request(self, event):
+        "Account for a `RequestEvent`."
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            if event.error:
+                self.errors += 1
+            if event.status == 503:
+                self.throttled += 1
+            self.retries += event.retries
+            self.bytes += event.bytes or 0
+            self.wait_time += event.waited
+            self.retry_time += event.retry_wait
+            self.network_time += event.latency - event.retry_wait
+        finally:
+            self.lock.release()
+
+    def add_parse(self, seconds):
+        self.lock.acquire()
+        try:
+            self.parse_time += seconds
+        finally:
+            self.lock.release()
+
+    def as_dict(self, _locked=False):
+        "Return the counters and the seconds elapsed as dictionary."
+        if not hasattr(self, 'started'):
+            return {}
+        if not _locked:
+            self.lock.acquire()
+        try:
+            totals = dict([(name, getattr(self, name))
+                for name in self.counters])
+            totals['elapsed'] = time.time() - self.started
+            return totals
+        finally:
+            if not _locked:
+                self.lock.release()
+
+    def __str__(self):
+        totals = self.as_dict()
+        elapsed = totals['elapsed'] or 1
+        return "%(requests)i requests (%(errors)i failed, %(throttled)i " \
+            "throttled, %(retries)i retries) in %(elapsed).1fs: " % totals + \
+            ", ".join(["%s %.1fs (%i%%)" % (name, totals[name + '_time'],
+                100 * totals[name + '_time'] / elapsed)
+                for name in ('wait', 'network', 'retry', 'parse')])
+
+    def __repr__(self):
+        return "<ClientStats %s>" % self
+
+
+Metrics = RequestMetrics()
+
+before_request_hooks = []
+"Functions called with the `RequestEvent` of each request before it is made"
+after_request_hooks = [Metrics]
+"Functions called with the `RequestEvent` of each request once it is done"
+
+def _call_hooks(hooks, event):
+    for hook in hooks:
+        try:
+            hook(event)
+        except Exception, e:
+            # never let instrumentation break a request
+            print >>sys.stderr, "Request hook %r failed: %s" % (hook, e)
 
 
 class PyDeliciousException(Exception):
     """Standard pydelicious error"""
-class PyDeliciousThrottled(Exception): pass
+class PyDeliciousThrottled(Exception):
+    """Raised when the server responds with 503, ``retry_after`` holds the
+    advised delay in seconds (or None)."""
+    retry_after = None
 class PyDeliciousUnauthorized(Exception): pass
 
 class DeliciousError(Exception):
@@ -183,11 +912,14 @@ class DeliciousHTTPErrorHandler(urllib2.HTTPDefaultErrorHandler):
         raise PyDeliciousUnauthorized, "Check credentials."
 
     def http_error_503(self, req, fp, code, msg, headers):
-        # Retry-After?
         errmsg = "Try again later."
+        retry_after = None
         if 'Retry-After' in headers:
             errmsg = "You may try again after %s" % headers['Retry-After']
-        raise PyDeliciousThrottled, errmsg
+            retry_after = parse_retry_after(headers['Retry-After'])
+        e = PyDeliciousThrottled(errmsg)
+        e.retry_after = retry_after
+        raise e
 
 
 ### Utility functions
@@ -198,67 +930,218 @@ def dict0(d):
             if v=='' and isinstance(v, basestring)])
 
 
+def parse_retry_after(value):
+    """Parse the value of a Retry-After header, either delta-seconds or an
+    HTTP-date, to a number of seconds from now. Returns None if the value
+    cannot be parsed.
+    """
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if not date:
+        return None
+    return max(0, mktime_tz(date) - time.time())
+
+
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+_day_timestamps = {}
+
+def _iso_day_timestamp(day):
+    "Return the epoch seconds at 00:00 UTC of a 'CCYY-MM-DD' date."
+    try:
+        return _day_timestamps[day]
+    except KeyError:
+        ordinal = datetime.date(int(day[0:4]), int(day[5:7]),
+                int(day[8:10])).toordinal()
+        if len(_day_timestamps) > 100000:
+            _day_timestamps.clear()
+        stamp = _day_timestamps[day] = (ordinal - _EPOCH_ORDINAL) * 86400
+        return stamp
+
+def _is_iso_time(value):
+    return len(value) == 20 and value[10] == 'T' and value[19] == 'Z' \
+            and value[4] == value[7] == '-' and value[13] == value[16] == ':'
+
+def iso_timestamp(value):
+    """Return the seconds since the epoch for an ISO 8601 time in the
+    del.icio.us format (ISO_8601_DATETIME). Parses by position, falling
+    back to `time.strptime` for other shapes. Raises ValueError for invalid
+    times.
+    """
+    if _is_iso_time(value):
+        try:
+            hour, minute, second = (int(value[11:13]), int(value[14:16]),
+                    int(value[17:19]))
+            if hour < 24 and minute < 60 and second < 62:
+                return _iso_day_timestamp(value[:10]) + hour * 3600 + \
+                        minute * 60 + second
+        except ValueError:
+            pass
+    return calendar.timegm(time.strptime(value, ISO_8601_DATETIME))
+
+def iso_time_tuple(value):
+    "Parse an ISO 8601 time to a struct_time, like `time.strptime` does."
+    if _is_iso_time(value):
+        try:
+            fields = [int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                    int(value[11:13]), int(value[14:16]), int(value[17:19])]
+            date = datetime.date(*fields[:3])
+            if fields[3] < 24 and fields[4] < 60 and fields[5] < 62:
+                return time.struct_time(fields + [date.weekday(),
+                    date.toordinal() - date.replace(month=1, day=1).toordinal()
+                    + 1, -1])
+        except ValueError:
+            pass
+    return time.strptime(value, ISO_8601_DATETIME)
+
 def delicious_datetime(str):
     """Parse a ISO 8601 formatted string to a Python datetime ...
     """
-    return datetime.datetime(*time.strptime(str, ISO_8601_DATETIME)[0:6])
+    return datetime.datetime(*iso_time_tuple(str)[0:6])
+
+def iso_timestamps(values, numpy=False):
+    """Convert a whole column of ISO 8601 times (i.e. the 'time' of posts)
+    to epoch seconds in one pass. Empty values become 0. With ``numpy``,
+    return a NumPy datetime64 array instead (if NumPy is installed, else an
+    ImportError is raised).
+    """
+    stamps = [value and iso_timestamp(value) or 0 for value in values]
+    if numpy:
+        import numpy
+        return numpy.array(stamps, dtype='datetime64[s]')
+    return stamps
+
+def post_timestamps(posts, numpy=False):
+    "Return the times of the posts as epoch seconds, see `iso_timestamps()`."
+    return iso_timestamps([post.get('time') for post in posts], numpy)
 
 
-def http_request(url, user_agent=USER_AGENT, retry=4, opener=None):
+def http_request(url, user_agent=USER_AGENT, retry=None, opener=None,
+        retry_policy=None, deadline=None, timeout=None, event=None):
     """Retrieve the contents referenced by the URL using urllib2.
 
-    Retries up to four times (default) on exceptions.
+    Transient errors are retried according to ``retry_policy``, which
+    defaults to the module `Retry` policy. ``retry`` and ``deadline``
+    override the number of tries and the time limit of the policy for this
+    call. See `RetryPolicy`.
+
+    ``timeout`` is a `Timeout` with the connect, read and total time limits,
+    its total limit is used as deadline unless one is given. The connect
+    and read limits are never longer than what remains of the deadline.
+
+    The request hooks are called with ``event``, or a new `RequestEvent`
+    for the URL.
     """
+    if not event:
+        event = RequestEvent(url)
+    _call_hooks(before_request_hooks, event)
+    event.started = time.time()
+    try:
+        fl = _http_request(url, user_agent, retry, opener, retry_policy,
+                deadline, timeout, event)
+    except Exception, e:
+        event.error = e
+        if isinstance(e, PyDeliciousThrottled):
+            event.status = 503
+        elif isinstance(e, PyDeliciousUnauthorized):
+            event.status = 401
+        event.latency = time.time() - event.started
+        _call_hooks(after_request_hooks, event)
+        raise
+    event.status = getattr(fl, 'code', None)
+    if hasattr(getattr(fl, 'fp', None), 'getvalue'):
+        event.bytes = len(fl.fp.getvalue())
+    elif hasattr(fl, 'info') and fl.info().get('Content-Length', '').isdigit():
+        event.bytes = int(fl.info()['Content-Length'])
+    event.latency = time.time() - event.started
+    _call_hooks(after_request_hooks, event)
+    return fl
+
+def _http_request(url, user_agent, retry, opener, retry_policy, deadline,
+        timeout, event):
     request = urllib2.Request(url, headers={'User-Agent':user_agent})
 
     if not opener:
-        opener = urllib2.build_opener()
+        opener = urllib2.build_opener(TimeoutHTTPHandler, TimeoutHTTPSHandler)
+    if not retry_policy:
+        retry_policy = Retry
+    if not timeout:
+        timeout = Timeout()
+    if retry is None:
+        retry = retry_policy.tries
+    if deadline is None:
+        deadline = timeout.total
+    if deadline is None:
+        deadline = retry_policy.deadline
+
+    started = time.time()
+    retry_policy.deposit()
 
     # Remember last error
     e = None
 
-    # Repeat request on time-out errors
-    tries = retry;
-    while tries:
+    attempt = 0
+    while True:
+        connect, read = timeout.connect, timeout.read
+        if deadline is not None:
+            remaining = max(deadline - (time.time() - started), .001)
+            connect = min(connect or remaining, remaining)
+            read = min(read or remaining, remaining)
+        request.connect_timeout = connect
+        request.read_timeout = read
         try:
-            return opener.open(request)
-
-        except urllib2.HTTPError, e:
-            # reraise unexpected protocol errors as PyDeliciousException
-            raise PyDeliciousException, "%s" % e
-
-        except urllib2.URLError, e:
-            # xxx: Ugly check for time-out errors
-            #if len(e)>0 and 'timed out' in arg[0]:
-            print >> sys.stderr, "%s, %s tries left." % (e, tries)
-            Waiter()
-            tries = tries - 1
-            #else:
-            #	tries = None
+            return opener.open(request, timeout=max(connect, read))
+
+        except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+            event.status = getattr(e, 'code', None)
+            if not retry_policy.retryable(e):
+                # reraise unexpected protocol errors as PyDeliciousException
+                raise PyDeliciousException, "%s" % e
+
+        attempt += 1
+        if attempt >= retry:
+            break
+        wait = retry_policy.delay(attempt)
+        if deadline is not None and time.time() - started + wait > deadline:
+            break
+        if not retry_policy.withdraw():
+            break
+        if DEBUG: print >>sys.stderr, \
+                "%s, retrying in %.2f seconds, %s tries left." % (e, wait,
+                        retry - attempt)
+        event.retries = attempt
+        event.retry_wait += wait
+        time.sleep(wait)
 
     # Give up
     raise PyDeliciousException, \
             "Unable to retrieve data at '%s', %s" % (url, e)
 
 
-def build_api_opener(host, user, passwd, extra_handlers=() ):
+def build_api_opener(host, user, passwd, extra_handlers=(), pool=None):
     """
     Build a urllib2 style opener with HTTP Basic authorization for one host
     and additional error handling. If HTTP_PROXY is set a proxyhandler is also
     added.
+
+    Connections are kept open and reused from ``pool``, a `ConnectionPool`
+    that may be shared between openers. By default each opener has its own.
+    The opener is thread-safe.
     """
 
     global DEBUG, HTTP_PROXY, HTTPS_PROXY, DLCS_API_REALM
 
     password_manager = urllib2.HTTPPasswordMgr()
     password_manager.add_password(DLCS_API_REALM, host, user, passwd)
-    auth_handler = urllib2.HTTPBasicAuthHandler(password_manager)
+    auth_handler = PreemptiveBasicAuthHandler(password_manager)
 
-    handlers = ( auth_handler, DeliciousHTTPErrorHandler(), ) + extra_handlers
+    if not pool:
+        pool = ConnectionPool()
 
-    if DEBUG:
-        httpdebug = urllib2.HTTPHandler(debuglevel=DEBUG)
-        handlers += ( httpdebug, )
+    handlers = ( auth_handler, DeliciousHTTPErrorHandler(),
+            PooledHTTPHandler(pool, debuglevel=DEBUG),
+            PooledHTTPSHandler(pool, debuglevel=DEBUG), ) + extra_handlers
 
     if HTTP_PROXY or HTTPS_PROXY:
         proto = {}
@@ -272,28 +1155,67 @@ def build_api_opener(host, user, passwd, extra_handlers=() ):
 
     return o
 
-def dlcs_api_opener(user, passwd):
+def dlcs_api_opener(user, passwd, pool=None):
     "Build an opener for DLCS_API_HOST, see build_api_opener()"
 
-    return build_api_opener(DLCS_API_HOST, user, passwd)
+    return build_api_opener(DLCS_API_HOST, user, passwd, pool=pool)
+
+
+class ApiUrl:
+
+    """Builds the request URLs for one API path, see `get_api_url()`."""
+
+    def __init__(self, api_url, path):
+        self.base = "%s/%s" % (api_url, path)
+        self.prefix = self.base + '?'
+
+    def __call__(self, params=None):
+        "Return the URL with the (UTF-8 encoded) parameters as query."
+        if not params:
+            return self.base
+        return self.prefix + "&".join([quote_plus(key) + '=' +
+            quote_plus(type(value) is str and value or str(value))
+            for key, value in params.iteritems()])
+
+    def __repr__(self):
+        return "<ApiUrl %s>" % self.base
+
+_api_urls = {}
+
+def get_api_url(api_url, path):
+    "Return the (cached) `ApiUrl` for a path of the API at ``api_url``."
+    try:
+        return _api_urls[api_url, path]
+    except KeyError:
+        builder = _api_urls[api_url, path] = ApiUrl(api_url, path)
+        return builder
 
 
 def dlcs_api_request(path, params=None, user='', passwd='', throttle=True,
-        opener=None):
-    """Retrieve/query a path within the del.icio.us API.
+        opener=None, waiter=None, retry_policy=None, timeout=None,
+        api_url=DLCS_API, stats=None):
+    """Retrieve/query a path within the del.icio.us API at ``api_url``.
 
     This implements a minimum interval between calls to avoid
     throttling. [#]_ Use param 'throttle' to turn this behaviour off.
+    The interval is adapted by ``waiter`` (default: the module `Waiter`)
+    as the server throttles or answers. Throttled requests for read-only
+    paths (see DLCS_IDEMPOTENT_PATHS) are retried after the advised delay,
+    up to DLCS_THROTTLE_RETRIES times. Other transient errors are retried
+    following ``retry_policy`` and within the limits of ``timeout``, see
+    `http_request()`. The default timeout allows slow paths to read for
+    longer, see DLCS_READ_TIMEOUTS. Each attempt is reported to the request
+    hooks with a `RequestEvent` for ``path``, and added to ``stats`` (a
+    `ClientStats`) if given.
 
     .. [#] http://del.icio.us/help/api/
     """
-    if throttle:
-        Waiter()
+    if not waiter:
+        waiter = Waiter
+    if not timeout:
+        timeout = Timeout(read=DLCS_READ_TIMEOUTS.get(path, DLCS_READ_TIMEOUT))
 
-    if params:
-        url = "%s/%s?%s" % (DLCS_API, path, urlencode(params))
-    else:
-        url = "%s/%s" % (DLCS_API, path)
+    url = get_api_url(api_url, path)(params)
 
     if DEBUG: print >>sys.stderr, \
             "dlcs_api_request: %s" % url
@@ -301,7 +1223,32 @@ def dlcs_api_request(path, params=None, user='', passwd='', throttle=True,
     if not opener:
         opener = dlcs_api_opener(user, passwd)
 
-    fl = http_request(url, opener=opener)
+    tries = DLCS_THROTTLE_RETRIES
+    while True:
+        waited = 0
+        if throttle:
+            waited = waiter() or 0
+        started = time.time()
+        event = RequestEvent(url, path, waited)
+        try:
+            try:
+                fl = http_request(url, opener=opener,
+                        retry_policy=retry_policy, timeout=timeout,
+                        event=event)
+            finally:
+                if stats:
+                    stats.add_request(event)
+        except PyDeliciousThrottled, e:
+            waiter.backoff(e.retry_after)
+            if not throttle or not tries or path not in DLCS_IDEMPOTENT_PATHS \
+                    or (e.retry_after or 0) > waiter.max_wait:
+                raise
+            tries -= 1
+            if DEBUG: print >>sys.stderr, \
+                    "dlcs_api_request: %s, %s tries left." % (e, tries)
+            continue
+        waiter.recover(time.time() - started)
+        break
 
     if DEBUG>2: print >>sys.stderr, \
             pformat(fl.info().headers)
@@ -309,41 +1256,161 @@ def dlcs_api_request(path, params=None, user='', passwd='', throttle=True,
     return fl
 
 
-def dlcs_encode_params(params, usercodec=PREFERRED_ENCODING, encoded=False):
-    """Turn all param values (int, list, bool) into utf8 encoded strings.
-    """
-
-    if params:
-        for key in params.keys():
-            if isinstance(params[key], bool):
-                if params[key]:
-                    params[key] = 'yes'
-                else:
-                    params[key] = 'no'
+def _convert_any(value):
+    "Convert a parameter value of any type to a string, or None if empty."
+    if value is True:
+        return 'yes'
+    elif value is False:
+        return 'no'
+    elif isinstance(value, (int, long)):
+        return str(value)
+    elif not value:
+        # strip/ignore empties other than False or 0
+        return None
+    elif isinstance(value, list):
+        return " ".join(value)
+    return value
+
+def _convert_text(value):
+    "Text: empty strings are left out, other values converted by value."
+    if type(value) in (str, unicode):
+        return value or None
+    return _convert_any(value)
+
+def _convert_tags(value):
+    """Tags: a list or tuple of tags, or a space separated string. Runs of
+    whitespace are collapsed to one space."""
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)):
+        value = " ".join(value)
+    elif not isinstance(value, basestring):
+        raise ValueError, "tags must be a string or list, not %r" % (value,)
+    return " ".join(value.split()) or None
+
+_bool_strings = {'yes': 'yes', 'true': 'yes', '1': 'yes',
+    'no': 'no', 'false': 'no', '0': 'no'}
+
+def _convert_bool(value):
+    """Bool: True or False, 1 or 0, or the strings 'yes', 'true', '1' or
+    'no', 'false', '0' in any case."""
+    if value is None or value == '':
+        return None
+    if value in (True, False) and not isinstance(value, basestring):
+        return value and 'yes' or 'no'
+    if isinstance(value, basestring) and value.lower() in _bool_strings:
+        return _bool_strings[value.lower()]
+    raise ValueError, "expected yes or no, not %r" % (value,)
+
+def _convert_int(value):
+    "Int: a non-negative integer, or a string of digits."
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, long)) and not isinstance(value, bool) \
+            and value >= 0:
+        return str(value)
+    if isinstance(value, basestring) and value.isdigit():
+        return value
+    raise ValueError, "expected a non-negative integer, not %r" % (value,)
+
+_param_converters = {
+    'text': _convert_text,
+    'tags': _convert_tags,
+    'bool': _convert_bool,
+    'int': _convert_int,
+}
 
-            elif isinstance(params[key], int):
-                params[key] = str(params[key])
+_recoders = {}
+
+def _get_recoder(usercodec, encoded):
+    """Return a function that turns a string in ``usercodec`` (or an
+    already UTF-8 encoded one if ``encoded``) into UTF-8."""
+    key = (usercodec, encoded)
+    if key not in _recoders:
+        if encoded:
+            def recode(value):
+                assert isinstance(value, str)
+                return value
+        elif codecs.lookup(usercodec).name == 'utf-8':
+            def recode(value):
+                if type(value) is unicode:
+                    return value.encode('utf-8')
+                value.decode('utf-8') # only check
+                return value
+        else:
+            def recode(value):
+                if type(value) is unicode:
+                    return value.encode('utf-8')
+                return value.decode(usercodec).encode('utf-8')
+        _recoders[key] = recode
+    return _recoders[key]
+
+
+class ParamSchema:
+
+    """The parameters of an API path and their types, compiled once into an
+    encoder for their values. Types are 'text', 'tags' (a list or space
+    separated string, whitespace normalized), 'bool' (True/False or
+    'yes'/'no') and 'int' (non-negative). Values that don't fit their type
+    raise ValueError. Parameters not in the schema are converted according
+    to their value. See DLCS_PARAM_TYPES.
+    """
 
-            elif not params[key]:
-                # strip/ignore empties other than False or 0
-                del params[key]
-                continue
+    def __init__(self, types=None):
+        self.types = types or {}
+        self.converters = dict([(name, _param_converters[type])
+            for name, type in self.types.items()])
 
-            elif isinstance(params[key], list):
-                params[key] = " ".join(params[key])
+    def encode(self, params, usercodec=PREFERRED_ENCODING, encoded=False):
+        """Return a new dictionary with the non-empty parameter values as
+        UTF-8 encoded strings. ``params`` is left unchanged.
+        """
+        if not params:
+            return {}
+        recode = _get_recoder(usercodec, encoded)
+        converters = self.converters
+        encoded_params = {}
+        for key, value in params.iteritems():
+            try:
+                value = converters.get(key, _convert_any)(value)
+            except ValueError, e:
+                raise ValueError, "Parameter %s: %s" % (key, e)
+            if value:
+                encoded_params[key] = recode(value)
+        return encoded_params
 
-            if encoded:
-            	assert isinstance(params[key], str)
-            else:
-                params[key] = params[key].decode(usercodec)
+    def __repr__(self):
+        return "<ParamSchema %s>" % ", ".join(sorted(self.types))
 
-            assert isinstance(params[key], basestring)
 
-        if not encoded:
-            params = dict([ (k, v.encode('utf8'))
-                    for k, v in params.items() if v])
+param_schemas = dict([(path, ParamSchema(types))
+    for path, types in DLCS_PARAM_TYPES.items()])
+_any_schema = ParamSchema()
 
-    return params
+def dlcs_encode_params(params, usercodec=PREFERRED_ENCODING, encoded=False,
+        path=None):
+    """Turn all param values (int, list, bool) into utf8 encoded strings,
+    according to the `ParamSchema` for API ``path`` if there is one. Returns
+    a new dictionary without the empty values.
+    """
+    return param_schemas.get(path, _any_schema).encode(params, usercodec,
+            encoded)
+
+def _accepts_keyword(func, name):
+    """Tell if callable ``func`` takes keyword argument ``name``, so that
+    hooks written before it was added keep working."""
+    if hasattr(func, 'func') and hasattr(func, 'keywords'):
+        # functools.partial
+        func = func.func
+    if inspect.isclass(func):
+        func = func.__init__
+    elif not (inspect.isfunction(func) or inspect.ismethod(func)):
+        func = getattr(func, '__call__', None)
+    try:
+        args, varargs, varkw, defaults = inspect.getargspec(func)
+    except TypeError:
+        return False
+    return bool(varkw) or name in args
 
 
 def dlcs_parse_xml(data, split_tags=False):
@@ -405,7 +1472,7 @@ def dlcs_parse_xml(data, split_tags=False):
 
         # Update: "time"
         return {fmt: {
-            'time':time.strptime(root.attrib['time'], ISO_8601_DATETIME) }}
+            'time':iso_time_tuple(root.attrib['time']) }}
 
     else:
         raise PyDeliciousException, "Unknown XML document format '%s'" % fmt
@@ -548,6 +1615,50 @@ def dlcs_rss_request(tag="", popular=0, user="", url=''):
     Summary information about a URL (as seen in the tagometer):
         json/urlinfo/{url md5}
 """
+class UrlTemplate:
+
+    """A URL template with ``%(name)s`` fields, compiled once into a
+    format string. Call it with the field values to get the URL, values are
+    quoted and other keywords ignored. ``required`` is the set of field
+    names.
+    """
+
+    def __init__(self, template, base=''):
+        parts = _template_field.split(template)
+        self.template = template
+        self.fields = tuple(parts[1::2])
+        self.required = frozenset(self.fields)
+        self.format = (base + "%s".join([literal.replace('%', '%%')
+            for literal in parts[0::2]]))
+
+    def __call__(self, **params):
+        return self.format % tuple([quote_plus(str(params[field]))
+            for field in self.fields])
+
+    def matches(self, params):
+        "Tell wether the template has exactly the fields in ``params``."
+        return self.required == frozenset(params)
+
+    def __repr__(self):
+        return "<UrlTemplate %s>" % self.template
+
+_template_field = re.compile(r'%\((\w+)\)s')
+
+_feed_templates = {}
+
+def get_feed_template(template, base=None):
+    """Return the (cached) `UrlTemplate` for a template below feeds URL
+    ``base``, DLCS_FEEDS by default."""
+    if base is None:
+        base = DLCS_FEEDS
+    try:
+        return _feed_templates[base, template]
+    except KeyError:
+        builder = _feed_templates[base, template] = UrlTemplate(template,
+                base)
+        return builder
+
+
 delicious_v2_feeds = {
     # Bookmarks from the hotlist
     'hotlist': "%(format)s",
@@ -592,12 +1703,16 @@ delicious_v2_feeds = {
 }
 
 
-def dlcs_feed(name_or_url, url_map=delicious_v2_feeds, count=15, **kwds):
+def dlcs_feed(name_or_url, url_map=delicious_v2_feeds, count=15,
+        timeout=None, opener=None, feeds_url=None, **kwds):
 
     """
     Request and parse a feed.
     Count should be between 1 and 100, default 15.
     Format values include 'rss' and 'json', defaults to json.
+    Time limits can be set with a `Timeout` instance, and another urllib2
+    opener can be given (i.e. to replay a recorded cassette). Named feeds
+    are below ``feeds_url``, DLCS_FEEDS by default.
 
     - http://www.delicious.com/help/feeds
     """
@@ -612,15 +1727,14 @@ def dlcs_feed(name_or_url, url_map=delicious_v2_feeds, count=15, **kwds):
     if not name_or_url:
         name_or_url = 'hotlist'
     if name_or_url in url_map:
-        params = dict([(k, quote_plus(str(v))) for k,v in kwds.items()])
-        url = DLCS_FEEDS + url_map[name_or_url] % params
+        url = get_feed_template(url_map[name_or_url], feeds_url)(**kwds)
     else:
         url = name_or_url
 
     if DEBUG:
         print 'dlcs_feed', url
 
-    feed = http_request(url).read()
+    feed = http_request(url, opener=opener, timeout=timeout).read()
 
     if format == 'rss':
         if feedparser:
@@ -632,6 +1746,115 @@ def dlcs_feed(name_or_url, url_map=delicious_v2_feeds, count=15, **kwds):
         return feed
 
 
+### Bulk operations
+
+class BulkResult:
+
+    """Outcome of a bulk write, see `DeliciousAPI.posts_add_many()`.
+
+    :done: the number of items written
+    :failed: list of ``(item, exception)`` for items that were not written
+    :elapsed: seconds taken by the whole batch
+    """
+
+    def __init__(self):
+        self.done = 0
+        self.failed = []
+        self.elapsed = 0
+        self.lock = threading.Lock()
+
+    def add(self, item, error=None):
+        self.lock.acquire()
+        try:
+            if error:
+                self.failed.append((item, error))
+            else:
+                self.done += 1
+        finally:
+            self.lock.release()
+
+    def get_count(self):
+        return self.done + len(self.failed)
+    count = property(get_count)
+
+    def get_rate(self):
+        "Items per second."
+        if not self.elapsed:
+            return 0.0
+        return self.count / self.elapsed
+    rate = property(get_rate)
+
+    def __str__(self):
+        return "%i done, %i failed in %.1f seconds (%.2f/s)" % (self.done,
+                len(self.failed), self.elapsed, self.rate)
+
+    def __repr__(self):
+        return "<BulkResult %s>" % self
+
+
+_stop_worker = object()
+
+def dlcs_bulk(call, items, workers=1):
+    """Call ``call(item)`` for each item of the (possibly endless) iterable
+    and return a `BulkResult`.
+
+    Negative answers, throttling and network errors are recorded per item
+    and do not stop the batch, other errors (i.e. PyDeliciousUnauthorized)
+    do. With more than one worker, items are taken from ``items`` as
+    workers become available and submitted from that many threads. The
+    calls still pass the rate limiter of the client, but the next request
+    can go out while the previous answer is underway.
+    """
+    result = BulkResult()
+    started = time.time()
+
+    def submit(item):
+        try:
+            call(item)
+        except (DeliciousError, PyDeliciousException, PyDeliciousThrottled), e:
+            result.add(item, e)
+        else:
+            result.add(item)
+
+    if workers <= 1:
+        for item in items:
+            submit(item)
+
+    else:
+        queue = Queue.Queue(workers)
+        errors = []
+        def work():
+            while True:
+                item = queue.get()
+                if item is _stop_worker:
+                    return
+                if errors:
+                    continue # drain after a fatal error
+                try:
+                    submit(item)
+                except Exception, e:
+                    errors.append(e)
+        threads = [threading.Thread(target=work) for i in range(workers)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        try:
+            for item in items:
+                if errors:
+                    break
+                queue.put(item)
+        finally:
+            for thread in threads:
+                queue.put(_stop_worker)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+
+    result.elapsed = time.time() - started
+    return result
+
+
 ### Main module class
 
 class DeliciousAPI:
@@ -648,7 +1871,8 @@ class DeliciousAPI:
     def __init__(self, user, passwd, codec=PREFERRED_ENCODING,
             api_request=dlcs_api_request, xml_parser=dlcs_parse_xml,
             build_opener=dlcs_api_opener, encode_params=dlcs_encode_params,
-            encoded=False):
+            encoded=False, retry_policy=None, timeout=None, waiter=None,
+            api_url=DLCS_API, store=None):
 
         """Initialize access to the API for ``user`` with ``passwd``.
 
@@ -658,15 +1882,45 @@ class DeliciousAPI:
         The ``api_request`` and ``xml_parser`` parameters by default point to
         functions within this package with standard implementations which
         request and parse a resource. See ``dlcs_api_request()`` and
-        ``dlcs_parse_xml()``.
+        ``dlcs_parse_xml()``. Of the keywords in API_REQUEST_KEYWORDS, an
+        ``api_request`` is only given those it takes, so hooks with the
+        ``(path, params, user, passwd, opener)`` signature keep working.
 
         Parameter ``build_opener`` is a callable that, provided with the 
         credentials, should build a urllib2 opener for the delicious API server
         with HTTP authentication. See ``dlcs_api_opener()`` for the default
         implementation.
 
-        ``encode_params`` finally preprocesses API parameters before
-        they are passed to ``api_request``.
+        ``encode_params`` preprocesses API parameters before
+        they are passed to ``api_request``, it is given the API path as
+        keyword ``path``. See ``dlcs_encode_params()``. For compatibility,
+        encoders with the old ``(params, codec, encoded=False)`` signature
+        are called without ``path``.
+
+        ``retry_policy`` is the `RetryPolicy` for transient errors.
+        Each instance gets its own policy (and retry budget) by default.
+
+        ``timeout`` is the default `Timeout` for requests. Paths
+        in DLCS_READ_TIMEOUTS (i.e. 'posts/all') get a longer read timeout.
+        Single calls can pass their own as ``_timeout``, e.g.::
+
+            api.posts_get(url=url, _timeout=Timeout(connect=2, read=5))
+
+        ``waiter`` is the adaptive rate limiter for the requests of this
+        instance (see `_AdaptiveWaiter`), each instance gets its own by
+        default. Pass the same waiter to instances for the same user.
+
+        ``api_url`` is the root of the API paths, DLCS_API.
+
+        ``store`` finally is an optional local copy of the collection. Each
+        successful request that changes the collection is passed on to its
+        ``apply(path, params)`` method, see `tools/localstore.py`.
+
+        Instances are thread-safe: share one between threads to share its
+        rate limiter and its pool of persistent connections.
+
+        The time spent on rate limiting, requests, retries and parsing is
+        accounted for in ``stats``, a `ClientStats`.
         """
 
         assert user != ""
@@ -677,17 +1931,33 @@ class DeliciousAPI:
         # Implement communication to server and parsing of respons messages:
         assert callable(encode_params)
         self._encode_params = encode_params
+        self._encode_path = _accepts_keyword(encode_params, 'path')
         self._encoded = encoded
         assert callable(build_opener)
         self._opener = build_opener(user, passwd)
         assert callable(api_request)
         self._api_request = api_request
+        self._request_keywords = frozenset([name
+            for name in API_REQUEST_KEYWORDS
+            if _accepts_keyword(api_request, name)])
         assert callable(xml_parser)
         self._parse_response = xml_parser
+        if not retry_policy:
+            retry_policy = RetryPolicy()
+        self._retry_policy = retry_policy
+        if not timeout:
+            timeout = Timeout()
+        self.timeout = timeout
+        if not waiter:
+            waiter = _AdaptiveWaiter(DLCS_WAIT_TIME)
+        self.waiter = waiter
+        self.api_url = api_url
+        self.store = store
+        self.stats = ClientStats()
 
     ### Core functionality
 
-    def request(self, path, _raw=False, **params):
+    def request(self, path, _raw=False, _timeout=None, **params):
         """Sends a request message to `path` in the API, and parses the results
         from XML. Use with ``_raw=True`` or ``call request_raw()`` directly
         to get the filehandler and process the response message manually.
@@ -705,21 +1975,22 @@ class DeliciousAPI:
         Positive answers are silently accepted and nothing is returned.
 
         Using ``_raw=True`` bypasses all parsing and never raises
-        ``DeliciousError``.
+        ``DeliciousError``. ``_timeout`` overrides the `Timeout` for this call.
 
         See ``dlcs_parse_xml()`` and ``self.request_raw()``."""
 
         if _raw:
             # return answer
-            return self.request_raw(path, **params)
+            return self.request_raw(path, _timeout=_timeout, **params)
 
         else:
-            params = self._encode_params(params, self.codec,
-                    encoded=self._encoded)
+            params = self._encode(path, params)
 
             # get answer and parse
-            fl = self._api_request(path, params=params, opener=self._opener)
+            fl = self._call_api(path, params, _timeout)
+            started = time.time()
             rs = self._parse_response(fl)
+            self.stats.add_parse(time.time() - started)
 
             if type(rs) == dict and 'result' in rs:
                 if not rs['result'][0]:
@@ -731,19 +2002,51 @@ class DeliciousAPI:
 
                 else:
                     # not out-of-the-oridinary result, OK
+                    if self.store and path not in DLCS_IDEMPOTENT_PATHS:
+                        self.store.apply(path, params)
                     return
 
             return rs
 
-    def request_raw(self, path, **params):
+    def request_raw(self, path, _timeout=None, **params):
         """Calls the path in the API, returns the filehandle. Returned file-
         like instances have an ``HTTPMessage`` instance with HTTP header
         information available. Use ``filehandle.info()`` or refer to the
         ``urllib2.openurl`` documentation.
         """
         # see `request()` on how the response can be handled
-        params = self._encode_params(params, self.codec, encoded=self._encoded)
-        return self._api_request(path, params=params, opener=self._opener)
+        params = self._encode(path, params)
+        return self._call_api(path, params, _timeout)
+
+    def _call_api(self, path, params, timeout=None):
+        """Call the ``api_request``, with the keywords it takes of those
+        added after ``(path, params, user, passwd, opener)``."""
+        kwds = {'retry_policy': self._retry_policy, 'waiter': self.waiter,
+            'timeout': self.get_timeout(path, timeout),
+            'api_url': self.api_url, 'stats': self.stats}
+        for name in kwds.keys():
+            if name not in self._request_keywords:
+                del kwds[name]
+        return self._api_request(path, params=params, opener=self._opener,
+                **kwds)
+
+    def _encode(self, path, params):
+        "Return ``params`` for ``path`` encoded by the ``encode_params``."
+        if self._encode_path:
+            return self._encode_params(params, self.codec,
+                    encoded=self._encoded, path=path)
+        return self._encode_params(params, self.codec, encoded=self._encoded)
+
+    def get_timeout(self, path, timeout=None):
+        """Return ``timeout`` or the instance `Timeout` for a request to
+        ``path``, with the longer read timeout of DLCS_READ_TIMEOUTS if the
+        path has one.
+        """
+        if timeout:
+            return timeout
+        if path in DLCS_READ_TIMEOUTS:
+            return self.timeout.replace(read=DLCS_READ_TIMEOUTS[path])
+        return self.timeout
 
     ### Explicit declarations of API paths, their parameters and docs
 
@@ -945,6 +2248,27 @@ class DeliciousAPI:
         """
         return self.request("tags/bundles/delete", bundle=bundle, **kwds)
 
+    # Bulk
+    def posts_add_many(self, posts, workers=1, **kwds):
+        """Add many posts, each given as a dictionary of `posts_add`
+        arguments. ``posts`` can be any iterable (i.e. a generator) and is
+        consumed as the posts are written. Returns a `BulkResult` with
+        throughput and the failed posts, for example those raising
+        ``DeliciousItemExistsError``. Other keywords apply to every post,
+        e.g. ``replace=True``. See `dlcs_bulk()` for ``workers``.
+        """
+        def add(post):
+            params = dict(kwds)
+            params.update(post)
+            self.posts_add(**params)
+        return dlcs_bulk(add, posts, workers)
+
+    def posts_delete_many(self, urls, workers=1):
+        """Delete the posts for many URLs from any iterable. Returns a
+        `BulkResult`, see `posts_add_many()`.
+        """
+        return dlcs_bulk(self.posts_delete, urls, workers)
+
     ### Utils
 
     # Lookup table for del.icio.us url-path to DeliciousAPI method.
@@ -976,46 +2300,124 @@ class DeliciousAPI:
         return "DeliciousAPI(%s)" % self.user
 
 
+### Client pool
+
+class DeliciousClientPool:
+
+    """Caches `DeliciousAPI` instances per set of credentials, for processes
+    working on behalf of many users.
+
+    The least recently used client is dropped when there are more than
+    `maxsize`. All clients share one `ConnectionPool`. The rate limiter
+    (waiter) of a user outlives a dropped client for as long as it still
+    delays calls, so a rebuilt client continues with it. Thread-safe.
+
+    Other keyword arguments are passed on to `DeliciousAPI`, except
+    ``waiter``: the pool owns the waiter of each user.
+    """
+
+    def __init__(self, maxsize=DLCS_CLIENT_POOL_SIZE, connection_pool=None,
+            **api_kwds):
+        if 'waiter' in api_kwds:
+            raise TypeError, "DeliciousClientPool keeps a waiter per user, " \
+                "it takes no 'waiter' argument"
+        self.maxsize = maxsize
+        if not connection_pool:
+            connection_pool = ConnectionPool()
+        self.connection_pool = connection_pool
+        self.api_kwds = api_kwds
+        self.clients = OrderedDict()
+        self.waiters = {}
+        self.lock = threading.Lock()
+
+    def get(self, user, passwd):
+        "Return the client for ``user``, building it if needed."
+        key = (user, passwd)
+        self.lock.acquire()
+        try:
+            if key in self.clients:
+                client = self.clients.pop(key)
+            else:
+                client = self.build(user, passwd)
+            # (re)insert as most recently used
+            self.clients[key] = client
+            if len(self.clients) > self.maxsize:
+                self.evict()
+            return client
+        finally:
+            self.lock.release()
+
+    def build(self, user, passwd):
+        if user not in self.waiters:
+            self.waiters[user] = _AdaptiveWaiter(DLCS_WAIT_TIME)
+        kwds = dict(self.api_kwds)
+        kwds.setdefault('build_opener', self.build_opener)
+        return DeliciousAPI(user, passwd, waiter=self.waiters[user], **kwds)
+
+    def build_opener(self, user, passwd):
+        return dlcs_api_opener(user, passwd, pool=self.connection_pool)
+
+    def evict(self):
+        "Drop the least recently used client, and waiters no longer delaying."
+        (user, passwd), client = self.clients.popitem(last=False)
+        tt = time.time()
+        active = set([u for u, p in self.clients])
+        for user, waiter in self.waiters.items():
+            if user not in active and waiter.next_call() < tt:
+                del self.waiters[user]
+
+    def __len__(self):
+        return len(self.clients)
+
+
+Clients = DeliciousClientPool()
+"Client pool used by the quick API access functions"
+
+
 ### Quick API access
 
 def apiNew(user, passwd):
     "Creates a new DeliciousAPI object, requires user(name) and passwd."
     return DeliciousAPI(user=user, passwd=passwd)
 
+def apiGet(user, passwd):
+    "Returns the pooled DeliciousAPI object for user, see `Clients`."
+    return Clients.get(user, passwd)
+
 def add(user, passwd, url, description, tags="", extended="", dt=None,
         replace=False):
     "Add a post for user. "
-    apiNew(user, passwd).posts_add(url=url, description=description,
+    apiGet(user, passwd).posts_add(url=url, description=description,
             extended=extended, tags=tags, dt=dt, replace=replace)
 
 def get(user, passwd, tag="", dt=None, count=0, hashes=[]):
     "Returns a list of posts for the user using the API. "
-    posts = apiNew(user, passwd).posts_get(
+    posts = apiGet(user, passwd).posts_get(
             tag=tag, dt=dt, hashes=hashes)['posts']
     if count: posts = posts[:count]
     return posts
 
 def get_update(user, passwd):
     "Returns the last update time for the user. "
-    return apiNew(user, passwd).posts_update()['update']['time']
+    return apiGet(user, passwd).posts_update()['update']['time']
 
 def get_all(user, passwd, tag="", start=0, results=100, fromdt=None,
         todt=None):
     "Returns a list with all posts. Please use sparingly. See `get_updated`"
-    return apiNew(user, passwd).posts_all(tag=tag, start=start,
+    return apiGet(user, passwd).posts_all(tag=tag, start=start,
             results=results, fromdt=fromdt, todt=todt, meta=True)['posts']
 
 def get_tags(user, passwd):
     "Returns a list with all tags for user."
-    return apiNew(user=user, passwd=passwd).tags_get()['tags']
+    return apiGet(user=user, passwd=passwd).tags_get()['tags']
 
 def delete(user, passwd, url):
     "Delete the URL from the del.icio.us account."
-    apiNew(user, passwd).posts_delete(url=url)
+    apiGet(user, passwd).posts_delete(url=url)
 
 def rename_tag(user, passwd, oldtag, newtag):
     "Rename the tag for the del.icio.us account."
-    apiNew(user=user, passwd=passwd).tags_rename(old=oldtag, new=newtag)
+    apiGet(user=user, passwd=passwd).tags_rename(old=oldtag, new=newtag)
 
 
 ### Old RSS
@@ -65,7 +65,10 @@ if Command:
         entry_points = {
             'console_scripts': [
                 'dlcs = pydelicious.tools.dlcs:_main',
-                'dlcs_feeds = pydelicious.tools.dlcs_feeds:_main'
+                'dlcs_feeds = pydelicious.tools.dlcs_feeds:_main',
+                'dlcs_mockserver = pydelicious.tools.mockserver:_main',
+                'dlcs_loadgen = pydelicious.tools.loadgen:_main',
+                'dlcsd = pydelicious.tools.dlcsd:_main'
             ]
         }
     ))
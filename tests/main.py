@@ -8,9 +8,10 @@ def init_unittest_suite():
     """
 
     from pydelicioustest import __testcases__ as l1
+    from toolstest import __testcases__ as l2
 
     suites = []
-    for testcase in l1:
+    for testcase in l1 + l2:
         suites.append(unittest.TestLoader().loadTestsFromTestCase(testcase))
 
     return unittest.TestSuite(suites)
@@ -1,43 +1,30 @@
 """Unittests for pydelicious module.
 """
 import sys, os
+import calendar
+import datetime
+import errno
+import gzip
+import socket
+import tempfile
+import threading
 import unittest
 import urllib
 import urllib2
 import pydelicious
 import time
+try:
+    from pydelicious.tools import mockserver, cassette, loadgen, localstore
+except ImportError:
+    from tools import mockserver, cassette, loadgen, localstore
 from StringIO import StringIO
 
-test_data = {
-    # old rss feeds
-    'http://del.icio.us/rss/': 'var/rss.xml',
-    'http://del.icio.us/rss/popular/': 'var/rss_popular.xml',
-    'http://del.icio.us/rss/tag/python': 'var/rss_tag_python.xml',
-    'http://del.icio.us/rss/pydelicious': 'var/rss_pydelicious.xml',
-    'http://del.icio.us/rss/url/efbfb246d886393d48065551434dab54': 'var/rss_url.xml',
-
-    # v2 feeds
-    'http://feeds.delicious.com/v2/json': 'var/feed_v2.json',
-    'http://feeds.delicious.com/v2/rss': 'var/feed_v2.rss',
-    'http://feeds.delicious.com/v2/json/recent': 'var/feed_v2_recent.json',
-    'http://feeds.delicious.com/v2/rss/recent': 'var/feed_v2_recent.rss.xml',
-
-}
-def fetch_file(url, fn):
-    data = urllib2.urlopen(url).read()
-    if os.path.exists(fn):
-        acted = 'Overwritten'
-    else:
-        acted = 'New'
-    open(fn, 'w+').write(data)
-    print "%s file %s for <%s>" % (acted, fn, url)
+# Recorded feeds, old rss and v2 (refresh with 'refresh_test_data')
+test_data = cassette.Cassette('var/feeds.cassette').load()
 
-def http_request_dummy(url, user_agent=None, retry=0, opener=None):
+def http_request_dummy(url, user_agent=None, retry=0, opener=None, **kwds):
     if url in test_data:
-        fn = test_data[url]
-        if not os.path.isfile(fn): 
-            fetch_file(url, fn)
-        return open(fn)
+        return test_data.response(url)
 
     else:
         return StringIO(url)
@@ -45,6 +32,7 @@ def http_request_dummy(url, user_agent=None, retry=0, opener=None):
 # Turn of all HTTP fetching in pydelicious,
 # don't do http requests but return pre-def data
 # See blackbox tests if you want to test for real
+http_request = pydelicious.http_request
 pydelicious.http_request = http_request_dummy
 
 
@@ -102,6 +90,526 @@ class TestWaiter(PyDeliciousTester):
                     "needed wait of %s, not %s" % (i*wt, waited,))
 
 
+class TestAdaptiveWaiter(PyDeliciousTester):
+
+    def test_aimd(self):
+        w = pydelicious._AdaptiveWaiter(2, min_wait=1, max_wait=8,
+                increase=.1, decrease=.5)
+        self.assertEqual(w.rate, .5)
+        w.backoff()
+        self.assertEqual(w.rate, .25)
+        self.assertEqual(w.throttled, 1)
+        w.backoff(); w.backoff()
+        self.assertEqual(w.wait, 8) # capped at max_wait
+        w.recover()
+        self.assertAlmostEqual(w.rate, .225)
+        w.recover(latency=w.latency_limit+1) # slow answers don't count
+        self.assertAlmostEqual(w.rate, .225)
+        for i in range(20):
+            w.recover()
+        self.assertEqual(w.rate, 1) # capped at min_wait
+
+    def test_retry_after(self):
+        w = pydelicious._AdaptiveWaiter(0)
+        w.backoff(retry_after=.3)
+        t = time.time()
+        w()
+        self.assert_(time.time() - t >= .25)
+
+    def test_parse_retry_after(self):
+        p = pydelicious.parse_retry_after
+        self.assertEqual(p('120'), 120)
+        self.assertEqual(p('Thu, 01 Jan 1970 00:00:00 GMT'), 0)
+        self.assertEqual(p('soon'), None)
+
+    def test_retry_throttled(self):
+        calls = []
+        def http_request_throttled(url, **kwds):
+            calls.append(url)
+            if len(calls) < 3:
+                e = pydelicious.PyDeliciousThrottled()
+                e.retry_after = 0
+                raise e
+            return StringIO(url)
+        w = pydelicious._AdaptiveWaiter(0, min_wait=0.001, max_wait=.01)
+        request = pydelicious.dlcs_api_request
+        pydelicious.http_request = http_request_throttled
+        try:
+            request('posts/get', opener=True, waiter=w)
+            self.assertEqual(len(calls), 3)
+            self.assertEqual(w.throttled, 2)
+            # never repeat mutating paths
+            del calls[:]
+            self.assertRaises(pydelicious.PyDeliciousThrottled,
+                    request, 'posts/add', opener=True, waiter=w)
+            self.assertEqual(len(calls), 1)
+        finally:
+            pydelicious.http_request = http_request_dummy
+
+
+class FailingOpener:
+
+    "Raises each of `errors` once, then returns `url`."
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def open(self, request, *args, **kwds):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return StringIO(request.get_full_url())
+
+
+class TestRetryPolicy(PyDeliciousTester):
+
+    def setUp(self):
+        self.policy = pydelicious.RetryPolicy(base=.001, cap=.01)
+
+    def test_retryable(self):
+        r = self.policy.retryable
+        self.assert_(r(urllib2.URLError(socket.timeout('timed out'))))
+        self.assert_(r(socket.error(errno.ECONNRESET, 'reset')))
+        self.assert_(r(urllib2.HTTPError('', 502, 'Bad Gateway', {}, None)))
+        self.failIf(r(urllib2.HTTPError('', 404, 'Not Found', {}, None)))
+        self.failIf(r(urllib2.URLError('unknown url type: foo')))
+
+    def test_delay(self):
+        p = pydelicious.RetryPolicy(base=1, cap=5)
+        for attempt in range(10):
+            self.assert_(0 <= p.delay(attempt) <= min(5, 2**attempt))
+
+    def test_retries(self):
+        o = FailingOpener(socket.timeout(), socket.timeout())
+        self.assertEqual(http_request('http://x/', opener=o,
+            retry_policy=self.policy).read(), 'http://x/')
+        self.assertEqual(o.calls, 3)
+        self.assertEqual(self.policy.retried, 2)
+
+    def test_no_retry(self):
+        o = FailingOpener(urllib2.HTTPError('', 404, 'Not Found', {}, None))
+        self.assertRaises(pydelicious.PyDeliciousException, http_request,
+                'http://x/', opener=o, retry_policy=self.policy)
+        self.assertEqual(o.calls, 1)
+
+    def test_budget(self):
+        self.policy.tokens = 1
+        o = FailingOpener(*[socket.timeout()]*3)
+        self.assertRaises(pydelicious.PyDeliciousException, http_request,
+                'http://x/', opener=o, retry_policy=self.policy)
+        self.assertEqual(o.calls, 2)
+        self.assertEqual(self.policy.exhausted, 1)
+
+    def test_deadline(self):
+        p = pydelicious.RetryPolicy(base=10, cap=10)
+        p.delay = lambda attempt: 10
+        o = FailingOpener(socket.timeout())
+        self.assertRaises(pydelicious.PyDeliciousException, http_request,
+                'http://x/', opener=o, retry_policy=p, deadline=5)
+        self.assertEqual(o.calls, 1)
+
+
+class TestTimeout(PyDeliciousTester):
+
+    def test_no_global_timeout(self):
+        self.assertEqual(socket.getdefaulttimeout(), None)
+
+    def test_get_timeout(self):
+        a = pydelicious.DeliciousAPI('testUser', 'testPwd',
+            timeout=pydelicious.Timeout(connect=1, read=2))
+        self.assertEqual(a.get_timeout('posts/get').read, 2)
+        t = a.get_timeout('posts/all')
+        self.assertEqual((t.connect, t.read),
+                (1, pydelicious.DLCS_REQUEST_TIMEOUT))
+        t = pydelicious.Timeout(read=3)
+        self.assertEqual(a.get_timeout('posts/all', t), t)
+
+    def test_read_timeout(self):
+        # accepts connections but never answers
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        url = 'http://127.0.0.1:%i/' % server.getsockname()[1]
+        opener = urllib2.build_opener(pydelicious.TimeoutHTTPHandler)
+        t = time.time()
+        try:
+            self.assertRaises(pydelicious.PyDeliciousException, http_request,
+                url, opener=opener, retry=1,
+                timeout=pydelicious.Timeout(connect=5, read=.2))
+        finally:
+            server.close()
+        self.assert_(time.time() - t < 2)
+
+
+class MockAPITester(PyDeliciousTester):
+
+    def setUp(self):
+        self.server = mockserver.MockDeliciousServer().start()
+        self.collection = self.server.add_user('testUser', 'testPwd',
+            mockserver.synthetic_posts(200))
+        self.host = host = self.server.host
+        self.pool = pydelicious.ConnectionPool(maxsize=8)
+        self.api = pydelicious.DeliciousAPI('testUser', 'testPwd',
+            api_url=self.server.api_url,
+            waiter=pydelicious._AdaptiveWaiter(0),
+            build_opener=lambda user, passwd: pydelicious.build_api_opener(
+                host, user, passwd, pool=self.pool))
+        pydelicious.http_request = http_request
+
+    def tearDown(self):
+        pydelicious.http_request = http_request_dummy
+        self.server.stop()
+        self.pool.clear()
+
+
+class TestThreadSafety(MockAPITester):
+
+    def test_concurrent_requests(self):
+        threads, calls = 8, 25
+        errors, results = [], []
+        urls = sorted(self.collection.posts)
+        def worker(n):
+            try:
+                for i in range(calls):
+                    url = urls[n * calls + i]
+                    post = self.api.posts_get(url=url)['posts'][0]
+                    results.append(post['href'] == url)
+            except Exception, e:
+                errors.append(e)
+        workers = [threading.Thread(target=worker, args=(n,))
+                for n in range(threads)]
+        for t in workers: t.start()
+        for t in workers: t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [True] * threads * calls)
+        # connections were reused
+        self.assert_(self.pool.created <= threads, self.pool.created)
+        self.assertEqual(self.pool.created + self.pool.reused,
+                threads * calls)
+
+
+class TestMetrics(MockAPITester):
+
+    def test_hooks(self):
+        metrics = pydelicious.RequestMetrics()
+        events = []
+        pydelicious.before_request_hooks.append(events.append)
+        pydelicious.after_request_hooks.append(metrics)
+        try:
+            for i in range(3):
+                self.api.posts_get(url='http://example.org/%i' % i)
+            api = pydelicious.DeliciousAPI('testUser', 'wrongPwd',
+                api_url=self.api.api_url, waiter=self.api.waiter,
+                build_opener=lambda user, passwd: pydelicious.build_api_opener(
+                    self.host, user, passwd, pool=self.pool))
+            self.assertRaises(pydelicious.PyDeliciousUnauthorized,
+                    api.posts_get, url='http://example.org/')
+        finally:
+            pydelicious.before_request_hooks.remove(events.append)
+            pydelicious.after_request_hooks.remove(metrics)
+        self.assertEqual(len(events), 4)
+        self.assertEqual(events[0].path, 'posts/get')
+        self.assert_(events[0].bytes > 0)
+        self.assert_(isinstance(events[3].error,
+                pydelicious.PyDeliciousUnauthorized))
+        stats = metrics.as_dict()['posts/get']
+        self.assertEqual(stats['requests'], 4)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['status'], {'200': 3, '401': 1})
+        text = metrics.prometheus()
+        self.assert_('pydelicious_requests_total{path="posts/get",'
+                'status="200"} 3\n' in text, text)
+        self.assert_('pydelicious_request_seconds_count{path="posts/get"} 4\n'
+                in text, text)
+
+
+class TestMockServer(MockAPITester):
+
+    def test_api(self):
+        self.api.posts_add('http://example.net/', 'Net', tags='a b')
+        self.assertRaises(pydelicious.DeliciousItemExistsError,
+            self.api.posts_add, 'http://example.net/', 'Net', replace=False)
+        self.api.tags_rename('a', 'c')
+        posts = self.api.posts_get(url='http://example.net/')['posts']
+        self.assertEqual(posts[0]['tag'], 'c b')
+        # renaming to tags that include the old one keeps it
+        self.api.posts_add('http://example.net/x', 'X', tags='d b e')
+        self.api.tags_rename('b', 'b f d')
+        posts = self.api.posts_get(url='http://example.net/x')['posts']
+        self.assertEqual(posts[0]['tag'], 'd b f e')
+        posts = self.api.posts_get(url='http://example.net/')['posts']
+        self.assertEqual(posts[0]['tag'], 'c b f d')
+        self.api.posts_delete('http://example.net/x')
+        posts = self.api.posts_all(results=10)['posts']
+        self.assertEqual(len(posts), 10)
+        self.assertEqual(posts[0]['href'], 'http://example.net/')
+        self.api.posts_delete('http://example.net/')
+        self.assertEqual(len(self.api.posts_all()['posts']), 200)
+        tags = self.api.tags_get()['tags']
+        self.assertEqual(sum([int(tag['count']) for tag in tags]),
+            sum([len(post['tag'].split())
+                for post in self.collection.posts.values()]))
+
+    def test_plan_retag(self):
+        self.api.posts_add('http://x.org/', 'X', tags='uniq')
+        self.api.posts_add('http://y.org/', 'Y', tags='gone other')
+        posts_file = tempfile.mktemp('.xml')
+        open(posts_file, 'w').write(self.api.posts_all(_raw=True).read())
+        try:
+            store = self.api.store = localstore.LocalStore(posts_file)
+            def check(*urls):
+                for url in urls:
+                    self.assertEqual(self.api.posts_get(url=url)['posts'][0]
+                        ['tag'], store.posts[url]['tag'])
+            # adding never renames a tag the user did not name
+            plan = store.plan_retag(add=['extra'], urls=['http://x.org/'])
+            self.assertEqual([path for path, params in plan], ['posts/add'])
+            for path, params in plan:
+                self.api.request(path, **params)
+            check('http://x.org/')
+            self.assertEqual(store.posts['http://x.org/']['tag'], 'uniq extra')
+            # a removed tag on exactly these posts is renamed
+            plan = store.plan_retag(remove=['gone'], add=['new'],
+                urls=['http://y.org/'])
+            self.assertEqual(plan, [('tags/rename',
+                {'old': 'gone', 'new': 'new'})])
+            for path, params in plan:
+                self.api.request(path, **params)
+            check('http://y.org/')
+            # renaming to tags that include the old one
+            self.api.tags_rename('uniq', 'other uniq')
+            check('http://x.org/', 'http://y.org/')
+            self.assertEqual(store.posts['http://x.org/']['tag'],
+                'other uniq extra')
+        finally:
+            os.remove(posts_file)
+
+    def test_throttle(self):
+        self.server.retry_after = 0
+        self.api.waiter = pydelicious._AdaptiveWaiter(0, min_wait=.01)
+        self.server.throttle_next(2)
+        self.assertEqual(len(self.api.posts_recent()['posts']), 15)
+        self.assertEqual(self.api.stats.throttled, 2)
+        self.server.throttle_next(1)
+        self.assertRaises(pydelicious.PyDeliciousThrottled,
+            self.api.posts_add, 'http://example.net/', 'Net')
+        self.assertEqual(self.server.stats[503], 3)
+
+    def test_drop(self):
+        self.api._retry_policy = pydelicious.RetryPolicy(base=.01)
+        self.server.drop_next(2)
+        self.assertEqual(len(self.api.posts_recent()['posts']), 15)
+        self.assertEqual(self.server.stats['dropped'], 2)
+
+    def test_feeds(self):
+        self.api.posts_add('http://example.net/', 'Net', tags='a b')
+        feed = pydelicious.dlcs_feed(self.server.feeds_url + 'json/testUser/a')
+        self.assertEqual(mockserver.json.loads(feed)[0]['u'],
+            'http://example.net/')
+        feed = pydelicious.dlcs_feed(self.server.feeds_url + 'rss/recent')
+        self.assert_('<link>http://example.net/</link>' in feed)
+        feed = pydelicious.dlcs_feed('user_tagged', username='testUser',
+            tag='a', feeds_url=self.server.feeds_url)
+        self.assertEqual(mockserver.json.loads(feed)[0]['u'],
+            'http://example.net/')
+
+
+class TestCassette(MockAPITester):
+
+    def setUp(self):
+        MockAPITester.setUp(self)
+        fd, self.filename = tempfile.mkstemp(suffix='.cassette.gz')
+        os.close(fd)
+
+    def tearDown(self):
+        MockAPITester.tearDown(self)
+        os.remove(self.filename)
+
+    def replay_api(self, tape, mode='replay'):
+        return pydelicious.DeliciousAPI('testUser', 'testPwd',
+            api_url=self.server.api_url,
+            waiter=pydelicious._AdaptiveWaiter(0, min_wait=.01),
+            build_opener=lambda user, passwd: tape.api_opener(user, passwd,
+                self.host, mode=mode, pool=self.pool))
+
+    def test_record_replay(self):
+        tape = cassette.Cassette(self.filename)
+        api = self.replay_api(tape, 'record')
+        recent = api.posts_recent()
+        api.posts_add('http://example.net/', 'Net', tags='a b')
+        self.server.retry_after = 0
+        self.server.throttle_next(1)
+        post = api.posts_get(url='http://example.net/')
+        feed_url = self.server.feeds_url + 'json/testUser/a'
+        feed = pydelicious.dlcs_feed(feed_url, opener=tape.opener('record'))
+        tape.save()
+        self.assertEqual(len(tape), 5)
+        self.assert_('testPwd' not in gzip.open(self.filename).read())
+        self.server.stop()
+
+        tape = cassette.Cassette(self.filename).load()
+        api = self.replay_api(tape)
+        self.assertEqual(api.posts_recent(), recent)
+        api.posts_add('http://example.net/', 'Net', tags='a b')
+        self.assertEqual(api.posts_get(url='http://example.net/'), post)
+        self.assertEqual(api.stats.throttled, 1)
+        self.assertEqual(api.posts_get(url='http://example.net/'), post)
+        self.assertEqual(pydelicious.dlcs_feed(feed_url,
+            opener=tape.opener()), feed)
+        self.assertRaises(pydelicious.PyDeliciousException,
+            api.posts_get, url='http://example.org/0')
+
+    def test_timing(self):
+        tape = cassette.Cassette()
+        tape.add({'method': 'GET', 'url': 'http://example.org/', 'status': 200,
+            'reason': 'OK', 'headers': [], 'body': 'ok', 'elapsed': .05})
+        started = time.time()
+        self.assertEqual(tape.opener(timing=1).open('http://example.org/'
+            ).read(), 'ok')
+        self.assert_(time.time() - started >= .05)
+
+
+class TestLoadgen(MockAPITester):
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(loadgen.percentile(values, 50), 50)
+        self.assertEqual(loadgen.percentile(values, 99), 99)
+        self.assertEqual(loadgen.percentile([.1], 95), .1)
+        self.assertEqual(loadgen.percentile([], 50), None)
+
+    def test_run(self):
+        users = []
+        for n in range(3):
+            self.server.add_user('load%i' % n, 'pwd',
+                mockserver.synthetic_posts(20, n))
+            users.append(('load%i' % n, 'pwd'))
+        report = loadgen.run(self.server.api_url, clients=3, operations=4,
+            users=users, mix=loadgen.parse_mix('sync=1,add=1,feeds=1'),
+            batch=2)
+        self.assertEqual(sum(report['operations'].values()), 12)
+        self.assertEqual(report['failed'], {})
+        self.assertEqual(report['requests'],
+            sum([p['requests'] for p in report['paths'].values()]))
+        self.assertEqual(report['requests'], sum(self.server.stats.values()))
+        self.assertEqual(report['paths']['posts/add']['requests'],
+            2 * report['operations']['add'])
+        for stats in report['paths'].values():
+            self.assert_(stats['p50'] <= stats['p95'] <= stats['p99'])
+        self.assert_('p99 ms' in loadgen.format_report(report))
+        self.assertRaises(ValueError, loadgen.parse_mix, 'foo=1')
+
+
+class TestClientStats(MockAPITester):
+
+    def test_stats(self):
+        self.api.waiter = pydelicious._AdaptiveWaiter(.01, min_wait=.01)
+        self.api.stats.reset()
+        for i in range(3):
+            self.api.posts_get(url='http://example.org/%i' % i)
+        stats = self.api.stats
+        self.assertEqual(stats.requests, 3)
+        self.assertEqual(stats.errors, 0)
+        self.assert_(stats.bytes > 0)
+        self.assert_(stats.wait_time > 0)
+        self.assertAlmostEqual(stats.wait_time, self.api.waiter.slept)
+        self.assert_(stats.network_time > 0)
+        self.assert_(stats.parse_time > 0)
+        totals = stats.reset()
+        self.assertEqual(totals['requests'], 3)
+        self.assertEqual(stats.requests, 0)
+        self.assertEqual(stats.wait_time, 0)
+
+
+class TestIsoTime(PyDeliciousTester):
+
+    def test_parse(self):
+        iso = pydelicious.ISO_8601_DATETIME
+        for value in ('2008-11-28T02:35:51Z', '1970-01-01T00:00:00Z',
+                '2000-02-29T23:59:59Z'):
+            self.assertEqual(pydelicious.iso_time_tuple(value),
+                time.strptime(value, iso))
+            self.assertEqual(pydelicious.iso_timestamp(value),
+                calendar.timegm(time.strptime(value, iso)))
+        for value in ('2010-02-30T00:00:00Z', '2010-01-01T25:00:00Z', 'x'):
+            self.assertRaises(ValueError, pydelicious.iso_timestamp, value)
+        self.assertEqual(pydelicious.delicious_datetime('2008-11-28T02:35:51Z'),
+            datetime.datetime(2008, 11, 28, 2, 35, 51))
+
+    def test_bulk(self):
+        posts = [{'time': '1970-01-01T00:01:00Z'}, {},
+            {'time': '2008-11-28T02:35:51Z'}]
+        self.assertEqual(pydelicious.post_timestamps(posts),
+            [60, 0, 1227839751])
+
+
+class TestClientPool(PyDeliciousTester):
+
+    def test_lru(self):
+        pool = pydelicious.DeliciousClientPool(maxsize=2,
+                api_request=api_request_dummy)
+        a = pool.get('a', 'pwd')
+        self.assert_(pool.get('a', 'pwd') is a)
+        b = pool.get('b', 'pwd')
+        pool.get('a', 'pwd')
+        pool.get('c', 'pwd') # evicts b
+        self.assertEqual(len(pool), 2)
+        self.assert_(pool.get('a', 'pwd') is a)
+        self.failIf(pool.get('b', 'pwd') is b)
+        self.assertEqual(pool.get('a', 'other').user, 'a')
+
+    def test_shared_state(self):
+        pool = pydelicious.DeliciousClientPool(maxsize=1)
+        a = pool.get('a', 'pwd')
+        a.waiter() # delays the next call
+        pool.get('b', 'pwd') # evicts a
+        self.assert_(pool.get('a', 'pwd').waiter is a.waiter)
+        handlers = [h for h in a._opener.handlers
+                if isinstance(h, pydelicious.PooledHTTPSHandler)]
+        self.assert_(handlers[0].pool is pool.connection_pool)
+        self.assertRaises(TypeError, pydelicious.DeliciousClientPool,
+            waiter=pydelicious._AdaptiveWaiter(0))
+
+
+class TestBulk(PyDeliciousTester):
+
+    def setUp(self):
+        def parser(data):
+            url = data[0]
+            if 'exists' in url:
+                return {'result': (False, 'item already exists')}
+            return {'result': (True, 'done')}
+        self.api = pydelicious.DeliciousAPI('testUser', 'testPwd',
+            api_request=api_request_dummy, xml_parser=parser)
+
+    def posts(self):
+        for i in range(20):
+            yield {'url': 'http://%s.example/%i' % (['new', 'exists'][i%4==0],
+                i), 'description': 'post %i' % i}
+
+    def test_posts_add_many(self):
+        for workers in 1, 4:
+            rs = self.api.posts_add_many(self.posts(), workers=workers)
+            self.assertEqual((rs.done, len(rs.failed)), (15, 5))
+            item, error = rs.failed[0]
+            self.assert_(isinstance(error,
+                pydelicious.DeliciousItemExistsError))
+            self.assert_(rs.rate > 0)
+
+    def test_posts_delete_many(self):
+        urls = (p['url'] for p in self.posts())
+        rs = self.api.posts_delete_many(urls)
+        self.assertEqual(rs.count, 20)
+
+    def test_fatal(self):
+        def unauthorized(item):
+            raise pydelicious.PyDeliciousUnauthorized
+        for workers in 1, 4:
+            self.assertRaises(pydelicious.PyDeliciousUnauthorized,
+                pydelicious.dlcs_bulk, unauthorized, range(100), workers)
+
+
 class TestGetrss(PyDeliciousTester):
 
     "test old RSS feed parsing"
@@ -142,6 +650,27 @@ class TestFeeds(PyDeliciousTester):
         else:
             self.assert_( f('', format='rss').startswith('<?xml version="1.0" encoding="UTF-8"?>') )
 
+    def test_url_templates(self):
+        t = pydelicious.get_feed_template(
+            pydelicious.delicious_v2_feeds['user_tagged_private'])
+        self.assert_(t is pydelicious.get_feed_template(t.template))
+        self.assertEqual(t.required, frozenset(['format', 'username', 'tag',
+            'key']))
+        self.assertEqual(t(format='rss', username='a b', tag='c/d', key='k',
+            count=15), pydelicious.DLCS_FEEDS + 'rss/a+b/c%2Fd?private=k')
+        self.assertRaises(KeyError, t, format='rss')
+        other = pydelicious.get_feed_template(t.template, 'http://x/v2/')
+        self.assert_(other is not t)
+        self.assert_(other is pydelicious.get_feed_template(t.template,
+            'http://x/v2/'))
+        self.assertEqual(other(format='rss', username='a', tag='b', key='k'),
+            'http://x/v2/rss/a/b?private=k')
+        api_url = pydelicious.get_api_url('https://host/v1', 'posts/get')
+        params = {'url': 'http://x/?a=1&b', 'tag': 'a b'}
+        self.assertEqual(api_url(params),
+            'https://host/v1/posts/get?' + urllib.urlencode(params))
+        self.assertEqual(api_url(), 'https://host/v1/posts/get')
+
 #        print f('', format='json')
 #        print f('recent')
 #        print f('recent', format='rss')
@@ -190,6 +719,83 @@ class DeliciousApiUnitTest(PyDeliciousTester):
         self.assert_('bar=%C3%A4' in urllib.urlencode(params))
         self.assert_('baz=%C2%A4' in urllib.urlencode(params))
 
+    def test_param_schema(self):
+        params = {'url': u'http://example.org/\xe4', 'description': 'Caf\xe9',
+            'tags': ['a', 'b'], 'replace': False, 'shared': True, 'dt': '',
+            'extended': None}
+        orig = dict(params)
+        encoded = pydelicious.dlcs_encode_params(params, 'latin-1',
+            path='posts/add')
+        self.assertEqual(params, orig)
+        self.assertEqual(encoded, {'url': 'http://example.org/\xc3\xa4',
+            'description': 'Caf\xc3\xa9', 'tags': 'a b', 'replace': 'no',
+            'shared': 'yes'})
+        # unknown paths and parameters are converted by value
+        self.assertEqual(pydelicious.dlcs_encode_params({'count': 0,
+            'x': ['y']}, 'utf-8', path='no/such/path'),
+            {'count': '0', 'x': 'y'})
+
+    def test_param_types(self):
+        encode = pydelicious.dlcs_encode_params
+        self.assertEqual(encode({'tags': " a  b\n\tc ", 'replace': 'YES',
+            'shared': 'no'}, 'utf-8', path='posts/add'),
+            {'tags': 'a b c', 'replace': 'yes', 'shared': 'no'})
+        # as given on the dlcs command line
+        for value, expected in (('1', 'yes'), ('0', 'no'), ('True', 'yes'),
+                ('false', 'no'), (1, 'yes'), (0, 'no')):
+            self.assertEqual(encode({'replace': value}, 'utf-8',
+                path='posts/add'), {'replace': expected})
+        self.assertEqual(encode({'tags': ('a', ' b ')}, 'utf-8',
+            path='posts/add'), {'tags': 'a b'})
+        self.assertEqual(encode({'count': 10, 'tag': ''}, 'utf-8',
+            path='posts/recent'), {'count': '10'})
+        self.assertEqual(encode({'results': '', 'start': '5'}, 'utf-8',
+            path='posts/all'), {'start': '5'})
+        for path, params in (('posts/recent', {'count': 'abc'}),
+                ('posts/recent', {'count': -1}),
+                ('posts/recent', {'count': True}),
+                ('posts/add', {'shared': 'maybe'}),
+                ('posts/add', {'replace': 2}),
+                ('posts/add', {'replace': 'y'}),
+                ('posts/add', {'tags': 3})):
+            self.assertRaises(ValueError, encode, params, 'utf-8', path=path)
+
+    def test_api_request_keywords(self):
+        calls = []
+        def api_request(path, params, user='', passwd='', opener=None,
+                timeout=None):
+            calls.append(timeout)
+        a = pydelicious.DeliciousAPI('testUser', 'testPwd', 'utf-8',
+            api_request=api_request, xml_parser=parser_dummy,
+            timeout=pydelicious.Timeout(connect=1, read=2))
+        a.request('posts/update')
+        a.request_raw('posts/update')
+        self.assertEqual([t.read for t in calls], [2, 2])
+
+    def test_old_style_encoder(self):
+        calls = []
+        def old_encoder(params, codec, encoded=False):
+            calls.append(params)
+            return {'url': params['url'].upper()}
+        class Encoder:
+            def __call__(self, params, codec, **kwds):
+                calls.append(kwds)
+                return {}
+        a = pydelicious.DeliciousAPI('testUser', 'testPwd', 'utf-8',
+            api_request=api_request_dummy, xml_parser=parser_dummy,
+            encode_params=old_encoder)
+        self.assertEqual(a.request('posts/delete', url='x')['not-parsed'][0],
+            pydelicious.DLCS_API + '/posts/delete?url=X')
+        self.assertEqual(a.request_raw('posts/delete', url='y')[0],
+            pydelicious.DLCS_API + '/posts/delete?url=Y')
+        self.assertEqual(calls, [{'url': 'x'}, {'url': 'y'}])
+        a = pydelicious.DeliciousAPI('testUser', 'testPwd', 'utf-8',
+            api_request=api_request_dummy, xml_parser=parser_dummy,
+            encode_params=Encoder())
+        a.request('posts/delete', url='x')
+        self.assertEqual(calls[-1], {'encoded': False,
+            'path': 'posts/delete'})
+
     def test_fetch_vs_methods(self):
         a = self.api_utf8
 
@@ -241,13 +847,13 @@ class DeliciousErrorTest(PyDeliciousTester):
             );
 
 
-__testcases__ = (TestGetrss, TestBug, TestFeeds, DeliciousApiUnitTest, DeliciousErrorTest)#TestWaiter, )
+__testcases__ = (TestAdaptiveWaiter, TestRetryPolicy, TestTimeout,
+        TestMockServer, TestCassette, TestLoadgen, TestMetrics, TestClientStats, TestIsoTime,
+        TestThreadSafety, TestClientPool, TestBulk, TestGetrss, TestBug, TestFeeds, DeliciousApiUnitTest, DeliciousErrorTest)#TestWaiter, )
 
 if __name__ == '__main__':
     if len(sys.argv)>1 and sys.argv[1] == 'refresh_test_data':
-        for url, fn in test_data.items():
-            if os.path.exists(fn):
-                fetch_file(url, fn)
+        test_data.refresh()
 
     else:
         unittest.main()
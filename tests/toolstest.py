@@ -0,0 +1,713 @@
+# encoding: utf-8
+"""Unittests for the modules in tools/.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from StringIO import StringIO
+from ConfigParser import ConfigParser
+
+import pydelicious
+try:
+    from pydelicious.tools import bookmarks, localstore, dlcs, dlcsd, \
+        writequeue, sharedstore
+except ImportError:
+    from tools import bookmarks, localstore, dlcs, dlcsd, writequeue, \
+        sharedstore
+
+
+POSTS_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<posts user="testUser" update="2010-11-21T13:58:04Z">
+  <post href="http://example.org/" description="Example &amp; co"
+    extended="Some notes" tag="example test" time="2010-11-20T10:00:00Z"
+    hash="2e1ab59c2a0fdc8e0bb5b02a1c2b9d2a" />
+  <post href="http://example.org/caf%C3%A9" description="Caf\xc3\xa9 \xe2\x98\x85"
+    tag="food" time="2009-01-01T00:00:00Z" shared="no" />
+</posts>
+"""
+
+TAGS_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<tags>
+  <tag count="1" tag="example" />
+  <tag count="1" tag="food" />
+  <tag count="1" tag="test" />
+</tags>
+"""
+
+
+class BookmarksTest(unittest.TestCase):
+
+    def posts(self):
+        return list(bookmarks.read_posts_xml(StringIO(POSTS_XML)))
+
+    def roundtrip(self, format, posts):
+        fl = StringIO()
+        bookmarks.write_posts(posts, fl, format)
+        fl.seek(0)
+        return list(bookmarks.read_posts(fl, format))
+
+    def test_read_xml(self):
+        posts = self.posts()
+        self.assertEqual(len(posts), 2)
+        self.assertEqual(posts[0]['description'], 'Example & co')
+        self.assertEqual(posts[1]['description'], u'Caf\xe9 ★')
+
+    def test_roundtrip(self):
+        posts = self.posts()
+        for format in 'xml', 'jsonl', 'csv':
+            self.assertEqual(self.roundtrip(format, posts), posts)
+        keys = ('href', 'description', 'extended', 'tag', 'time', 'shared')
+        for orig, html in zip(posts, self.roundtrip('html', posts)):
+            for key in keys:
+                self.assertEqual(orig.get(key), html.get(key))
+
+    def test_html_chunks(self):
+        fl = StringIO()
+        bookmarks.write_netscape_html(self.posts() * 50, fl)
+        fl.seek(0)
+        chunk_size = bookmarks.CHUNK_SIZE
+        bookmarks.CHUNK_SIZE = 7 # split tags and UTF-8 sequences
+        try:
+            posts = list(bookmarks.read_netscape_html(fl))
+        finally:
+            bookmarks.CHUNK_SIZE = chunk_size
+        self.assertEqual(len(posts), 100)
+        self.assertEqual(posts[-1]['description'], u'Caf\xe9 ★')
+        self.assertEqual(posts[0]['extended'], 'Some notes')
+
+    def test_params(self):
+        post = self.posts()[1]
+        params = bookmarks.post_to_params(post)
+        self.assertEqual(params['description'], 'Caf\xc3\xa9 \xe2\x98\x85')
+        self.assertEqual(params['shared'], 'no')
+        self.failIf('extended' in params)
+        back = bookmarks.params_to_post(params)
+        for key in 'href', 'description', 'tag', 'time', 'shared':
+            self.assertEqual(back[key], bookmarks._encode(post[key]))
+
+    def test_import(self):
+        added = []
+        api = pydelicious.DeliciousAPI('testUser', 'testPwd', 'utf-8',
+            api_request=lambda path, params, **kwds: added.append(params),
+            xml_parser=lambda fl: {'result': (True, 'done')})
+        rs = bookmarks.import_posts(api, iter(self.posts()))
+        self.assertEqual(rs.done, 2)
+        self.assertEqual(added[1]['description'], 'Caf\xc3\xa9 \xe2\x98\x85')
+
+    def test_diff(self):
+        old = self.posts()
+        new = self.roundtrip('jsonl', old)
+        new[0]['tag'] = 'test example'
+        new[1]['tag'] = 'food cafe'
+        new[1]['shared'] = 'yes'
+        del new[0]['extended']
+        new.append({'href': 'http://example.org/new'})
+        diff = list(bookmarks.diff_posts(bookmarks.sorted_posts(old[1:]),
+            bookmarks.sorted_posts(new)))
+        self.assertEqual([(change, changed)
+            for change, was, now, changed in diff], [('changed', ['tag',
+            'shared']), ('added', []), ('added', [])])
+        self.assertEqual(diff[2][2]['href'], 'http://example.org/new')
+        diff = list(bookmarks.diff_posts(bookmarks.sorted_posts(new),
+            bookmarks.sorted_posts(old)))
+        self.assertEqual([change for change, was, now, changed in diff],
+            ['changed', 'changed', 'removed'])
+        self.assertEqual(diff[1][3], ['extended'])
+        new[0]['meta'] = old[0]['meta'] = 'unchanged'
+        self.assertEqual(len(list(bookmarks.diff_posts(
+            bookmarks.sorted_posts(new), bookmarks.sorted_posts(old)))), 2)
+        unsorted = sorted(new, key=bookmarks.post_hash, reverse=True)
+        self.assertRaises(ValueError, list,
+            bookmarks.diff_posts(unsorted, []))
+
+    def test_sorted_posts(self):
+        posts = [{'href': 'http://example.org/%i' % i,
+            'time': '2010-01-%02iT00:00:00Z' % (i * 7 % 28 + 1)}
+            for i in range(300)]
+        width = bookmarks.MERGE_WIDTH
+        bookmarks.MERGE_WIDTH = 4
+        try:
+            for key, reverse in ('time', False), ('time', True), ('url', True):
+                expected = sorted(posts, key=bookmarks.SORT_KEYS[key],
+                    reverse=reverse)
+                # spill every 10 posts, and merge spill files on the way
+                result = list(bookmarks.sorted_posts(iter(posts), key,
+                    reverse, max_memory=bookmarks.POST_OVERHEAD * 10))
+                self.assertEqual(result, expected)
+        finally:
+            bookmarks.MERGE_WIDTH = width
+        self.assertEqual(list(bookmarks.sorted_posts(posts[:5], 'url')),
+            posts[:5])
+
+
+    def test_sorted_posts_io(self):
+        posts = [{'href': 'http://example.org/%i' % i} for i in range(1000)]
+        written = [0]
+        spill = bookmarks._spill
+        def counting_spill(entries, tmpdir):
+            entries = list(entries)
+            written[0] += len(entries)
+            return spill(entries, tmpdir)
+        width = bookmarks.MERGE_WIDTH
+        bookmarks.MERGE_WIDTH, bookmarks._spill = 4, counting_spill
+        try:
+            # 100 spills: every post is written once per merge level
+            result = list(bookmarks.sorted_posts(iter(posts), 'url',
+                max_memory=bookmarks.POST_OVERHEAD * 10))
+        finally:
+            bookmarks.MERGE_WIDTH, bookmarks._spill = width, spill
+        self.assertEqual(result, sorted(posts, key=bookmarks.SORT_KEYS['url']))
+        self.assert_(written[0] <= len(posts) * 5, written[0])
+
+    def test_fetch_posts(self):
+        pages = []
+        xml = POSTS_XML.replace('<post href="http://example.org/caf',
+            '<post href="http://example.org/more" />\n<post href="http://example.org/caf')
+        class API:
+            def posts_all(self, tag, start, results, _raw):
+                pages.append(start)
+                posts = list(bookmarks.read_posts_xml(StringIO(xml)))
+                fl = StringIO()
+                bookmarks.write_posts_xml(posts[start:start + results], fl)
+                fl.seek(0)
+                return fl
+        posts = list(bookmarks.fetch_posts(API(), page_size=2))
+        self.assertEqual(len(posts), 3)
+        self.assertEqual(pages, [0, 2])
+
+
+class LocalStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.posts_file = os.path.join(self.dir, 'posts.xml')
+        self.tags_file = os.path.join(self.dir, 'tags.xml')
+        open(self.posts_file, 'w').write(POSTS_XML)
+        open(self.tags_file, 'w').write(TAGS_XML)
+        self.store = localstore.LocalStore(self.posts_file, self.tags_file)
+        self.api = pydelicious.DeliciousAPI('testUser', 'testPwd', 'utf-8',
+            api_request=lambda path, params, **kwds: None,
+            xml_parser=lambda fl: {'result': (True, 'done')},
+            store=self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def reload(self):
+        self.store.save()
+        return localstore.LocalStore(self.posts_file, self.tags_file)
+
+    def test_write_through(self):
+        self.api.posts_add('http://example.net/', 'Net', tags='test new')
+        self.api.tags_rename('test', 'testing example')
+        self.api.posts_delete('http://example.org/caf%C3%A9')
+        store = self.reload()
+        store.load()
+        self.assertEqual(store.posts.keys(),
+            ['http://example.org/', 'http://example.net/'])
+        self.assertEqual(store.posts['http://example.org/']['tag'],
+            'example testing')
+        self.assertEqual(store.posts['http://example.net/']['tag'],
+            'testing example new')
+        self.assertEqual(store.tags,
+            {'example': 2, 'testing': 2, 'new': 1})
+        self.assertEqual(len(store.get_tagged('testing')), 2)
+
+    def test_delete_tag(self):
+        self.api.tags_delete('example')
+        store = self.reload()
+        store.load()
+        self.assertEqual(store.posts['http://example.org/']['tag'], 'test')
+        self.failIf('example' in store.tags)
+        self.assertEqual(store.info['user'], 'testUser')
+
+    def test_plan_retag(self):
+        plan = self.store.plan_retag(remove=['example'])
+        self.assertEqual(plan, [('tags/delete', {'tag': 'example'})])
+        self.api.posts_add('http://example.net/', 'Net', tags='test new')
+        plan = self.store.plan_retag(remove=['test', 'food'],
+            urls=['http://example.org/', 'http://example.org/caf%C3%A9'])
+        self.assertEqual([path for path, params in plan],
+            ['tags/delete', 'posts/add'])
+        self.assertEqual(plan[1][1]['tags'], 'example')
+        # 'example' is on exactly this post, but is not renamed
+        plan = self.store.plan_retag(add=['more'],
+            urls=['http://example.org/'])
+        self.assertEqual(len(plan), 1)
+        self.assertEqual(plan[0][0], 'posts/add')
+        self.assertEqual(plan[0][1]['tags'], 'example test more')
+        for path, params in plan:
+            self.api.request(path, **params)
+        self.assertEqual(
+            sorted(self.store.posts['http://example.org/']['tag'].split()),
+            ['example', 'more', 'test'])
+
+    def test_no_request_no_load(self):
+        self.api.posts_get(url='http://example.org/')
+        self.failIf(self.store.loaded)
+
+    def test_threads(self):
+        self.store.autosave = True
+        errors = []
+        def add(n):
+            try:
+                for i in range(20):
+                    self.api.posts_add('http://example.net/%i/%i' % (n, i),
+                        'Net', tags='thread%i shared' % n)
+                    self.store.save()
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=add, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        store = localstore.LocalStore(self.posts_file, self.tags_file)
+        store.load()
+        self.assertEqual(len(store.posts), 82)
+        self.assertEqual(store.tags['shared'], 80)
+        self.assertEqual(store.tags['thread3'], 20)
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.posts_file = os.path.join(self.dir, 'posts.xml')
+        open(self.posts_file, 'w').write(POSTS_XML)
+        self.conf = ConfigParser()
+        self.conf.add_section('local-files')
+        self.conf.set('local-files', 'posts', self.posts_file)
+        self.conf.set('local-files', 'tags', os.path.join(self.dir, 'tags.xml'))
+        self.requests = []
+        self.api = pydelicious.DeliciousAPI('testUser', 'testPwd', 'utf-8',
+            api_request=lambda path, params, **kwds:
+                self.requests.append(path),
+            xml_parser=lambda fl: {'result': (True, 'done')},
+            store=localstore.LocalStore(self.posts_file))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_batch(self):
+        fn = os.path.join(self.dir, 'batch')
+        open(fn, 'w').write("# maintenance\n\ntagged food\n"
+            "tag 'new more' http://example.org/\ntagged new\n"
+            "bogus\ntagged 'unterminated\n")
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            result = dlcs.batch(self.conf, self.api, fn, keep_cache=True,
+                ignore_case=False)
+            output, status = sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        self.assertEqual(result, 1)
+        self.assertEqual(output.splitlines(), ['http://example.org/caf%C3%A9',
+            '* 1 request(s) to make',
+            '* tagged "http://example.org/" with "example test new more"',
+            'http://example.org/'])
+        self.assertEqual(self.requests, ['posts/add'])
+        lines = status.splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assert_(lines[0].startswith('3: ok '))
+        self.assert_(lines[3].startswith('6: FAILED (ValueError'))
+        self.assert_(lines[4].startswith('7: FAILED (ValueError'))
+        self.assertEqual(lines[5].split(' in ')[0], '5 command(s), 2 failed')
+        self.failIf(dlcs.CACHE_PARSED)
+
+    def test_import_keeps_codec(self):
+        fn = os.path.join(self.dir, 'import.jsonl')
+        open(fn, 'w').write('{"href": "http://example.net/caf\\u00e9", '
+            '"description": "Caf\\u00e9"}\n')
+        sent = []
+        api = pydelicious.DeliciousAPI('testUser', 'testPwd', 'latin-1',
+            api_request=lambda path, params, **kwds: sent.append(params),
+            xml_parser=lambda fl: {'result': (True, 'done')})
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            dlcs.importposts(self.conf, api, fn, replace=False)
+            dlcs.deleteposts(self.conf, api, 'http://example.net/caf\xe9')
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(api.codec, 'latin-1')
+        self.assertEqual(sent[0]['description'], 'Caf\xc3\xa9')
+        self.assertEqual(sent[1]['url'], 'http://example.net/caf\xc3\xa9')
+
+    def test_profile(self):
+        open(os.path.join(self.dir, 'tags.xml'), 'w').write(TAGS_XML)
+        config = os.path.join(self.dir, 'dlcs-rc')
+        self.conf.add_section('dlcs')
+        self.conf.set('dlcs', 'username', 'testUser')
+        self.conf.set('dlcs', 'password', 'testPwd')
+        self.conf.write(open(config, 'w'))
+        hooks = list(pydelicious.after_request_hooks)
+        clock = [0]
+        def tick():
+            clock[0] += 1
+            return clock[0]
+        reports = []
+        stdout, stderr, now = sys.stdout, sys.stderr, time.time
+        time.time = tick
+        try:
+            for run in range(2):
+                sys.stdout, sys.stderr = StringIO(), StringIO()
+                dlcs.main(['--no-daemon', '-c', config, '-C', '--profile',
+                    'tags'])
+                reports.append(sys.stderr.getvalue())
+        finally:
+            sys.stdout, sys.stderr, time.time = stdout, stderr, now
+        self.assertEqual(pydelicious.after_request_hooks, hooks)
+        phases = [line[:15].strip() for line in reports[0].splitlines()[1:-2]]
+        self.assertEqual(phases, ['config', 'command', 'cache read', 'parse',
+            'output'])
+        # each run reports its own phases only
+        self.assertEqual(reports[1], reports[0])
+
+    def test_sort_limit(self):
+        open(os.path.join(self.dir, 'tags.xml'), 'w').write(
+            TAGS_XML.replace('count="1" tag="food"', 'count="3" tag="food"'))
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            for cmd, args, opts in ((dlcs.tagged, ('example', 'food'),
+                    {'sort': 'time', 'limit': 1}),
+                    (dlcs.tagged, ('example', 'food'), {'sort': '-time'}),
+                    (dlcs.findposts, ('example',), {'sort': 'url',
+                        'limit': 0}),
+                    (dlcs.tags, (), {'sort': '-count', 'limit': 2}),
+                    (dlcs.tags, ('<3',), {'limit': 1})):
+                cmd(self.conf, self.api, keep_cache=True, ignore_case=False,
+                    *args, **opts)
+                print
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(output.splitlines(), ['http://example.org/caf%C3%A9',
+            '', 'http://example.org/', 'http://example.org/caf%C3%A9', '',
+            '', 'food example', 'example'])
+        self.assertRaises(ValueError, dlcs.tags, self.conf, self.api,
+            keep_cache=True, sort='time')
+        self.assertEqual(dlcs.value_sorted({'a': 1, 'b': 3, 'c': 2}, 2),
+            [('b', 3), ('c', 2)])
+        parser, opts, args = dlcs.parse_argv_split(dlcs.__options__,
+            ['--limit', '0', 'tags'])
+        self.assertEqual((opts['limit'], opts['sort']), (0, None))
+        stderr = sys.stderr
+        for argv, error in ((['--sort', 'bogus', 'posts'], 'Unknown sort'),
+                (['--sort', '-time', 'tags'], 'Unknown sort'),
+                (['--limit', '-1', 'tags'], '--limit must be')):
+            sys.stderr = StringIO()
+            try:
+                self.assertRaises(SystemExit, dlcs.main,
+                    ['--no-daemon'] + argv)
+                status = sys.stderr.getvalue()
+            finally:
+                sys.stderr = stderr
+            self.assert_(('error: ' + error) in status, status)
+
+
+class FlushAPI:
+
+    "Records the calls made, raising the exceptions in ``errors`` by path."
+
+    def __init__(self, **errors):
+        self.calls = []
+        self.errors = errors
+
+    def request(self, path, **params):
+        errors = self.errors.get(path.replace('/', '_'))
+        if errors:
+            raise errors.pop(0)
+        self.calls.append((path, params))
+
+
+class WriteQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.posts_file = os.path.join(self.dir, 'posts.xml')
+        open(self.posts_file, 'w').write(POSTS_XML)
+        self.store = localstore.LocalStore(self.posts_file)
+        self.queue = writequeue.WriteQueue(os.path.join(self.dir, 'queue'))
+        self.reads = []
+        self.api = pydelicious.DeliciousAPI('testUser', 'testPwd', 'utf-8',
+            api_request=writequeue.queued_api_request(self.queue,
+                lambda path, params, **kwds: self.reads.append(path) or
+                    StringIO('<update time="2010-11-21T13:58:04Z" />')),
+            store=self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def queue_changes(self):
+        self.api.posts_add('http://example.net/', 'Net', tags='new')
+        self.api.tags_rename('test', 'testing')
+        self.api.posts_add('http://example.net/', 'Net', tags='newer')
+        self.api.posts_delete('http://example.org/')
+        self.api.posts_add('http://example.org/', 'Back', tags='again')
+
+    def test_queue(self):
+        self.queue_changes()
+        self.api.posts_update()
+        self.assertEqual(self.reads, ['posts/update'])
+        self.assertEqual(len(self.queue), 5)
+        self.assertEqual(self.store.posts['http://example.net/']['tag'],
+            'newer')
+        self.assertEqual(self.store.posts['http://example.org/']['tag'],
+            'again')
+        calls = writequeue.coalesce(self.queue.entries())
+        self.assertEqual([(i, path) for i, path, params in calls],
+            [(1, 'tags/rename'), (2, 'posts/add'), (4, 'posts/add')])
+        self.assertEqual([params['replace'] for i, path, params in calls[1:]],
+            ['yes', 'yes'])
+
+    def test_flush(self):
+        self.queue_changes()
+        api = FlushAPI(posts_add=[pydelicious.PyDeliciousThrottled(),
+            pydelicious.DeliciousError('refused')])
+        result = self.queue.flush(api, batch=3)
+        self.assertEqual(str(result),
+            "2 sent, 2 coalesced, 1 failed, 0 remaining")
+        self.assertEqual([path for path, params in api.calls],
+            ['tags/rename', 'posts/add'])
+        self.assertEqual(api.calls[1][1]['tags'], 'again')
+        self.assertEqual(len(writequeue.WriteQueue(
+            self.queue.failed_file).entries()), 1)
+
+    def test_flush_stopped(self):
+        self.queue_changes()
+        api = FlushAPI(posts_add=[pydelicious.PyDeliciousThrottled()] * 2)
+        result = self.queue.flush(api, tries=2)
+        self.assertEqual(str(result),
+            "1 sent, 1 coalesced, 0 failed, 3 remaining")
+        self.assert_(isinstance(result.error, pydelicious.PyDeliciousThrottled))
+        entries = self.queue.entries()
+        self.assertEqual(entries[0]['params']['replace'], 'yes')
+        result = self.queue.flush(api)
+        self.assertEqual(str(result),
+            "2 sent, 1 coalesced, 0 failed, 0 remaining")
+
+    def test_kept_result(self):
+        # the same URL twice without replace, as `dlcs --queue post` does
+        for tags in 'first', 'second':
+            self.api.posts_add('http://example.net/', 'Net', tags=tags,
+                replace=False)
+        self.queue.append('posts/add', {'url': 'http://example.net/',
+            'description': 'Net', 'tags': 'second', 'replace': 'no'})
+        conf = ConfigParser()
+        conf.add_section('local-files')
+        conf.set('local-files', 'posts', self.posts_file)
+        conf.set('local-files', 'tags', os.path.join(self.dir, 'tags.xml'))
+        conf.set('local-files', 'queue', self.queue.filename)
+        self.store.save()
+        # in the background
+        api = FlushAPI(posts_add=[pydelicious.DeliciousItemExistsError(
+            'item already exists')])
+        api.store = None
+        result = dlcs.flush_queue(conf, api, keep_result=True)
+        self.assertEqual(len(result.failed), 1)
+        # the cache has the refused change, and is fetched again
+        self.failIf(os.path.exists(self.posts_file))
+        # `dlcs flush` reports it
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            dlcs.flush(conf, api)
+            output, status = sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        self.assertEqual(output,
+            "* 0 sent, 2 coalesced, 1 failed, 0 remaining\n")
+        self.assert_(status.startswith('* posts/add failed: item already'))
+        self.assertEqual(self.queue.pop_result(), None)
+
+    def test_keep_result(self):
+        self.queue_changes()
+        api = FlushAPI(posts_add=[pydelicious.DeliciousError('refused')])
+        self.queue.flush(api, batch=3, keep_result=True)
+        self.queue.append('posts/delete', {'url': 'http://example.net/'})
+        self.queue.flush(api, keep_result=True)
+        result = self.queue.pop_result()
+        self.assertEqual(str(result),
+            "3 sent, 2 coalesced, 1 failed, 0 remaining")
+        path, params, error = result.failed[0]
+        self.assertEqual((path, params['url'], params['tags'], error),
+            ('posts/add', 'http://example.net/', 'newer', 'refused'))
+        self.assertEqual(self.queue.pop_result(), None)
+
+    def test_torn_write(self):
+        self.api.posts_delete('http://example.org/')
+        open(self.queue.filename, 'a').write('{"path": "posts/del')
+        self.api.posts_delete('http://example.org/caf%C3%A9')
+        self.assertEqual([e['params']['url'] for e in self.queue.entries()],
+            ['http://example.org/', 'http://example.org/caf%C3%A9'])
+
+
+class SharedStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = sharedstore.SharedStore(os.path.join(self.dir, 'shared.db'))
+        self.posts = list(bookmarks.read_posts_xml(StringIO(POSTS_XML)))
+        example, cafe = self.posts
+        self.store.import_posts('alice', self.posts)
+        self.store.import_posts('bob', [dict(example, description='Example'),
+            {'href': 'http://example.org/new', 'description': 'New'}])
+        self.store.import_posts('carol', [dict(example, shared='no'),
+            dict(cafe, shared='yes')])
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def test_dedupe(self):
+        self.assertEqual(self.store.stats(),
+            {'users': 3, 'urls': 3, 'posts': 6})
+        self.assertEqual(self.store.connect().execute("SELECT COUNT(*) FROM "
+            "posts WHERE description IS NULL").fetchone()[0], 5)
+        for post in self.posts:
+            post['hash'] = bookmarks.post_hash(post)
+        self.assertEqual(list(self.store.posts('alice')), self.posts)
+        self.assertEqual(self.store.get_post('carol',
+            'http://example.org/caf%C3%A9')['description'], u'Caf\xe9 ★')
+        self.assertEqual(list(self.store.posts('bob'))[0]['description'],
+            'Example')
+        self.assertEqual(self.store.url_users('http://example.org/caf%C3%A9'),
+            ['carol'])
+        self.store.delete_user('bob')
+        self.assertEqual(self.store.stats(),
+            {'users': 2, 'urls': 2, 'posts': 4})
+
+    def test_mates(self):
+        mates = self.store.mates('alice')
+        self.assertEqual([(user, common, total)
+            for user, score, common, total in mates],
+            [('carol', 1, 2), ('bob', 1, 2)])
+        self.assertEqual(self.store.mates('alice', min_common=2), [])
+
+    def test_user_store(self):
+        api = pydelicious.DeliciousAPI('alice', 'testPwd', 'utf-8',
+            api_request=lambda path, params, **kwds: None,
+            xml_parser=lambda fl: {'result': (True, 'done')},
+            store=self.store.user('alice'))
+        api.tags_rename('test', 'testing more')
+        api.posts_delete('http://example.org/caf%C3%A9')
+        api.posts_add('http://example.org/new', 'New', tags='new')
+        posts = dict([(post['href'], post)
+            for post in self.store.posts('alice')])
+        self.assertEqual(sorted(posts), ['http://example.org/',
+            'http://example.org/new'])
+        self.assertEqual(posts['http://example.org/']['tag'],
+            'example testing more')
+        self.assertEqual(posts['http://example.org/new']['tag'], 'new')
+        self.assertEqual(self.store.url_users('http://example.org/new'),
+            ['alice', 'bob'])
+
+    def test_retag_wildcards(self):
+        alice = self.store.user('alice')
+        for i, tag in enumerate(['a_b', 'axb', '100%', '1000', 'c\\d']):
+            self.store.add_post('alice', {'href': 'http://example.com/%i' % i,
+                'tag': tag, 'time': '2010-01-01T00:00:00Z'})
+        self.assertEqual(alice.retag('a_b', ['ab']), 1)
+        self.assertEqual(alice.retag('100%', []), 1)
+        self.assertEqual(alice.retag('c\\d', ['cd']), 1)
+        self.assertEqual(sorted([post.get('tag') for post in
+            self.store.posts('alice') if 'example.com' in post['href']]),
+            [None, '1000', 'ab', 'axb', 'cd'])
+
+
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.conf_file = os.path.join(self.dir, 'dlcs-rc')
+        self.socket = os.path.join(self.dir, 'socket')
+        open(self.conf_file, 'w').write("[dlcs]\nusername = testUser\n"
+            "password = testPwd\n\n[local-files]\nposts = %s\ntags = %s\n" % (
+            os.path.join(self.dir, 'posts.xml'),
+            os.path.join(self.dir, 'tags.xml')))
+        open(os.path.join(self.dir, 'posts.xml'), 'w').write(POSTS_XML)
+        open(os.path.join(self.dir, 'tags.xml'), 'w').write(TAGS_XML)
+        self.daemon = dlcsd.DlcsDaemon(self.socket, ['-c', self.conf_file])
+        self.thread = threading.Thread(target=self.daemon.serve)
+        self.thread.start()
+
+    def tearDown(self):
+        dlcsd.send({'action': 'stop'}, self.socket)
+        self.thread.join()
+        dlcs.CACHE_PARSED = False
+        dlcs.UPDATE_INTERVAL = 0
+        shutil.rmtree(self.dir)
+
+    def forward(self, *argv):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            forwarded, result = dlcsd.forward(['-C', '-c', self.conf_file] +
+                list(argv), self.conf_file, 'utf-8', self.socket)
+            return forwarded, sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_forward(self):
+        self.assertEqual(self.forward('tagged', 'food'),
+            (True, 'http://example.org/caf%C3%A9\n'))
+        self.assertEqual(self.forward('tagged', 'test')[1],
+            'http://example.org/\n')
+        self.assert_(self.daemon.client.store.loaded)
+        self.assertEqual(dlcsd.send({'action': 'status'}, self.socket)[
+            'commands'], 2)
+        # not for the daemon
+        self.assertEqual(self.forward('postit', 'http://example.org/'),
+            (False, ''))
+        self.assertEqual(self.forward('--no-daemon', 'tags'), (False, ''))
+        self.assertEqual(dlcsd.forward(['tags'], 'other-rc', 'utf-8',
+            self.socket), (False, None))
+
+    def test_terminal_files(self):
+        self.assertEqual(oct(os.stat(self.socket).st_mode & 0777), '0600')
+        for argv in (['exportposts'], ['exportposts', '-', 'jsonl'],
+                ['importposts', '-'], ['batch']):
+            self.assertEqual(self.forward(*argv), (False, ''))
+        fn = os.path.join(self.dir, 'export.jsonl')
+        self.assertEqual(self.forward('exportposts', fn)[0], True)
+        self.assertEqual(len(open(fn).readlines()), 2)
+
+    def test_export_stdout(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            dlcs.exportposts(self.daemon.conf, self.daemon.client, '-',
+                'jsonl', keep_cache=True, fetch=False, sort=None)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(len(output.splitlines()), 2)
+
+    def test_cache_reload(self):
+        self.forward('tagged', 'food')
+        open(os.path.join(self.dir, 'posts.xml'), 'w').write(
+            POSTS_XML.replace('food', 'eat'))
+        os.utime(os.path.join(self.dir, 'posts.xml'), (0, 0))
+        self.assertEqual(self.forward('tagged', 'eat')[1],
+            'http://example.org/caf%C3%A9\n')
+        self.daemon.client.store.ensure_loaded()
+        self.assertEqual(self.daemon.client.store.find_tags(['eat']), ['eat'])
+
+    def test_no_daemon(self):
+        self.assertEqual(dlcsd.forward(['tags'], self.conf_file, 'utf-8',
+            os.path.join(self.dir, 'nosocket')), (False, None))
+
+
+__testcases__ = (BookmarksTest, LocalStoreTest, BatchTest, WriteQueueTest,
+        SharedStoreTest, DaemonTest)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,543 @@
+"""Import and export of bookmark collections.
+
+Reads and writes posts in these formats:
+
+- xml: the del.icio.us ``posts/all`` document
+- html: the Netscape bookmark file, as used by most browsers
+- jsonl: one JSON object per line
+- csv: a header row with the attribute names, then a row per post
+
+All readers and writers stream: readers are generators yielding one post
+at a time, writers consume any iterable of posts. Memory use does not depend
+on the size of the collection.
+
+Posts are dictionaries with the attributes of a ``<post/>`` element of the
+v1 API: href, description, extended, tag (space separated), time (ISO 8601),
+shared ('no' for private posts), hash and meta. Use `post_to_params` to get
+the arguments for ``DeliciousAPI.posts_add``, and `import_posts` to add a
+stream of posts to a collection::
+
+    posts = read_posts(open('bookmarks.html'), 'html')
+    print import_posts(api, posts)
+
+`fetch_posts` streams a collection from del.icio.us a page at a time, and
+`sorted_posts` sorts any stream with a fixed memory limit, using temporary
+files for the rest::
+
+    posts = sorted_posts(fetch_posts(api), 'time', reverse=True)
+    write_posts(posts, open('bookmarks.csv', 'w'), 'csv')
+
+`diff_posts` compares two snapshots of a collection, i.e. a cached
+``posts/all`` against a new one, by merging them on the hash attribute.
+"""
+import csv
+import time
+import heapq
+import codecs
+import tempfile
+from HTMLParser import HTMLParser
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+
+try:
+    # Python >= 2.5
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from pydelicious import ISO_8601_DATETIME, dlcs_encode_params, iso_timestamp
+
+
+CHUNK_SIZE = 64 * 1024
+"Bytes read at a time by the HTML reader"
+
+_attr_entities = {'\n': '&#10;', '\r': '&#13;', '\t': '&#9;'}
+
+POST_ATTRIBUTES = ('href', 'description', 'extended', 'tag', 'time',
+        'shared', 'hash', 'meta')
+
+
+### Conversion
+
+def post_to_params(post):
+    """Return the `posts_add` arguments for a post, as UTF-8 encoded
+    strings. Use with a ``DeliciousAPI`` with codec 'utf-8'.
+    """
+    params = {
+        'url': post['href'],
+        'description': post.get('description', ''),
+        'extended': post.get('extended', ''),
+        'tags': post.get('tag', ''),
+        'dt': post.get('time', ''),
+        'shared': post.get('shared', 'yes') != 'no',
+    }
+    for key, value in params.items():
+        if isinstance(value, unicode):
+            params[key] = value.encode('utf-8')
+    return dlcs_encode_params(params, 'utf-8', path='posts/add')
+
+def params_to_post(params):
+    """Return the post for a dictionary of `posts_add` arguments, the
+    reverse of `post_to_params`.
+    """
+    post = {'href': params['url'],
+            'hash': md5(_encode(params['url'])).hexdigest()}
+    for key, attr in (('description', 'description'), ('extended',
+            'extended'), ('tags', 'tag'), ('dt', 'time')):
+        value = params.get(key)
+        if isinstance(value, list):
+            value = " ".join(value)
+        if value:
+            post[attr] = value
+    shared = params.get('shared', True)
+    if shared is False or shared == 'no':
+        post['shared'] = 'no'
+    return post
+
+def post_hash(post):
+    "Return the hash attribute of a post, the MD5 digest of its URL."
+    return post.get('hash') or md5(_encode(post['href'])).hexdigest()
+
+def post_timestamp(post):
+    "Return the time of a post as seconds since the epoch, or 0."
+    if not post.get('time'):
+        return 0
+    return iso_timestamp(post['time'])
+
+def timestamp_to_time(timestamp):
+    "Return the ISO 8601 time for seconds since the epoch."
+    return time.strftime(ISO_8601_DATETIME, time.gmtime(int(timestamp)))
+
+
+### del.icio.us XML
+
+def read_posts_xml(fl):
+    """Yield the posts from a del.icio.us posts document (``posts/all``,
+    ``posts/get``, ``posts/recent``). Elements are discarded once read.
+    """
+    events = iterparse(fl, events=('start', 'end'))
+    root = None
+    for event, elem in events:
+        if event == 'start':
+            if root is None:
+                root = elem
+            continue
+        if elem.tag == 'post':
+            yield dict(elem.attrib)
+            root.clear()
+
+def write_posts_xml(posts, fl, user=''):
+    "Write posts as a del.icio.us posts document (UTF-8)."
+    fl.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    if user:
+        fl.write('<posts user=%s>\n' % _encode(quoteattr(user)))
+    else:
+        fl.write('<posts>\n')
+    for post in posts:
+        attrs = ['%s=%s' % (k, quoteattr(post[k], _attr_entities))
+                for k in POST_ATTRIBUTES if post.get(k)]
+        fl.write(_encode('  <post %s />\n' % " ".join(attrs)))
+    fl.write('</posts>\n')
+
+
+### Netscape bookmark file
+
+class NetscapeBookmarkParser(HTMLParser):
+
+    """Incremental parser for Netscape bookmark files. Feed it data and take
+    the parsed posts from `posts`.
+
+    ``TAGS`` (comma separated) and the enclosing folders are not mixed: only
+    ``TAGS`` become del.icio.us tags. Spaces within a tag become
+    underscores.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.posts = []
+        self.post = None
+        self.field = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            attrs = dict(attrs)
+            if not attrs.get('href'):
+                return
+            self.post = {'href': attrs['href'], 'description': ''}
+            self.post['hash'] = md5(_encode(attrs['href'])).hexdigest()
+            if attrs.get('tags'):
+                self.post['tag'] = " ".join([t.strip().replace(' ', '_')
+                    for t in attrs['tags'].split(',') if t.strip()])
+            if attrs.get('add_date', '').isdigit():
+                self.post['time'] = timestamp_to_time(attrs['add_date'])
+            if attrs.get('private') == '1':
+                self.post['shared'] = 'no'
+            self.posts.append(self.post)
+            self.field = 'description'
+        elif tag == 'dd' and self.post:
+            self.post['extended'] = ''
+            self.field = 'extended'
+        else:
+            self.field = None
+            if tag in ('dt', 'dl', 'h3'):
+                self.post = None
+
+    def handle_endtag(self, tag):
+        if tag == 'a':
+            self.field = None
+        elif tag == 'dl':
+            self.field = self.post = None
+
+    def handle_data(self, data):
+        if self.field:
+            self.post[self.field] += data
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape('&%s;' % name))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape('&#%s;' % name))
+
+    def pop(self, final=False):
+        """Return the posts completed so far. The last post may still get
+        (more) extended text, so it is kept unless ``final``.
+        """
+        if final:
+            posts, self.posts = self.posts, []
+        else:
+            posts, self.posts = self.posts[:-1], self.posts[-1:]
+        for post in posts:
+            for key in ('description', 'extended'):
+                if key in post:
+                    post[key] = post[key].strip()
+        return posts
+
+def read_netscape_html(fl, encoding='utf-8'):
+    "Yield the posts from a Netscape bookmark file."
+    parser = NetscapeBookmarkParser()
+    decoder = codecs.getincrementaldecoder(encoding)('replace')
+    while True:
+        data = fl.read(CHUNK_SIZE)
+        if not data:
+            break
+        if not isinstance(data, unicode):
+            data = decoder.decode(data)
+        parser.feed(data)
+        for post in parser.pop():
+            yield post
+    parser.close()
+    for post in parser.pop(final=True):
+        yield post
+
+def write_netscape_html(posts, fl):
+    "Write posts as a Netscape bookmark file (UTF-8)."
+    fl.write('<!DOCTYPE NETSCAPE-Bookmark-file-1>\n'
+        '<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">\n'
+        '<TITLE>Bookmarks</TITLE>\n<H1>Bookmarks</H1>\n<DL><p>\n')
+    for post in posts:
+        attrs = 'HREF=%s' % quoteattr(post['href'])
+        if post.get('time'):
+            attrs += ' ADD_DATE="%i"' % post_timestamp(post)
+        attrs += ' PRIVATE="%i"' % (post.get('shared') == 'no')
+        if post.get('tag'):
+            attrs += ' TAGS=%s' % quoteattr(",".join(post['tag'].split()))
+        fl.write(_encode('<DT><A %s>%s</A>\n' % (attrs,
+            escape(post.get('description', '')))))
+        if post.get('extended'):
+            fl.write(_encode('<DD>%s\n' % escape(post['extended'])))
+    fl.write('</DL><p>\n')
+
+
+### JSON lines
+
+def read_jsonl(fl):
+    "Yield the posts from a file with a JSON object per line."
+    for line in fl:
+        if line.strip():
+            yield json.loads(line)
+
+def write_jsonl(posts, fl):
+    "Write posts as JSON objects, one per line."
+    for post in posts:
+        fl.write(json.dumps(post, sort_keys=True) + '\n')
+
+
+### CSV
+
+def read_csv(fl):
+    "Yield the posts from a CSV file with a header row."
+    for row in csv.DictReader(fl):
+        yield dict([(key, value.decode('utf-8'))
+            for key, value in row.items() if key and value])
+
+def write_csv(posts, fl):
+    "Write posts as CSV (UTF-8), with a column per post attribute."
+    writer = csv.writer(fl)
+    writer.writerow(POST_ATTRIBUTES)
+    for post in posts:
+        writer.writerow([_encode(post.get(key, ''))
+            for key in POST_ATTRIBUTES])
+
+
+### Formats
+
+readers = {
+    'xml': read_posts_xml,
+    'html': read_netscape_html,
+    'jsonl': read_jsonl,
+    'csv': read_csv,
+}
+
+writers = {
+    'xml': write_posts_xml,
+    'html': write_netscape_html,
+    'jsonl': write_jsonl,
+    'csv': write_csv,
+}
+
+extensions = {
+    '.xml': 'xml',
+    '.html': 'html',
+    '.htm': 'html',
+    '.jsonl': 'jsonl',
+    '.json': 'jsonl',
+    '.csv': 'csv',
+}
+
+def guess_format(filename, default='xml'):
+    "Return the format name for a filename by its extension."
+    for ext, format in extensions.items():
+        if filename.lower().endswith(ext):
+            return format
+    return default
+
+def read_posts(fl, format='xml'):
+    "Yield the posts from a file in ``format``."
+    return readers[format](fl)
+
+def write_posts(posts, fl, format='xml'):
+    "Write posts to a file in ``format``."
+    return writers[format](posts, fl)
+
+def convert(infl, outfl, informat, outformat):
+    "Copy posts from one file and format to another."
+    write_posts(read_posts(infl, informat), outfl, outformat)
+
+def import_posts(api, posts, replace=False, workers=1):
+    """Add posts from any iterable to the collection of ``api`` (a
+    ``DeliciousAPI`` with codec 'utf-8') using its bulk write path, and
+    return the ``BulkResult``.
+    """
+    params = (post_to_params(post) for post in posts)
+    return api.posts_add_many(params, workers=workers, replace=replace)
+
+
+def fetch_posts(api, tag='', page_size=1000):
+    """Yield all posts (with ``tag``) of the collection of ``api``, a
+    ``DeliciousAPI``, asking ``posts/all`` for ``page_size`` posts at a
+    time. Posts changed while fetching may be missed or repeated.
+    """
+    start = 0
+    while True:
+        count = 0
+        for post in read_posts_xml(api.posts_all(tag=tag, start=start,
+                results=page_size, _raw=True)):
+            count += 1
+            yield post
+        if count < page_size:
+            break
+        start += page_size
+
+
+### Sorting
+
+SORT_KEYS = {
+    'time': lambda post: post.get('time', ''),
+    'url': lambda post: post['href'],
+    'description': lambda post: post.get('description', '').lower(),
+    'hash': post_hash,
+}
+"Sort keys of posts by name"
+
+MAX_SORT_MEMORY = 32 * 1024 * 1024
+"Default bytes of posts held in memory by `sorted_posts`"
+
+MERGE_WIDTH = 64
+"Maximum number of spill files merged at once"
+
+POST_OVERHEAD = 500
+"Estimated bytes per post besides the values"
+
+def sorted_posts(posts, key=post_hash, reverse=False,
+        max_memory=MAX_SORT_MEMORY, tmpdir=None):
+    """Yield the posts from any iterable sorted by ``key``, a function or a
+    name in SORT_KEYS (default: hash). The sort is stable.
+
+    Posts are collected until their estimated size reaches ``max_memory``
+    bytes, then sorted and written to a temporary file in ``tmpdir``. Every
+    MERGE_WIDTH files of the same size are merged into one, so each post is
+    written about log(spills, MERGE_WIDTH) times, and the rest are merged
+    at the end.
+    """
+    if not callable(key):
+        key = SORT_KEYS[key]
+    sort_key = key
+    if reverse:
+        sort_key = lambda post: _Descending(key(post))
+    levels = [] # sorted files by the number of merges that made them
+    try:
+        entries, size = [], 0
+        for n, post in enumerate(posts):
+            entries.append((sort_key(post), n, post))
+            size += POST_OVERHEAD + sum([len(value)
+                for value in post.values() if isinstance(value, basestring)])
+            if size >= max_memory:
+                entries.sort()
+                run, level = _spill(entries, tmpdir), 0
+                entries, size = [], 0
+                while True:
+                    if level == len(levels):
+                        levels.append([])
+                    levels[level].append(run)
+                    if len(levels[level]) < MERGE_WIDTH:
+                        break
+                    run = _merge_runs(levels[level], sort_key, tmpdir)
+                    levels[level] = []
+                    level += 1
+        # smallest first, and no more than MERGE_WIDTH at once
+        runs = []
+        for level in levels:
+            runs.extend(level)
+        levels = [runs]
+        while len(runs) >= MERGE_WIDTH:
+            runs.append(_merge_runs(runs[:MERGE_WIDTH], sort_key, tmpdir))
+            del runs[:MERGE_WIDTH]
+        entries.sort()
+        for entry in heapq.merge(entries, *[_read_run(run, sort_key)
+                for run in runs]):
+            yield entry[2]
+    finally:
+        for level in levels:
+            for run in level:
+                run.close()
+
+def _merge_runs(runs, sort_key, tmpdir):
+    "Merge sorted files into a new one, and close them."
+    try:
+        return _spill(heapq.merge(*[_read_run(run, sort_key)
+            for run in runs]), tmpdir)
+    finally:
+        for run in runs:
+            run.close()
+
+def _spill(entries, tmpdir):
+    "Write sorted entries to a temporary file, and return it rewound."
+    fl = tempfile.TemporaryFile(dir=tmpdir)
+    for key, n, post in entries:
+        fl.write(json.dumps([n, post]) + '\n')
+    fl.seek(0)
+    return fl
+
+def _read_run(fl, sort_key):
+    for line in fl:
+        n, post = json.loads(line)
+        yield sort_key(post), n, post
+
+class _Descending(object):
+
+    "Sort key wrapper reversing the order."
+
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+### Diff
+
+DIFF_FIELDS = ('description', 'extended', 'tag', 'time', 'shared')
+"Post attributes compared by `diff_posts`"
+
+def changed_fields(old, new, fields=DIFF_FIELDS):
+    """Return the names of the ``fields`` that differ between two versions
+    of a post. Posts with the same meta attribute are not compared further.
+    """
+    if old.get('meta') and old.get('meta') == new.get('meta'):
+        return []
+    return [name for name in fields
+        if _field(old, name) != _field(new, name)]
+
+def diff_posts(old, new, fields=DIFF_FIELDS):
+    """Compare two streams of posts, both sorted by hash (see
+    `sorted_posts`), in one pass. Yields ``(change, old_post, new_post,
+    changed)`` with change 'added', 'removed' or 'changed' and the changed
+    fields for the latter::
+
+        old = sorted_posts(read_posts(open('yesterday.xml')))
+        new = sorted_posts(read_posts(open('today.xml')))
+        for change, was, now, changed in diff_posts(old, new):
+            ...
+
+    Only the current post of each stream is held. Raises ValueError if a
+    stream is out of order.
+    """
+    old, new = _hash_ordered(old), _hash_ordered(new)
+    was, now = _next(old), _next(new)
+    while was or now:
+        if not now or (was and was[0] < now[0]):
+            yield 'removed', was[1], None, []
+            was = _next(old)
+        elif not was or now[0] < was[0]:
+            yield 'added', None, now[1], []
+            now = _next(new)
+        else:
+            changed = changed_fields(was[1], now[1], fields)
+            if changed:
+                yield 'changed', was[1], now[1], changed
+            was, now = _next(old), _next(new)
+
+def _hash_ordered(posts):
+    last = None
+    for post in posts:
+        key = post_hash(post)
+        if last is not None and key < last:
+            raise ValueError, "Posts not sorted by hash at %s" % post['href']
+        last = key
+        yield key, post
+
+def _next(iterator):
+    try:
+        return iterator.next()
+    except StopIteration:
+        return None
+
+def _field(post, name):
+    value = post.get(name) or ''
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    if name == 'tag':
+        return sorted(value.split())
+    elif name == 'shared':
+        return value != 'no'
+    return value
+
+
+def _encode(data):
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    return data
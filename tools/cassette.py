@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""cassette - Record and replay HTTP traffic for deterministic tests.
+
+A `Cassette` holds the responses (status, headers, body and time taken) of
+requests made through a urllib2 opener, one JSON object per line in a file
+(gzipped if the name ends with '.gz'). Its handlers plug into any opener,
+i.e. using ``build_api_opener(extra_handlers=...)``::
+
+    cassette = Cassette('sync.cassette')
+    api = DeliciousAPI(user, passwd, build_opener=lambda user, passwd:
+        cassette.api_opener(user, passwd, mode='record'))
+    ...
+    cassette.save()
+
+Then replay the same requests offline, at full speed or with the original
+timing (``timing=1``, or another factor)::
+
+    cassette = Cassette('sync.cassette').load()
+    api = DeliciousAPI(user, passwd, build_opener=lambda user, passwd:
+        cassette.api_opener(user, passwd, timing=1))
+
+Feeds are replayed by passing ``cassette.opener()`` to ``dlcs_feed``.
+Request headers (credentials) are never recorded.
+"""
+import os
+import sys
+import gzip
+import time
+import base64
+import httplib
+import threading
+import urllib2
+from urllib import addinfourl
+from StringIO import StringIO
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import pydelicious
+
+
+SKIP_HEADERS = ('set-cookie', 'transfer-encoding', 'connection')
+"Response headers that are not recorded"
+
+
+class Cassette:
+
+    """Recorded HTTP interactions, see the module documentation.
+
+    Requests are matched by method and URL. Interactions recorded more than
+    once for a request are replayed in order, the last one repeats.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.interactions = []
+        self.index = {}
+        self.positions = {}
+        self.lock = threading.Lock()
+
+    ### Storage
+
+    def open(self, mode='r'):
+        if self.filename.endswith('.gz'):
+            return gzip.open(self.filename, mode + 'b')
+        return open(self.filename, mode)
+
+    def load(self):
+        "Read the interactions from file, if it exists."
+        self.interactions, self.index, self.positions = [], {}, {}
+        if os.path.exists(self.filename):
+            fl = self.open()
+            try:
+                for line in fl:
+                    if line.strip():
+                        self.add(json.loads(line))
+            finally:
+                fl.close()
+        return self
+
+    def save(self):
+        fl = self.open('w')
+        try:
+            for interaction in self.interactions:
+                fl.write(json.dumps(interaction, sort_keys=True) + '\n')
+        finally:
+            fl.close()
+
+    def add(self, interaction):
+        self.lock.acquire()
+        try:
+            self.interactions.append(interaction)
+            key = (interaction['method'], interaction['url'])
+            self.index.setdefault(key, []).append(interaction)
+        finally:
+            self.lock.release()
+
+    def record(self, req, response, body, elapsed):
+        "Add the interaction for a urllib2 request and response."
+        headers = [(name, value) for name, value in response.info().items()
+            if name.lower() not in SKIP_HEADERS]
+        interaction = {'method': req.get_method(), 'url': req.get_full_url(),
+            'status': response.code, 'reason': response.msg,
+            'headers': headers, 'elapsed': round(elapsed, 4)}
+        try:
+            interaction['body'] = body.decode('utf-8')
+        except UnicodeDecodeError:
+            interaction['body'] = base64.b64encode(body)
+            interaction['encoding'] = 'base64'
+        self.add(interaction)
+
+    ### Lookup
+
+    def find(self, url, method='GET'):
+        "Return the next recorded interaction for a request, or None."
+        self.lock.acquire()
+        try:
+            found = self.index.get((method, url))
+            if not found:
+                return None
+            position = self.positions.get((method, url), 0)
+            self.positions[method, url] = min(position + 1, len(found) - 1)
+            return found[position]
+        finally:
+            self.lock.release()
+
+    def __contains__(self, url):
+        return ('GET', url) in self.index
+
+    def __len__(self):
+        return len(self.interactions)
+
+    def response(self, url, method='GET', timing=0):
+        """Return the recorded response for a request as a urllib2 response,
+        or None. Sleep for the original time taken times ``timing``.
+        """
+        interaction = self.find(url, method)
+        if not interaction:
+            return None
+        if timing:
+            time.sleep(interaction.get('elapsed', 0) * timing)
+        body = interaction['body']
+        if interaction.get('encoding') == 'base64':
+            body = base64.b64decode(body)
+        else:
+            body = body.encode('utf-8')
+        headers = httplib.HTTPMessage(StringIO("".join(["%s: %s\r\n" % (k, v)
+            for k, v in interaction['headers']]) + "\r\n"))
+        response = addinfourl(StringIO(body), headers, url)
+        response.code = interaction['status']
+        response.msg = interaction['reason']
+        return response
+
+    ### Openers
+
+    def handlers(self, mode='replay', timing=0):
+        """Return the handlers for a mode: 'replay' only answers from the
+        cassette, 'record' records all responses and 'auto' records those
+        not in the cassette yet.
+        """
+        if mode == 'replay':
+            return (ReplayHandler(self, timing),)
+        elif mode == 'record':
+            return (RecordHandler(self),)
+        elif mode == 'auto':
+            return (ReplayHandler(self, timing, strict=False),
+                RecordHandler(self))
+        raise ValueError, "Unknown cassette mode %r" % mode
+
+    def opener(self, mode='replay', timing=0):
+        "Return a urllib2 opener, i.e. for ``dlcs_feed``."
+        return urllib2.build_opener(pydelicious.TimeoutHTTPHandler,
+            pydelicious.TimeoutHTTPSHandler, *self.handlers(mode, timing))
+
+    def api_opener(self, user, passwd, host=pydelicious.DLCS_API_HOST,
+            mode='replay', timing=0, pool=None):
+        "Return an API opener for ``DeliciousAPI``, see ``build_api_opener``."
+        return pydelicious.build_api_opener(host, user, passwd,
+            extra_handlers=self.handlers(mode, timing), pool=pool)
+
+    def refresh(self, mode='record'):
+        "Fetch all GET requests in the cassette again, and save it."
+        urls = []
+        for interaction in self.interactions:
+            if interaction['method'] == 'GET' and \
+                    interaction['url'] not in urls:
+                urls.append(interaction['url'])
+        self.interactions, self.index, self.positions = [], {}, {}
+        opener = self.opener(mode)
+        for url in urls:
+            try:
+                opener.open(url).read()
+            except (urllib2.URLError, IOError), e:
+                print >>sys.stderr, "%s: %s" % (url, e)
+        self.save()
+
+
+class RecordHandler(urllib2.BaseHandler):
+
+    """Records all responses to a `Cassette`, before errors are handled so
+    that i.e. 503 answers are recorded too.
+    """
+
+    handler_order = 900
+
+    def __init__(self, cassette):
+        self.cassette = cassette
+
+    def http_request(self, req):
+        req.cassette_started = time.time()
+        return req
+
+    def http_response(self, req, response):
+        if getattr(response, 'cassette', None):
+            # replayed
+            return response
+        body = response.read()
+        elapsed = time.time() - getattr(req, 'cassette_started', time.time())
+        self.cassette.record(req, response, body, elapsed)
+        replay = addinfourl(StringIO(body), response.info(),
+            response.geturl())
+        replay.code = response.code
+        replay.msg = response.msg
+        return replay
+
+    https_request = http_request
+    https_response = http_response
+
+
+class ReplayHandler(urllib2.BaseHandler):
+
+    """Answers requests from a `Cassette`. Unknown requests fail with a
+    URLError, or are passed on to the other handlers if not ``strict``.
+    """
+
+    handler_order = 100
+
+    def __init__(self, cassette, timing=0, strict=True):
+        self.cassette = cassette
+        self.timing = timing
+        self.strict = strict
+
+    def http_open(self, req):
+        response = self.cassette.response(req.get_full_url(),
+            req.get_method(), self.timing)
+        if response:
+            response.cassette = self.cassette
+            return response
+        if self.strict:
+            raise urllib2.URLError("Not in cassette: %s %s" % (
+                req.get_method(), req.get_full_url()))
+
+    https_open = http_open
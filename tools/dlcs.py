@@ -13,9 +13,10 @@ to perfom operations. See::
 This tool enables quick access but the server communication may be slow and
 when doing multiple expensive requests del.icio.us may throttle you and
 return 503's. This all depends on your collection size (posts/tags/bundles)
-ofcourse. In any case, the post and tag lists are stored locally and some
-changes to your collection may not be noticed until you clear this cache
-since posts/update does not notice any edits.
+ofcourse. In any case, the post and tag lists are stored locally. Changes
+made through `dlcs` are written through to these files (see
+`tools/localstore.py`), but edits made elsewhere may not be noticed until you
+clear this cache since posts/update does not notice any edits.
 
 Quickstart
 ----------
@@ -35,6 +36,50 @@ but this can be changed using command line options. If no username or
 password are provided `dlcs` will guess the username and prompt for the
 password.
 
+Profiling
+---------
+To see where a slow command spends its time, use::
+
+    % dlcs --profile tags
+
+This prints the wall time per phase (config, posts/update, download, cache
+read, parse, command, output) and the time spent on requests and throttling
+to stderr. Add ``--profile-out FILE`` to dump cProfile stats of the command
+for use with pstats, or ``--profile-out -`` to print them.
+
+Recording
+---------
+``--record FILE`` saves all API requests and answers made by a command to a
+cassette file, ``--replay FILE`` runs a command against it offline (see
+`tools/cassette.py`). Useful for reproducible timings and bug reports.
+
+Daemon
+------
+Commands that are run often (i.e. from a browser) answer faster with
+`dlcsd` running. It keeps the configuration, API client, local store and
+parsed cache in memory, and `dlcs` forwards commands to it when it runs::
+
+    % dlcsd start
+    % dlcsd stop
+
+Offline changes
+---------------
+With ``--queue`` the commands that change the collection (post, tag, untag,
+rename, bundle, deleteposts...) don't wait for del.icio.us. The changes are
+written to a queue file (~/.dlcs-queue, or 'queue' under 'local-files' in
+the config) and the local cache, and sent by a flush started in the
+background. Use `dlcs flush` to send them and see the outcome. Changes
+refused by del.icio.us are reported by the next `dlcs flush` or queued
+command, and the cached lists are fetched again since they have them.
+
+Shared store
+------------
+`dlcs share` copies the cached post list into a database shared by many
+accounts (~/.dlcs-shared.db, or 'shared' under 'local-files' in the config),
+which stores each URL once (see `tools/sharedstore.py`). Once the user is
+in there, `dlcs mates` compares with the other users in it instead of
+crawling the url feeds.
+
 Limitation
 ----------
 - Bundle sizes are restricted by the maximum URL size [xxx:length?], the
@@ -82,12 +127,23 @@ import time
 import locale
 import codecs
 import math
+import shutil
+import shlex
+import heapq
+from itertools import islice
 from os.path import expanduser, getmtime, exists, abspath
 from ConfigParser import ConfigParser
+from StringIO import StringIO
 import pydelicious
 from pydelicious import DeliciousAPI, dlcs_parse_xml, PyDeliciousException, \
     dlcs_feed
 from pprint import pformat    
+try:
+    from pydelicious.tools import bookmarks, localstore, cassette, dlcsd, \
+        writequeue, sharedstore
+except ImportError:
+    # running from the source tree
+    import bookmarks, localstore, cassette, dlcsd, writequeue, sharedstore
 
 try:
     # Python >= 2.4
@@ -112,6 +168,7 @@ except:
 
 
 __cmds__ = [
+    'batch',
     'bundle',
     'bundleadd',
     'bundleremove',
@@ -119,12 +176,16 @@ __cmds__ = [
     'clearcache',
     'deletebundle',
     'deleteposts',
+    'diff',
+    'exportposts',
     'findposts',
     'findtags',
+    'flush',
     'getbundle',
     'getposts',
     'gettags',
     'help',
+    'importposts',
     'info',
     'mates',
     'post',
@@ -134,6 +195,7 @@ __cmds__ = [
     'recent',
     'rename',
     'req',
+    'share',
     'stats',
     'tag',
     'tags',
@@ -156,6 +218,12 @@ else:
 
 NEW_CONFIG = not os.path.exists(DLCS_CONFIG)
 
+# Set by dlcsd, which runs many commands in one process:
+UPDATE_INTERVAL = 0
+"Seconds to reuse the answer of posts/update for"
+CACHE_PARSED = False
+"Keep the parsed cache files in memory until they change"
+
 ENCODING = locale.getpreferredencoding()
 
 __usage__ = """%prog [options] [command] [args...] """ + """
@@ -187,6 +255,26 @@ __options__ = [
         'help':"When posting a URL, set the 'shared' parameter."}),
     (('-r', '--replace'),{'default':False,
         'help':"When posting a URL, set the 'replace' parameter."}),
+    (('-P', '--profile'),{'action':'store_true','default':False,
+        'help':"Print the time spent per phase to stderr."}),
+    (('--profile-out',),{'dest':'profile_out',
+        'help':"Profile the command with cProfile and dump the stats to file (or '-' to print)."}),
+    (('--record',),{'dest':'record',
+        'help':"Record all API requests and answers to a cassette file."}),
+    (('--replay',),{'dest':'replay',
+        'help':"Answer API requests from a recorded cassette file."}),
+    (('-Q', '--queue'),{'action':'store_true','default':False,
+        'help':"Queue changes locally and send them in the background (see `flush`)."}),
+    (('--sort',),{'dest':'sort','default':None,
+        'help':"Sort posts by KEY: time, url, description or hash, descending with a leading '-' (posts, tagged, findposts, exportposts). Tags sort by count or tag."}),
+    (('--limit',),{'dest':'limit','type':'int','default':None,
+        'help':"Print the first N only, after sorting (posts, tagged, findposts, tags)."}),
+    (('--sort-memory',),{'dest':'sort_memory','type':'int','default':32,
+        'help':"Megabytes of posts to sort in memory, more go to temporary files [%default]."}),
+    (('--fetch',),{'dest':'fetch','action':'store_true','default':False,
+        'help':"Read the posts from del.icio.us a page at a time, not from the cache (exportposts)."}),
+    (('--no-daemon',),{'dest':'no_daemon','action':'store_true','default':False,
+        'help':"Run the command in this process, even if dlcsd is running."}),
     (('-v', '--verboseness'),{'default':0,
         'help':"TODO: Increase or set DEBUG (defaults to 0 or the DLCS_DEBUG env. var.)"})
 ]
@@ -335,6 +423,96 @@ class DebugWrapper:
         setattr(base, name, value)
 
 
+# Profiling
+class PhaseTimer:
+
+    """Wall time spent per phase of a command, see --profile. Phases nest,
+    the time of a phase does not include that of the phases started within.
+    Requests are timed separately using the pydelicious request hooks.
+    Each run of a command has its own, as ``timer`` of the client.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.order = []
+        self.stack = []
+        self.network = self.waited = 0
+        self.requests = 0
+
+    def start(self, name):
+        now = time.time()
+        if self.stack:
+            self.add(self.stack[-1][0], now - self.stack[-1][1])
+        self.stack.append([name, now])
+
+    def stop(self):
+        now = time.time()
+        name, started = self.stack.pop()
+        self.add(name, now - started)
+        if self.stack:
+            self.stack[-1][1] = now
+
+    def add(self, name, seconds):
+        if name not in self.times:
+            self.order.append(name)
+            self.times[name] = 0
+        self.times[name] += seconds
+
+    def __call__(self, event):
+        "After-request hook."
+        self.requests += 1
+        self.network += event.latency
+        self.waited += event.waited
+
+    def report(self, fl):
+        total = sum(self.times.values())
+        print >>fl, "Phase            Seconds       %"
+        for name in self.order:
+            print >>fl, "%-15s %8.3f  %6.1f" % (name, self.times[name],
+                total and 100 * self.times[name] / total)
+        print >>fl, "%-15s %8.3f" % ('total', total)
+        print >>fl, "%i request(s): %.3fs network, %.3fs throttle wait" % (
+            self.requests, self.network, self.waited)
+
+def get_timer(dlcs):
+    "Return the `PhaseTimer` of the run using ``dlcs``, or a new one."
+    return getattr(dlcs, 'timer', None) or PhaseTimer()
+
+class TimedWriter:
+
+    """Wraps a file to time its writes as the 'output' phase."""
+
+    def __init__(self, fl, timer):
+        self.fl = fl
+        self.timer = timer
+
+    def write(self, data):
+        self.timer.start('output')
+        try:
+            self.fl.write(data)
+        finally:
+            self.timer.stop()
+
+    def __getattr__(self, name):
+        return getattr(self.fl, name)
+
+def run_profiled(cmd, filename, *args, **kwds):
+    """Run the command with cProfile and dump the stats to filename, or
+    print the top of the list to stderr for '-'.
+    """
+    import cProfile, pstats
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(cmd, *args, **kwds)
+    finally:
+        if filename == '-':
+            stats = pstats.Stats(profiler, stream=sys.stderr)
+            stats.sort_stats('cumulative').print_stats(30)
+        else:
+            profiler.dump_stats(filename)
+            print >>sys.stderr, "Profile written to %s (see pstats)" % filename
+
+
 ### Main
 
 def main(argv):
@@ -343,6 +521,7 @@ def main(argv):
     the operations. Default command is `info()`.
 
     Configuration file is loaded and used to store username/password.
+    Commands are forwarded to a running `dlcsd` unless --no-daemon is given.
     """
 
     global DEBUG
@@ -350,6 +529,9 @@ def main(argv):
     if not argv:
         argv = sys.argv[1:]
 
+    timer = PhaseTimer()
+    timer.start('config')
+
     ### Parse argument vector
     optparser, opts, args = parse_argv_split(__options__, argv, __usage__)
 
@@ -366,6 +548,45 @@ def main(argv):
 
     if not cmdid in __cmds__:
         optparser.exit("Command must be one of %s" % ", ".join(__cmds__))
+    check_options(optparser, cmdid, opts)
+
+    if not opts['no_daemon']:
+        forwarded, result = dlcsd.forward(argv, opts['config'],
+            opts['encoding'])
+        if forwarded:
+            return result
+
+    conf, options = load_config(opts)
+
+    # Force output encoding
+    sys.stdout = codecs.getwriter(options['encoding'])(sys.stdout)
+    if options['profile']:
+        sys.stdout = TimedWriter(sys.stdout, timer)
+        pydelicious.after_request_hooks.append(timer)
+    # TODO: run tests, args = [a.decode(options['encoding']) for a in args]
+
+    dlcs = build_client(conf, options)
+    timer.stop()
+
+    try:
+        return run_command(cmdid, conf, dlcs, args, options, timer)
+    finally:
+        if options['profile']:
+            pydelicious.after_request_hooks.remove(timer)
+        if options['queue'] and cmdid != 'flush':
+            # refused by the last background flush
+            result = writequeue.WriteQueue(queue_file(conf)).pop_result()
+            if result and result.failed:
+                report_flush(result)
+            background_flush(conf, options)
+        if options['profile']:
+            timer.report(sys.stderr)
+
+def load_config(opts):
+
+    """Read the config file, initializing it if needed, and return it with
+    the options: the items under 'dlcs' overridden by ``opts``.
+    """
 
     ### Parse config file
     conf = ConfigParser()
@@ -408,27 +629,76 @@ def main(argv):
     if not 'password' in options:
         options['password'] = getpass.getpass("Password for %s: " % options['username'])
 
+    return conf, options
 
-    # Force output encoding
-    sys.stdout = codecs.getwriter(options['encoding'])(sys.stdout)
-    # TODO: run tests, args = [a.decode(options['encoding']) for a in args]
+def build_client(conf, options, store=None):
+
+    """Return the DeliciousAPI instance to pass to the command functions,
+    with the local store for the cached files (or ``store``). With the
+    queue option changes are queued instead of sent.
+    """
+
+    # Local copy of the collection, updated by all changes made through dlcs
+    if not store:
+        bundles_file = None
+        if conf.has_option('local-files', 'bundles'):
+            bundles_file = conf.get('local-files', 'bundles')
+        store = localstore.LocalStore(conf.get('local-files', 'posts'),
+            conf.get('local-files', 'tags'), bundles_file)
+
+    # Record or replay the API traffic
+    kwds = {}
+    tape = None
+    if options.get('record') or options.get('replay'):
+        mode = options.get('record') and 'record' or 'replay'
+        tape = cassette.Cassette(options[mode]).load()
+        kwds['build_opener'] = lambda user, passwd: tape.api_opener(user,
+            passwd, mode=mode)
+    if options.get('queue'):
+        kwds['api_request'] = writequeue.queued_api_request(
+            writequeue.WriteQueue(queue_file(conf)))
 
-    # DeliciousAPI instance to pass to the command functions
     dlcs = DeliciousAPI(options['username'], options['password'],
-        codec=options['encoding'])
+        codec=options['encoding'], store=store, **kwds)
+    dlcs.tape = tape
 
     # TODO: integrate debugwrapper if DEBUG:
     if DEBUG > 2:
         dlcs = DebugWrapper(dlcs, sys.stderr)
 
+    return dlcs
+
+def run_command(cmdid, conf, dlcs, args, options, timer=None):
+
+    """Call the command function, then write back the changes to the
+    local store (and the recorded cassette). The phases are timed with
+    ``timer``, or a new `PhaseTimer`, set as ``timer`` of the client
+    during the command.
+    """
+
     ### Defer processing to command function
     cmd = getattr(sys.modules[__name__], cmdid)
+    if timer is None:
+        timer = PhaseTimer()
+    saved, dlcs.timer = getattr(dlcs, 'timer', None), timer
+    timer.start('command')
     try:
-        return cmd(conf, dlcs, *args, **options)
-    except PyDeliciousException, e:
-        print >> sys.stderr, e
-    except pydelicious.DeliciousError, e:
-        print >> sys.stderr, e
+        try:
+            if options.get('profile_out'):
+                return run_profiled(cmd, options['profile_out'], conf, dlcs,
+                    *args, **options)
+            return cmd(conf, dlcs, *args, **options)
+        except PyDeliciousException, e:
+            print >> sys.stderr, e
+        except pydelicious.DeliciousError, e:
+            print >> sys.stderr, e
+    finally:
+        # write back the changes that did succeed
+        dlcs.store.save()
+        if options.get('record'):
+            dlcs.tape.save()
+        timer.stop()
+        dlcs.timer = saved
 
 ### Command functions
 
@@ -637,11 +907,107 @@ def posts(conf, dlcs, *urls, **opts):
     """
 
     posts = cached_posts(conf, dlcs, opts['keep_cache'])
-    for post in posts['posts']:
-        if urls and not post['href'] in urls:
-            continue
-        else:
-            print output('posts', opts, post)
+    found = [post for post in posts['posts']
+        if not urls or post['href'] in urls]
+    for post in select(found, opts, bookmarks.SORT_KEYS):
+        print output('posts', opts, post)
+
+def exportposts(conf, dlcs, filename='-', format='', **opts):
+
+    """Write all posts to a file, or to standard output for '-'. The format
+    is del.icio.us XML (xml), Netscape bookmark HTML (html), JSON lines
+    (jsonl) or CSV (csv) and follows the file extension if not given::
+
+        % dlcs exportposts bookmarks.html
+        % dlcs exportposts - jsonl
+        % dlcs --fetch --sort -time exportposts newest-first.csv
+
+    The cached post list is streamed, not loaded. With --fetch the posts are
+    read from del.icio.us instead, in pages. --sort keeps at most
+    --sort-memory megabytes of posts in memory.
+    """
+
+    if opts['fetch']:
+        posts = bookmarks.fetch_posts(dlcs)
+    else:
+        posts = bookmarks.read_posts(open(cache_posts_file(conf, dlcs,
+            opts['keep_cache'])))
+    if opts['sort']:
+        key, reverse = parse_sort(opts['sort'], bookmarks.SORT_KEYS)
+        posts = bookmarks.sorted_posts(posts, key, reverse,
+            opts['sort_memory'] * 1024 * 1024)
+    format = format or bookmarks.guess_format(filename)
+    if filename == '-':
+        # the writers encode, skip the encoding writer main puts on stdout
+        out = getattr(sys.stdout, 'stream', sys.stdout)
+    else:
+        out = open(filename, 'w')
+    bookmarks.write_posts(posts, out, format)
+    if filename != '-':
+        out.close()
+        print >>sys.stderr, "* Exported posts to %s (%s)" % (filename, format)
+
+def diff(conf, dlcs, old, new='', **opts):
+
+    """Compare two snapshots of a collection and print the added (+), removed
+    (-) and changed (~) posts, with the changed fields. The files are in any
+    format of `exportposts`, the new one defaults to the cached post list::
+
+        % dlcs exportposts yesterday.xml
+        ...
+        % dlcs diff yesterday.xml
+        % dlcs diff mine.xml theirs.jsonl
+
+    Returns 1 if there are differences.
+    """
+
+    if not new:
+        new = cache_posts_file(conf, dlcs, opts['keep_cache'])
+    snapshots = []
+    for filename in old, new:
+        posts = bookmarks.read_posts(open(filename),
+            bookmarks.guess_format(filename))
+        snapshots.append(bookmarks.sorted_posts(posts,
+            max_memory=opts['sort_memory'] * 1024 * 1024))
+    counts = {'added': 0, 'removed': 0, 'changed': 0}
+    marks = {'added': '+', 'removed': '-', 'changed': '~'}
+    for change, was, now, changed in bookmarks.diff_posts(*snapshots):
+        counts[change] += 1
+        line = "%s %s" % (marks[change], (now or was)['href'])
+        if changed:
+            line += " (%s)" % ", ".join(changed)
+        print line
+    print >>sys.stderr, "* %(added)i added, %(removed)i removed, " \
+        "%(changed)i changed" % counts
+    if [count for count in counts.values() if count]:
+        return 1
+
+def importposts(conf, dlcs, filename, format='', **opts):
+
+    """Add all posts from a file (or standard input for '-') to del.icio.us.
+    Formats are those of `exportposts`. Existing posts are reported and
+    skipped, unless --replace is set::
+
+        % dlcs importposts bookmarks.html
+        % dlcs importposts - jsonl < posts.jsonl
+    """
+
+    format = format or bookmarks.guess_format(filename)
+    if filename == '-':
+        infile = sys.stdin
+    else:
+        infile = open(filename)
+    # the importer hands over UTF-8 encoded values, the client may be used
+    # for other commands after this (batch, dlcsd)
+    codec, dlcs.codec = dlcs.codec, 'utf-8'
+    try:
+        result = bookmarks.import_posts(dlcs, bookmarks.read_posts(infile,
+            format), replace=opts['replace'])
+    finally:
+        dlcs.codec = codec
+    for post, error in result.failed:
+        print >>sys.stderr, "! %s: %s" % (post['url'], error)
+    print "* Imported posts: %s" % result
 
 def postsupdate(conf, dlcs, **opts):
 
@@ -689,15 +1055,20 @@ def findposts(conf, dlcs, keyword, **opts):
     """
 
     posts = cached_posts(conf, dlcs, opts['keep_cache'])
+    found = []
     for post in posts['posts']:
-        fields = post['tag']+post['href']+post['description']+post['extended']
+        fields = post.get('tag', '') + post['href'] + \
+            post.get('description', '') + post.get('extended', '')
 
         if opts['ignore_case']:
             if fields.lower().find(keyword.lower()) > -1:
-                print post['href']
+                found.append(post)
 
         elif fields.find(keyword) > -1:
-            print post['href']
+            found.append(post)
+
+    for post in select(found, opts, bookmarks.SORT_KEYS):
+        print post['href']
 
 def deleteposts(conf, dlcs, *urls, **opts):
 
@@ -813,38 +1184,19 @@ def tag(conf, dlcs, tags, *urls, **opts):
 
         % dlcs tag "tag1 tag2" http://... http://...
 
-    This will retrieve the post for each URL, add the given tags and then
-    replace the post at del.icio.us. URLs not in the collection cause
-    a message to stderr and are ignored.
+    The posts are taken from the local cache and replaced at del.icio.us,
+    or if some tag is on exactly these URLs that tag is renamed to include
+    the new ones. URLs not in the collection cause a message to stderr and
+    are ignored.
     """
 
+    store = local_store(conf, dlcs, opts['keep_cache'])
+    tags = tags.split()
     for url in urls:
-        posts = dlcs.request('posts/get', url=url)
-        if not posts['posts']:
+        if url not in store.posts:
             print >>sys.stderr, '* URL "%s" not in collection' % (url)
 
-        else:
-            post = posts['posts'][0]
-            if not 'extended' in post:
-                post['extended'] = ""
-            if not 'tag' in post:
-                post['tag'] = ""
-            if not 'shared' in post:
-                post['shared'] = "True"
-
-            # XXX: del.icio.us takes care of duplicates...
-            post['tag'] += ' '+tags
-
-            dlcs.posts_add(replace="yes",
-                shared=post['shared'],
-                description=post['description'],
-                extended=post['extended'],
-                url=post['href'],
-                tags=post['tag'],
-                time=post['time'])
-
-            print '* tagged "%s" with "%s"' % (url,
-                post['tag'])
+    run_plan(dlcs, store.plan_retag(add=tags, urls=urls))
 
 def untag(conf, dlcs, tags, *urls, **opts):
 
@@ -852,78 +1204,42 @@ def untag(conf, dlcs, tags, *urls, **opts):
     Tags and URLs not found are reported on stderr and ignored.
     Provide only tag names without URL to completely remove them from
     the collection.
-    Setting --ignore-case will lowercase all tags for the given URLs.
+    Setting --ignore-case will remove the tags in any case.
+
+    Tags that are on none but the given URLs are removed with one
+    ``tags/delete`` request each, other posts are replaced one by one using
+    the local cache. The number of requests is printed before starting.
     """
 
-    if opts['ignore_case']:
-        tags = [t.lower() for t in tags.split(' ')]
+    store = local_store(conf, dlcs, opts['keep_cache'])
+    tags = tags.split()
+    found = store.find_tags(tags, opts['ignore_case'])
+    if not found:
+        print >>sys.stderr, '* Tags "%s" not found' % " ".join(tags)
+        return
+    if urls:
+        for url in urls:
+            if url not in store.posts:
+                print >>sys.stderr, '* URL "%s" not in collection' % (url)
+            elif not set(found) & set(store.posts[url].get('tag', '').split()):
+                print >>sys.stderr, '* Tags "%s" not found on URL "%s"' % (
+                    " ".join(tags), url)
+        urls = [url for url in urls if url in store.posts]
     else:
-        tags = tags.split(' ')
-
-    urls = list(urls)
-
-    if not urls:
-        posts = cached_posts(conf, dlcs, opts['keep_cache'])
-
-        for post in posts['posts']:
-            for tag in tags:
-                if opts['ignore_case']:
-                    post['tag'] = post['tag'].lower()
-                if tag in post['tag'].split(' '):
-                    urls.append(post['href'])
+        urls = None
 
-    for url in urls:
-        # TODO: fetching posts is inefficient and ignoring the localcache:
-        # Must have indexed access to fields in localcache
-        posts = dlcs.request('posts/get', url=url)
-        if not posts['posts']:
-            print >>sys.stderr, '* URL "%s" not in collection' % (url)
-
-        else:
-            post = posts['posts'][0]
-            if not 'extended' in post:
-                post['extended'] = ""
-            if not 'tag' in post:
-                post['tag'] = ""
-            if not 'shared' in post:
-                post['shared'] = "True"
-
-            if opts['ignore_case']:
-                tagged = post['tag'].lower().split(' ')
-            else:                    
-                tagged = post['tag'].split(' ')
-            untagged = []
-
-            for tag in tags:
-                if tag in tagged:
-                    tagged.remove(tag)
-                    untagged.append(tag)
-
-            if not untagged:
-                print >>sys.stderr, '* Tags "%s" not found on URL "%s"' % (tags, url)
-                continue
-
-            post['tag'] = " ".join(tagged)
-
-            dlcs.posts_add(replace="yes",
-                shared=post['shared'],
-                description=post['description'],
-                extended=post['extended'],
-                url=post['href'],
-                tags=post['tag'],
-                time=post['time'])
-
-            print '* untagged "%s" from "%s"' % (" ".join(untagged),
-                url)
+    run_plan(dlcs, store.plan_retag(remove=found, urls=urls))
 
 def tagged(conf, dlcs, *tags, **opts):
 
     """Request all posts for a tag or overlap of tags. Print URLs.
 
         % dlcs tagged tag [tag2 ...]
+        % dlcs --sort -time --limit 50 tagged python
     """
 
     posts = cached_posts(conf, dlcs, opts['keep_cache'])
+    found = []
     for post in posts['posts']:
 
         if opts['ignore_case']:
@@ -936,9 +1252,12 @@ def tagged(conf, dlcs, *tags, **opts):
             if '+' in tag:
                 andq = tag.split('+')
                 if Set(post_tags).issuperset(Set(andq)):
-                    print post['href']
+                    found.append(post)
             elif tag in post_tags:
-                print post['href']
+                found.append(post)
+
+    for post in select(found, opts, bookmarks.SORT_KEYS):
+        print post['href']
 
 
 def tags(conf, dlcs, *count, **opts):
@@ -946,6 +1265,7 @@ def tags(conf, dlcs, *count, **opts):
     """Print all tags, optionally filtered by their count.
 
         % dlcs tags [[ '>' | '<' | '=' ] count]
+        % dlcs --sort -count --limit 20 tags
     """
 
     tags = cached_tags(conf, dlcs, opts['keep_cache'])
@@ -961,20 +1281,24 @@ def tags(conf, dlcs, *count, **opts):
         else:
             count = '='
 
+    found = []
     for tag in tags['tags']:
         if count:
             tc = int(tag['count'])
             if count == '=':
                 if tc == number:
-                    print tag['tag'],
+                    found.append(tag)
             elif count == '>':
                 if tc > number:
-                    print tag['tag'],
+                    found.append(tag)
             elif count == '<':
                 if tc < number:
-                    print tag['tag'],
+                    found.append(tag)
         else:            
-            print tag['tag'],
+            found.append(tag)
+
+    for tag in select(found, opts, TAG_SORT_KEYS):
+        print tag['tag'],
 
 def tagrel(conf, dlcs, *tags, **opts):
 
@@ -1039,6 +1363,37 @@ def findtags(conf, dlcs, *tags, **opts):
             elif tag.find(findtag) > -1:
                 print tag
 
+def flush(conf, dlcs, **opts):
+
+    """Send the changes queued with --queue to del.icio.us::
+
+        % dlcs --queue tag python http://python.org/
+        % dlcs flush
+
+    A flush is started in the background after each queued command, this
+    waits for it to finish and includes its outcome. Superseded changes to
+    the same URL or bundle are left out. Changes refused by del.icio.us are
+    moved to a '.failed' file next to the queue, and the cached lists are
+    fetched again.
+    """
+
+    if opts.get('queue'):
+        dlcs = build_client(conf, dict(opts, queue=False))
+    while True:
+        result = flush_queue(conf, dlcs)
+        if result:
+            break
+        # another flush is running
+        time.sleep(1)
+    earlier = writequeue.WriteQueue(queue_file(conf)).pop_result()
+    if earlier:
+        earlier.add(result)
+        result = earlier
+    report_flush(result)
+    print "* %s" % result
+    if result.error:
+        return "! Flush stopped: %s" % result.error
+
 def clearcache(conf, dlcs, *clear, **opts):
 
     """Delete all locally cached data::
@@ -1068,11 +1423,25 @@ def mates(conf, dlcs, *args, **opts):
     """The following was adapted from delicious_mates.
     http://www.aiplayground.org/artikel/delicious-mates/
 
-        % dlcs mates [max_mates[, min_bookmarks[, min_common]]]
+        % dlcs mates [max_mates [min_bookmarks [min_common]]]
 
+    Shows at most ``max_mates`` (15) users having at least ``min_bookmarks``
+    (1) bookmarks and ``min_common`` (2) URLs in common with the user.
     """
    
-    max_mates, min_bookmarks, min_common = map(int, opts['mates'].split(','))
+    if opts.get('mates'):
+        args = opts['mates'].split(',')
+    max_mates, min_bookmarks, min_common = map(int, args) + [15, 1, 2][len(args):]
+
+    store = shared_store(conf)
+    if exists(store.filename) and dlcs.user in store.users():
+        print "Getting mates from the shared store %s" % store.filename
+        friends = {}
+        for username, score, num_common, num_total in store.mates(dlcs.user,
+                max_mates, min_bookmarks, min_common):
+            friends[username] = (score, num_common, float(num_total))
+        print_mates(friends, max_mates)
+        return
 
     delicious_users = {}
     posts = cached_posts(conf, dlcs, opts['keep_cache'])
@@ -1112,11 +1481,13 @@ def mates(conf, dlcs, *args, **opts):
             else:
                 print
             time.sleep(1)
-    
+    print_mates(friends, max_mates)
+
+def print_mates(friends, max_mates):
     print "\nTop %i del.icio.us mates:" % max_mates
     print "username".ljust(20), "weight".ljust(20), "# common bookmarks".ljust(20), "# total bookmarks".ljust(20), "% common"
     print "--------------------------------------------------------------------------------------------"
-    for (username, (weight, num_common, num_total)) in value_sorted(friends)[:max_mates]:
+    for (username, (weight, num_common, num_total)) in value_sorted(friends, max_mates):
         print username.ljust(20),
         print ("%.5f" % (weight*100)).ljust(20),
         print str(num_common).ljust(20),
@@ -1125,6 +1496,82 @@ def mates(conf, dlcs, *args, **opts):
 
 
 
+def share(conf, dlcs, filename='', user='', **opts):
+
+    """Copy the posts of a user to the shared store, replacing those stored
+    before. Without arguments the cached post list of the current user is
+    copied, else a file in any format of `exportposts`::
+
+        % dlcs share
+        % dlcs share bob.xml bob
+    """
+
+    if not filename:
+        filename = cache_posts_file(conf, dlcs, opts['keep_cache'])
+    user = user or dlcs.user
+    store = shared_store(conf)
+    count = store.import_posts(user, bookmarks.read_posts(open(filename),
+        bookmarks.guess_format(filename)))
+    print "* Shared %i posts of %s (%s)" % (count, user, ", ".join([
+        "%i %s" % (n, key) for key, n in sorted(store.stats().items())]))
+    store.close()
+
+def batch(conf, dlcs, filename='-', **opts):
+
+    """Run many commands in one process, one per line of a file or standard
+    input, with the arguments quoted as in a shell::
+
+        % dlcs batch commands.txt
+        % echo 'tag python "http://example.org/a b"' | dlcs batch -
+
+    Empty lines and lines starting with '#' are skipped, the options given
+    to batch apply to all commands. The cache files are parsed and
+    posts/update is asked only once for the whole batch. A status line for
+    each command is printed to stderr, the exit status is 1 if any failed.
+    """
+
+    global UPDATE_INTERVAL, CACHE_PARSED
+
+    if filename == '-':
+        fl = sys.stdin
+    else:
+        fl = open(filename)
+    saved = UPDATE_INTERVAL, CACHE_PARSED
+    UPDATE_INTERVAL, CACHE_PARSED = float('inf'), True
+    done = failed = 0
+    started = time.time()
+    try:
+        for lineno, line in enumerate(fl):
+            t = time.time()
+            try:
+                args = shlex.split(line, comments=True)
+                if not args:
+                    continue
+                cmdid, args = args[0], args[1:]
+                if cmdid not in __cmds__ or cmdid in ('batch', 'postit'):
+                    raise ValueError("command not available in batch")
+                result = getattr(sys.modules[__name__], cmdid)(conf, dlcs,
+                    *args, **opts)
+                if result and result is not True:
+                    raise ValueError(result)
+                done += 1
+                status = 'ok'
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception, e:
+                failed += 1
+                status = 'FAILED (%s: %s)' % (e.__class__.__name__, e)
+            print >>sys.stderr, "%i: %s %.3fs: %s" % (lineno + 1, status,
+                time.time() - t, line.strip())
+    finally:
+        UPDATE_INTERVAL, CACHE_PARSED = saved
+        if fl is not sys.stdin:
+            fl.close()
+    print >>sys.stderr, "%i command(s), %i failed in %.2fs" % (done + failed,
+        failed, time.time() - started)
+    if failed:
+        return 1
+
 ### Utils
 def http_dump(fl):
 
@@ -1138,7 +1585,58 @@ def http_dump(fl):
         fl.read().strip()])
 
 def cache_file(fn, data):
-    open(fn, 'w').write(data.read())
+    shutil.copyfileobj(data, open(fn, 'w'))
+
+def cache_download(fn, method, timer):
+    "Cache the raw response of an API method."
+    timer.start('download')
+    try:
+        cache_file(fn, method(_raw=True))
+    finally:
+        timer.stop()
+
+_last_update = [0, None]
+
+def last_update(dlcs):
+    """Return the time of the last update to the collection. The answer is
+    reused for UPDATE_INTERVAL seconds.
+    """
+    if UPDATE_INTERVAL and time.time() - _last_update[0] < UPDATE_INTERVAL:
+        return _last_update[1]
+    timer = get_timer(dlcs)
+    timer.start('posts/update')
+    try:
+        update = dlcs.posts_update()['update']['time']
+    finally:
+        timer.stop()
+    _last_update[:] = [time.time(), update]
+    return update
+
+_parsed = {}
+
+def parse_cache_file(fn, timer):
+    """Read and parse a cached file, timed with ``timer``. With CACHE_PARSED
+    set, the result is kept until the file changes (and should not be
+    modified).
+    """
+    if CACHE_PARSED:
+        st = os.stat(fn)
+        key = (st.st_mtime, st.st_size)
+        if fn in _parsed and _parsed[fn][0] == key:
+            return _parsed[fn][1]
+    timer.start('cache read')
+    try:
+        data = open(fn).read()
+    finally:
+        timer.stop()
+    timer.start('parse')
+    try:
+        parsed = dlcs_parse_xml(StringIO(data))
+    finally:
+        timer.stop()
+    if CACHE_PARSED:
+        _parsed[fn] = (key, parsed)
+    return parsed
 
 def cache_append_posts(fl, ):
     pass
@@ -1149,46 +1647,196 @@ def cached_tags(conf, dlcs, noupdate=False):
     older than the last time the posts where updated (according to
     del.icio.us posts/update, which only notes new posts, not any updates).
     """
+    save_store(dlcs)
+    timer = get_timer(dlcs)
     tags_file = conf.get('local-files', 'tags')
     if not exists(tags_file):
         print >>sys.stderr, "cached_tags: Fetching new tag list..."
-        cache_file(tags_file, dlcs.tags_get(_raw=True))
+        cache_download(tags_file, dlcs.tags_get, timer)
     else:
         if not noupdate:
-            lastupdate = dlcs.posts_update()['update']['time']
+            lastupdate = last_update(dlcs)
             if time.gmtime(getmtime(tags_file)) < lastupdate:
                 print >>sys.stderr, "cached_tags: Updating tag list..."
-                cache_file(tags_file, dlcs.tags_get(_raw=True))
+                cache_download(tags_file, dlcs.tags_get, timer)
         elif DEBUG: print >>sys.stderr, "cached_tags: Forced read from cached file..."
-    tags = dlcs_parse_xml(open(tags_file))
-    return tags
+    return parse_cache_file(tags_file, timer)
 
 def cached_posts(conf, dlcs, noupdate=False):
     """
     Same as cached_tags but for the post list.
     """
+    return parse_cache_file(cache_posts_file(conf, dlcs, noupdate),
+        get_timer(dlcs))
+
+def cache_posts_file(conf, dlcs, noupdate=False):
+    """
+    Make sure the post list is cached locally, see cached_posts, and return
+    the filename.
+    """
+    save_store(dlcs)
+    timer = get_timer(dlcs)
     posts_file = conf.get('local-files', 'posts')
     if not exists(posts_file):
         print >>sys.stderr, "cached_posts: Fetching new post list..."
-        cache_file(posts_file, dlcs.posts_all(_raw=True))
+        cache_download(posts_file, dlcs.posts_all, timer)
     else:
         if not noupdate:
-            lastupdate = dlcs.posts_update()['update']['time']
+            lastupdate = last_update(dlcs)
             if time.gmtime(getmtime(posts_file)) < lastupdate:
                 print >>sys.stderr, "cached_posts: Updating post list..."
-                cache_file(posts_file, dlcs.posts_all(_raw=True))
+                cache_download(posts_file, dlcs.posts_all, timer)
         elif DEBUG: print >>sys.stderr, "cached_posts: Forced read from cached file..."
-    posts = dlcs_parse_xml(open(posts_file))
-    return posts
+    return posts_file
+
+def queue_file(conf):
+    "Return the file name of the queue for --queue."
+    if conf.has_option('local-files', 'queue'):
+        return conf.get('local-files', 'queue')
+    return expanduser("~/.dlcs-queue")
+
+def parse_sort(value, keys):
+    """Return the key name and wether to sort descending for a --sort value,
+    or raise ValueError if it is not in ``keys``."""
+    key = value.lstrip('-')
+    if key not in keys:
+        raise ValueError, "Unknown sort key %r, use one of %s" % (key,
+            ", ".join(sorted(keys)))
+    return key, value.startswith('-')
+
+def shared_store(conf):
+    "Return the `sharedstore.SharedStore` for `share` and `mates`."
+    if conf.has_option('local-files', 'shared'):
+        return sharedstore.SharedStore(conf.get('local-files', 'shared'))
+    return sharedstore.SharedStore(expanduser("~/.dlcs-shared.db"))
+
+def flush_queue(conf, dlcs, keep_result=False):
+    """
+    Flush the queue through ``dlcs``, which sends the changes (its local
+    store has them already). Returns a `writequeue.FlushResult`, or None if
+    another flush is running. If changes were refused the cached lists are
+    removed, as they have them, so they are fetched again.
+    """
+    store, dlcs.store = dlcs.store, None
+    try:
+        result = writequeue.WriteQueue(queue_file(conf)).flush(dlcs,
+            keep_result=keep_result)
+    finally:
+        dlcs.store = store
+    if result and result.failed:
+        for name in ('posts', 'tags'):
+            filename = conf.get('local-files', name)
+            if exists(filename):
+                os.unlink(filename)
+    return result
+
+def report_flush(result):
+    "Print the changes refused in a flush."
+    for path, params, error in result.failed:
+        print >>sys.stderr, "* %s failed: %s (%s)" % (path, error,
+            ", ".join(["%s=%s" % item for item in sorted(params.items())]))
+
+def background_flush(conf, options):
+    """
+    Flush the queue from a detached child process, if there is anything
+    queued and no flush is running.
+    """
+    queue = writequeue.WriteQueue(queue_file(conf))
+    if not len(queue):
+        return
+    if os.fork():
+        return
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        null = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(null, fd)
+        flush_queue(conf, build_client(conf, dict(options, queue=False)),
+            keep_result=True)
+    finally:
+        os._exit(0)
+
+def save_store(dlcs):
+    "Write pending changes to the cache files before they are read."
+    store = getattr(dlcs, 'store', None)
+    if store and store.changed:
+        store.save()
+
+def local_store(conf, dlcs, noupdate=False):
+    """
+    Return the loaded local store of the API instance (or a new one for the
+    cached files), making sure the post list is cached and up to date.
+    """
+    cache_posts_file(conf, dlcs, noupdate)
+    store = getattr(dlcs, 'store', None)
+    if not store:
+        store = localstore.LocalStore(conf.get('local-files', 'posts'),
+            conf.get('local-files', 'tags'))
+    store.ensure_loaded()
+    return store
+
+def run_plan(dlcs, calls):
+    """
+    Print the number of requests planned by the local store, then make them
+    and print each change.
+    """
+    print '* %i request(s) to make' % len(calls)
+    for path, params in calls:
+        dlcs.request(path, **dict([(k, v.encode(dlcs.codec))
+            for k, v in params.items()]))
+        if path == 'tags/delete':
+            print '* deleted tag "%s"' % params['tag']
+        elif path == 'tags/rename':
+            print '* "%s" -> "%s"' % (params['old'], params['new'])
+        else:
+            print '* tagged "%s" with "%s"' % (params['url'], params['tags'])
+
+def value_sorted(dic, limit=None):
+    """
+    Return dic.items(), sorted by the values stored in the dictionary,
+    highest first. Only the first `limit` items are selected, if given.
+    """
+    order = lambda (key, num): (num, key)
+    if limit is not None:
+        return heapq.nlargest(limit, dic.iteritems(), order)
+    return sorted(dic.iteritems(), key=order, reverse=True)
+
+TAG_SORT_KEYS = {
+    'count': lambda tag: int(tag['count']),
+    'tag': lambda tag: tag['tag'],
+}
+
+def check_options(parser, cmdid, opts):
+    "Exit with a usage error if the --sort or --limit value is invalid."
+    if opts.get('sort'):
+        keys = cmdid == 'tags' and TAG_SORT_KEYS or bookmarks.SORT_KEYS
+        try:
+            parse_sort(opts['sort'], keys)
+        except ValueError, e:
+            parser.error(str(e))
+    if opts.get('limit') is not None and opts['limit'] < 0:
+        parser.error("--limit must be 0 or more, not %i" % opts['limit'])
 
-def value_sorted(dic):
+def select(items, opts, keys):
     """
-    Return dic.items(), sorted by the values stored in the dictionary.
+    Return the items in the order of the --sort option, a name in `keys`
+    (a dictionary of key functions), and only the first --limit items.
+    With a limit the items are selected with a heap of that size instead of
+    sorting them all.
     """
-    l = [(num, key) for (key, num) in dic.items()]
-    l.sort(reverse=True)
-    l = [(key, num) for (num, key) in l]
-    return l
+    limit = opts.get('limit')
+    if not opts.get('sort'):
+        if limit is not None:
+            return list(islice(items, limit))
+        return items
+    name, reverse = parse_sort(opts['sort'], keys)
+    if limit is None:
+        return sorted(items, key=keys[name], reverse=reverse)
+    elif reverse:
+        return heapq.nlargest(limit, items, keys[name])
+    return heapq.nsmallest(limit, items, keys[name])
 
 
 def _main():    
@@ -8,7 +8,6 @@ import locale
 import optparse
 import os
 from pprint import pprint, pformat
-import re
 import sys
 
 import pydelicious
@@ -48,22 +47,34 @@ def parse_argv(options, argv, usage="%prog [args] [options]"):
 	
 	return parser, optsv, args
 
-find_patterns = re.compile('%\(([^)]*)\)s').findall
+def index_feeds(feeds=pydelicious.delicious_v2_feeds):
+	"Group the feed names by the set of parameters their template requires. "
+	index = {}
+	for name, path in feeds.items():
+		fields = pydelicious.get_feed_template(path).required
+		index.setdefault(fields, []).append(name)
+	return index
+
+feed_index = index_feeds()
 
 def feeds_for_params(**params):
 	kandidates = {}
-	"Feed paths that need more parameters. "
+	"Feed paths that need more parameters, with the missing parameters. "
 	matches = []
 	"Feed paths that match current paramters. "
-	params = set([p for p in params if type(params[p]) != type(None)])
-	for name, path in pydelicious.delicious_v2_feeds.items():
-		ptrns = set(find_patterns(path))
-		if ptrns > params:
-			kandidates[name] = params.difference(ptrns)
-		elif ptrns == params:
-			matches.append(name)
+	params = frozenset([p for p in params if type(params[p]) != type(None)])
+	for fields, names in feed_index.items():
+		if fields > params:
+			for name in names:
+				kandidates[name] = fields.difference(params)
+		elif fields == params:
+			matches.extend(names)
 	return matches, kandidates
 
+def feed_url(name, base=None, **params):
+	return pydelicious.get_feed_template(
+			pydelicious.delicious_v2_feeds[name], base)(**params)
+
 def main(argv):
 	optparser, opts, args = parse_argv(__options__, argv, __usage__)
 	kwds = {}
@@ -82,7 +93,7 @@ def main(argv):
 		if matches:
 			print "Exact matches:"
 		for m in matches:
-			print '\t'+m+':', pydelicious.delicious_v2_feeds[m] % kwds
+			print '\t'+m+':', feed_url(m, **kwds)
 		if candidates:
 			print "Candidates:"
 		for m in candidates:
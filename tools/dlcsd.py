@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""dlcsd - Keep dlcs loaded in a background process.
+
+Every `dlcs` command starts Python, reads the config, asks del.icio.us for
+posts/update and parses the cached lists. `dlcsd` does all that once: it
+owns the API client (and its rate limiter), the local store and the parsed
+cache files, and runs the commands that `dlcs` forwards to it over a Unix
+socket::
+
+    % dlcsd start
+    % dlcs tags python      # answered by the daemon
+    % dlcsd stop
+
+`dlcs` forwards its command line to the daemon whenever one listens on the
+socket, ~/.dlcs-socket or $DLCS_SOCKET. Interactive commands (postit),
+commands reading or writing the terminal ('-' as file), and command lines
+for another config or user, or with options that only make sense
+in-process (--record, --replay, --profile...), still run in `dlcs` itself,
+as does any command given --no-daemon. The daemon asks for
+posts/update at most once per --update-interval seconds, and reloads the
+cache files once they are replaced.
+
+Options after the action are `dlcs` options (i.e. -c CONFIG) used to set up
+the daemon.
+"""
+import os
+import sys
+import time
+import socket
+import codecs
+import traceback
+import SocketServer
+from os.path import expanduser
+from StringIO import StringIO
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+SOCKET = os.environ.get('DLCS_SOCKET', expanduser('~/.dlcs-socket'))
+
+LOCAL_COMMANDS = ('postit',)
+"Commands that need the terminal of the user"
+
+LOCAL_OPTIONS = ('record', 'replay', 'profile', 'profile_out', 'no_daemon')
+"Options that are only honoured by dlcs itself"
+
+FILE_COMMANDS = {'batch': '-', 'exportposts': '-', 'importposts': None}
+"Commands with a file argument, and its default ('-' for the terminal)"
+
+
+### Client
+
+def send(message, path=SOCKET):
+    """Send a message to the daemon and return the reply, or None if no
+    daemon listens on ``path``."""
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error:
+            return None
+        fl = sock.makefile('rwb')
+        fl.write(json.dumps(message) + '\n')
+        fl.flush()
+        reply = fl.readline()
+        fl.close()
+    finally:
+        sock.close()
+    if not reply:
+        return None
+    return json.loads(reply)
+
+def forward(argv, config, encoding, path=SOCKET):
+    """Run a dlcs command line in the daemon and write its output. The
+    config file and output encoding are those of the client. Returns
+    ``(True, result)`` with the return value of the command, or ``(False,
+    None)`` if no daemon is listening or it would not run the command.
+    """
+    reply = send({'argv': argv, 'cwd': os.getcwd(),
+        'config': os.path.abspath(config), 'encoding': encoding}, path)
+    if not reply or reply.get('local'):
+        return False, None
+    # output travels as latin-1, to keep the bytes encoded by the daemon
+    sys.stdout.write(reply['stdout'].encode('latin-1'))
+    sys.stderr.write(reply['stderr'].encode('latin-1'))
+    return True, reply['result']
+
+
+### Daemon
+
+class DlcsRequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        message = json.loads(line)
+        if 'argv' in message:
+            reply = self.server.run(message['argv'], message.get('cwd'),
+                message.get('config'), message.get('encoding'))
+        elif message.get('action') == 'stop':
+            self.server.running = False
+            reply = {'stopped': True}
+        else:
+            reply = self.server.status()
+        self.wfile.write(json.dumps(reply) + '\n')
+
+
+class DlcsDaemon(SocketServer.UnixStreamServer):
+
+    """Runs forwarded dlcs commands one at a time, with one API client
+    and local store set up from the dlcs options in ``argv``. Changes queued
+    with --queue are sent after ``idle_flush`` seconds without commands.
+    """
+
+    def __init__(self, path=SOCKET, argv=(), update_interval=60, idle_flush=5):
+        try:
+            from pydelicious.tools import dlcs
+        except ImportError:
+            import dlcs
+        self.dlcs = dlcs
+        dlcs.UPDATE_INTERVAL = update_interval
+        dlcs.CACHE_PARSED = True
+        parser, opts, args = dlcs.parse_argv_split(dlcs.__options__,
+            list(argv), dlcs.__usage__)
+        opts['config'] = os.path.abspath(opts['config'])
+        self.conf, self.options = dlcs.load_config(opts)
+        self.client = dlcs.build_client(self.conf, self.options)
+        self.client.store.ensure_loaded()
+        self.queued_client = None
+        if os.path.exists(path):
+            if send({'action': 'status'}, path):
+                raise socket.error("dlcsd already running at %s" % path)
+            os.remove(path)
+        # no other user may connect, not even before a chmod
+        umask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path,
+                DlcsRequestHandler)
+        finally:
+            os.umask(umask)
+        self.path = path
+        self.timeout = idle_flush
+        self.started = time.time()
+        self.commands = 0
+        self.running = False
+
+    def run(self, argv, cwd=None, config=None, encoding=None):
+        "Run a dlcs command line and return the reply for the client."
+        dlcs = self.dlcs
+        stdout, stderr = StringIO(), StringIO()
+        saved = sys.stdout, sys.stderr, os.getcwd()
+        sys.stderr = stderr
+        try:
+            try:
+                parser, opts, args = dlcs.parse_argv_split(dlcs.__options__,
+                    list(argv), dlcs.__usage__)
+                cmdid = args and args.pop(0) or 'info'
+                dlcs.check_options(parser, cmdid, opts)
+                opts['config'] = config or os.path.abspath(opts['config'])
+                opts['encoding'] = encoding or opts['encoding']
+                if cmdid in FILE_COMMANDS and (args[:1] or
+                        [FILE_COMMANDS[cmdid]])[0] == '-':
+                    # uses the standard input or output of the client
+                    return {'local': True}
+                if cmdid in LOCAL_COMMANDS or [name for name in LOCAL_OPTIONS
+                        if opts.get(name)] or opts['config'] != \
+                        self.options['config'] or opts.get('username',
+                        self.options['username']) != self.options['username']:
+                    return {'local': True}
+                options = dict(self.options)
+                options.update(opts)
+                sys.stdout = codecs.getwriter(options['encoding'])(stdout)
+                if cwd:
+                    os.chdir(cwd)
+                self.commands += 1
+                client = self.client
+                if options['queue']:
+                    client = self.get_queued_client()
+                result = dlcs.run_command(cmdid, self.conf, client, args,
+                    options)
+            except SystemExit, e:
+                result = e.code
+            except Exception, e:
+                traceback.print_exc()
+                result = 1
+        finally:
+            sys.stdout, sys.stderr = saved[:2]
+            os.chdir(saved[2])
+        if result is not None and not isinstance(result, (int, basestring)):
+            result = str(result)
+        return {'stdout': stdout.getvalue().decode('latin-1'),
+            'stderr': stderr.getvalue().decode('latin-1'), 'result': result}
+
+    def get_queued_client(self):
+        "The client for --queue, sharing the store."
+        if not self.queued_client:
+            self.queued_client = self.dlcs.build_client(self.conf,
+                dict(self.options, queue=True), self.client.store)
+        return self.queued_client
+
+    def handle_timeout(self):
+        "Send the queued changes while idle."
+        queue = self.dlcs.writequeue.WriteQueue(self.dlcs.queue_file(self.conf))
+        if len(queue):
+            self.dlcs.flush_queue(self.conf, self.client)
+
+    def status(self):
+        return {'pid': os.getpid(), 'user': self.options['username'],
+            'config': self.options['config'], 'commands': self.commands,
+            'uptime': time.time() - self.started}
+
+    def serve(self):
+        "Handle requests until stopped."
+        self.running = True
+        try:
+            while self.running:
+                self.handle_request()
+        finally:
+            self.server_close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def daemonize():
+    "Detach from the terminal, in a double forked child."
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    os.chdir('/')
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null, fd)
+
+
+### Main
+
+__usage__ = """%prog start|run|stop|status [--update-interval SECONDS] [dlcs options]
+
+start runs the daemon in the background, run in the foreground."""
+
+def main(argv):
+    if not argv or argv[0] not in ('start', 'run', 'stop', 'status'):
+        print >>sys.stderr, __usage__.replace('%prog', 'dlcsd')
+        return 2
+    action, argv = argv[0], argv[1:]
+    interval = 60
+    if '--update-interval' in argv:
+        i = argv.index('--update-interval')
+        interval = float(argv[i+1])
+        del argv[i:i+2]
+
+    if action in ('stop', 'status'):
+        reply = send({'action': action})
+        if not reply:
+            print >>sys.stderr, "dlcsd is not running"
+            return 1
+        for key, value in sorted(reply.items()):
+            print "%s: %s" % (key, value)
+        return
+
+    daemon = DlcsDaemon(SOCKET, argv, interval)
+    if action == 'start':
+        print >>sys.stderr, "dlcsd listening at %s" % SOCKET
+        daemonize()
+    daemon.serve()
+
+def _main():
+    try:
+        sys.exit(main(sys.argv[1:]))
+    except KeyboardInterrupt:
+        print >>sys.stderr, "User interrupt"
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+"""loadgen - Drive a del.icio.us API server with many simulated clients.
+
+Each client is a `DeliciousAPI` instance with its own rate limiter, running
+a weighted mix of operations from its own thread:
+
+:sync: a `dlcs` style sync, ``posts/update``, ``posts/all`` and ``tags/get``
+:add: a bulk add of a batch of new posts with ``posts_add_many``
+:feeds: polling the user and recent feeds
+
+Without ``--url`` a local `mockserver` is started, with a user and a
+synthetic collection per client::
+
+    % dlcs_loadgen --clients 20 --duration 30 --mix sync=6,add=1,feeds=3 \\
+        --wait .1 --throttle-rate 5
+
+The report gives the throughput, and the request count, errors and
+p50/p95/p99 latency per API path, followed by the throttle and retry counts
+and the time spent in the rate limiters. Use it to size worker pools and
+rate limits before changing them in production.
+"""
+import sys
+import math
+import time
+import random
+import optparse
+import threading
+from urlparse import urlsplit
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import pydelicious
+from pydelicious import DeliciousAPI, RequestEvent, get_feed_template, \
+    delicious_v2_feeds
+try:
+    from pydelicious.tools import mockserver
+except ImportError:
+    import mockserver
+
+
+DEFAULT_MIX = {'sync': 6, 'add': 1, 'feeds': 3}
+
+
+class LoadRecorder:
+
+    """After-request hook collecting the latencies, errors, throttles and
+    retries per path."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.throttled = 0
+        self.retries = 0
+
+    def __call__(self, event):
+        self.lock.acquire()
+        try:
+            self.latencies.setdefault(event.path, []).append(event.latency)
+            if event.error:
+                self.errors[event.path] = self.errors.get(event.path, 0) + 1
+            if event.status == 503:
+                self.throttled += 1
+            self.retries += event.retries
+        finally:
+            self.lock.release()
+
+    def requests(self):
+        return sum([len(values) for values in self.latencies.values()])
+
+    def paths(self):
+        "Return a dictionary with the counts and percentiles per path."
+        paths = {}
+        for path, values in self.latencies.items():
+            values = sorted(values)
+            paths[path] = {'requests': len(values),
+                'errors': self.errors.get(path, 0),
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'p99': percentile(values, 99)}
+        return paths
+
+
+def percentile(values, p):
+    "Return the ``p``-th percentile of sorted ``values`` (nearest rank)."
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(0, min(rank, len(values)) - 1)]
+
+
+class SimulatedClient(threading.Thread):
+
+    """Runs operations picked at random by weight from ``mix``, until
+    ``deadline`` or after ``operations`` operations."""
+
+    def __init__(self, api, user, feeds_url, mix, seed=0, batch=10,
+            deadline=None, operations=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.api = api
+        self.user = user
+        self.feeds_url = feeds_url
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.batch = batch
+        self.deadline = deadline
+        self.operations = operations
+        self.choices = []
+        for name, weight in sorted(mix.items()):
+            self.choices.extend([name] * weight)
+        self.done = {}
+        self.failed = {}
+        self.added = 0
+
+    def run(self):
+        count = 0
+        while (self.operations is None or count < self.operations) and \
+                (self.deadline is None or time.time() < self.deadline):
+            name = self.random.choice(self.choices)
+            try:
+                getattr(self, 'do_' + name)()
+                self.done[name] = self.done.get(name, 0) + 1
+            except Exception:
+                self.failed[name] = self.failed.get(name, 0) + 1
+            count += 1
+
+    def do_sync(self):
+        self.api.posts_update()
+        self.api.posts_all()
+        self.api.tags_get()
+
+    def do_add(self):
+        posts = [{'url': 'http://example.com/load/%s/%i' % (self.seed, i),
+                'description': 'Load test %i' % i, 'tags': 'load test'}
+            for i in range(self.added, self.added + self.batch)]
+        self.added += self.batch
+        self.api.posts_add_many(posts, replace=True)
+
+    def do_feeds(self):
+        for name, params in (('user', {'username': self.user}),
+                ('recent', {})):
+            url = get_feed_template(delicious_v2_feeds[name],
+                self.feeds_url)(format='json', **params)
+            pydelicious.http_request(url,
+                event=RequestEvent(url, 'feeds/' + name)).read()
+
+
+def run(api_url, clients=4, duration=10, operations=None, mix=DEFAULT_MIX,
+        users=((mockserver.DEFAULT_USER, mockserver.DEFAULT_PASSWD),),
+        feeds_url=None, wait=0, batch=10, seed=0, pool_size=None):
+    """Run ``clients`` simulated clients against ``api_url`` for
+    ``duration`` seconds, or ``operations`` operations each. ``users`` is a
+    list of ``(user, passwd)``, one per client (repeated if short). Returns
+    a report dictionary, see `format_report`.
+    """
+    if not feeds_url:
+        feeds_url = api_url.rsplit('/', 1)[0] + '/v2/'
+    host = urlsplit(api_url)[1]
+    pool = pydelicious.ConnectionPool(maxsize=pool_size or clients)
+    recorder = LoadRecorder()
+    deadline = None
+    if operations is None:
+        deadline = time.time() + duration
+
+    threads = []
+    for n in range(clients):
+        user, passwd = users[n % len(users)]
+        api = DeliciousAPI(user, passwd, api_url=api_url,
+            waiter=pydelicious._AdaptiveWaiter(wait, min_wait=wait or .01),
+            build_opener=lambda user, passwd: pydelicious.build_api_opener(
+                host, user, passwd, pool=pool))
+        threads.append(SimulatedClient(api, user, feeds_url, mix,
+            seed + n, batch, deadline, operations))
+
+    pydelicious.after_request_hooks.append(recorder)
+    started = time.time()
+    try:
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+    finally:
+        pydelicious.after_request_hooks.remove(recorder)
+        pool.clear()
+    elapsed = time.time() - started
+
+    report = {'clients': clients, 'elapsed': elapsed,
+        'requests': recorder.requests(),
+        'throughput': recorder.requests() / elapsed,
+        'throttled': recorder.throttled, 'retries': recorder.retries,
+        'wait_time': sum([t.api.stats.wait_time for t in threads]),
+        'retry_time': sum([t.api.stats.retry_time for t in threads]),
+        'operations': {}, 'failed': {}, 'paths': recorder.paths()}
+    for thread in threads:
+        for counts, key in ((thread.done, 'operations'),
+                (thread.failed, 'failed')):
+            for name, count in counts.items():
+                report[key][name] = report[key].get(name, 0) + count
+    return report
+
+
+def format_report(report):
+    "Return the report as a text table, latencies in milliseconds."
+    lines = ["%(requests)i requests by %(clients)i clients in %(elapsed).2fs, "
+        "%(throughput).1f req/s" % report, "",
+        "%-20s %8s %7s %8s %8s %8s" % ('path', 'requests', 'errors',
+            'p50 ms', 'p95 ms', 'p99 ms')]
+    for path, stats in sorted(report['paths'].items()):
+        lines.append("%-20s %8i %7i %8.1f %8.1f %8.1f" % (path,
+            stats['requests'], stats['errors'], stats['p50'] * 1000,
+            stats['p95'] * 1000, stats['p99'] * 1000))
+    lines.append("")
+    lines.append("throttled: %(throttled)i, retries: %(retries)i, "
+        "rate limiter wait: %(wait_time).2fs, retry wait: %(retry_time).2fs"
+        % report)
+    lines.append("operations: %s" % ", ".join(["%s %i" % item
+        for item in sorted(report['operations'].items())]))
+    if report['failed']:
+        lines.append("failed: %s" % ", ".join(["%s %i" % item
+            for item in sorted(report['failed'].items())]))
+    return "\n".join(lines)
+
+
+def parse_mix(value):
+    "Parse a mix like 'sync=6,add=1,feeds=3' to a dictionary of weights."
+    mix = {}
+    for item in value.split(','):
+        name, weight = item.split('=')
+        if not hasattr(SimulatedClient, 'do_' + name.strip()):
+            raise ValueError, "Unknown operation %r" % name
+        mix[name.strip()] = int(weight)
+    return mix
+
+
+### Main
+
+__usage__ = "%prog [options]"
+
+__options__ = [
+    (('--url',), {'help': "API URL of the target server "
+        "(default: start a local mock server)"}),
+    (('--feeds-url',), {'dest': 'feeds_url',
+        'help': "Feeds URL of the target server [URL/../v2/]"}),
+    (('-u', '--username'), {'default': mockserver.DEFAULT_USER}),
+    (('-p', '--password'), {'default': mockserver.DEFAULT_PASSWD}),
+    (('-c', '--clients'), {'type': 'int', 'default': 4,
+        'help': "Number of simulated clients [%default]"}),
+    (('-d', '--duration'), {'type': 'float', 'default': 10,
+        'help': "Seconds to run [%default]"}),
+    (('-n', '--operations'), {'type': 'int',
+        'help': "Operations per client, instead of a duration"}),
+    (('-m', '--mix'), {'default': ",".join(["%s=%i" % item
+        for item in sorted(DEFAULT_MIX.items())]),
+        'help': "Weights of the operations [%default]"}),
+    (('-w', '--wait'), {'type': 'float', 'default': 0,
+        'help': "Seconds between requests per client [%default]"}),
+    (('-b', '--batch'), {'type': 'int', 'default': 10,
+        'help': "Posts per bulk add [%default]"}),
+    (('--pool',), {'type': 'int',
+        'help': "Connections in the shared pool [clients]"}),
+    (('--seed',), {'type': 'int', 'default': 0}),
+    (('--json',), {'action': 'store_true', 'default': False,
+        'help': "Print the report as JSON"}),
+    (('--posts',), {'type': 'int', 'default': 1000,
+        'help': "Posts per user on the mock server [%default]"}),
+    (('--latency',), {'type': 'float', 'default': 0}),
+    (('--jitter',), {'type': 'float', 'default': 0}),
+    (('--throttle-rate',), {'type': 'float', 'dest': 'throttle_rate'}),
+    (('--throttle-prob',), {'type': 'float', 'dest': 'throttle_prob',
+        'default': 0}),
+    (('--drop-rate',), {'type': 'float', 'dest': 'drop_rate', 'default': 0}),
+]
+
+def main(argv):
+    parser = optparse.OptionParser(__usage__)
+    for opt in __options__:
+        parser.add_option(*opt[0], **opt[1])
+    opts, args = parser.parse_args(argv)
+    try:
+        mix = parse_mix(opts.mix)
+    except ValueError, e:
+        parser.error("Invalid mix %r: %s" % (opts.mix, e))
+
+    server = None
+    if opts.url:
+        users = [(opts.username, opts.password)]
+    else:
+        server = mockserver.MockDeliciousServer(latency=opts.latency,
+            jitter=opts.jitter, throttle_rate=opts.throttle_rate,
+            throttle_prob=opts.throttle_prob, retry_after=0,
+            drop_rate=opts.drop_rate, seed=opts.seed)
+        users = []
+        for n in range(opts.clients):
+            user = 'load%i' % n
+            server.add_user(user, opts.password,
+                mockserver.synthetic_posts(opts.posts, opts.seed + n))
+            users.append((user, opts.password))
+        opts.url, opts.feeds_url = server.api_url, server.feeds_url
+        server.start()
+        print >>sys.stderr, "Started mock server at %s" % server.host
+
+    try:
+        report = run(opts.url, opts.clients, opts.duration, opts.operations,
+            mix, users, opts.feeds_url, opts.wait, opts.batch, opts.seed,
+            opts.pool)
+    finally:
+        if server:
+            server.stop()
+    if opts.json:
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        print format_report(report)
+
+def _main():
+    try:
+        sys.exit(main(sys.argv[1:]))
+    except KeyboardInterrupt:
+        print >>sys.stderr, "User interrupt"
+
+if __name__ == '__main__':
+    _main()
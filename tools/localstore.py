@@ -0,0 +1,367 @@
+"""Local copy of a del.icio.us collection, kept up to date by the client.
+
+`LocalStore` holds the post, tag and bundle lists as cached by `dlcs` in
+~/.dlcs-posts.xml, ~/.dlcs-tags.xml and (optionally) a bundles file, with
+indexes by URL and by tag. Given to a ``DeliciousAPI`` as ``store``, every
+successful call that changes the collection (posts/add, posts/delete,
+tags/rename, tags/delete, tags/bundles/set, tags/bundles/delete) is applied
+to the store as well, so the cached files stay consistent without fetching
+the collection again::
+
+    store = LocalStore(posts_file, tags_file)
+    api = DeliciousAPI(user, passwd, store=store)
+    api.tags_rename('pyhton', 'python')
+    store.save()
+
+Lists are only maintained if their file existed when the store was loaded,
+a partial list is never written.
+"""
+import os
+import time
+import threading
+from xml.sax.saxutils import quoteattr
+
+try:
+    # Python >= 2.5
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = dict
+
+from pydelicious import dlcs_parse_xml, ISO_8601_DATETIME
+try:
+    from pydelicious.tools import bookmarks
+except ImportError:
+    import bookmarks
+
+
+class LocalStore:
+
+    """The cached lists of a collection with indexes, see the module
+    documentation.
+
+    Some attributes (None if the list is not available):
+    :posts: ordered dictionary of posts by URL
+    :tags: dictionary of tag counts by tag
+    :bundles: dictionary of space separated tags by bundle name
+    :tagged: index with the set of URLs for each tag
+    :changed: names of the lists changed since the last save
+
+    `apply` and `save` hold ``lock``, so one store can be shared by the
+    threads of a client.
+    """
+
+    def __init__(self, posts_file=None, tags_file=None, bundles_file=None,
+            autosave=False):
+        self.posts_file = posts_file
+        self.tags_file = tags_file
+        self.bundles_file = bundles_file
+        self.autosave = autosave
+        self.loaded = False
+        self.posts = self.tags = self.bundles = self.tagged = None
+        self.info = {}
+        self.changed = set()
+        self.mtimes = {}
+        self.lock = threading.Lock()
+
+    ### Loading and saving
+
+    def load(self):
+        "(Re)load all available lists from file and build the indexes."
+        self.posts = self.tags = self.bundles = self.tagged = None
+        if self.posts_file and os.path.exists(self.posts_file):
+            data = dlcs_parse_xml(open(self.posts_file))
+            self.info = dict([(k, v) for k, v in data.items() if k != 'posts'])
+            self.posts = OrderedDict()
+            self.tagged = {}
+            for post in data['posts']:
+                self.posts[post['href']] = post
+                self.index(post)
+        if self.tags_file and os.path.exists(self.tags_file):
+            self.tags = dict([(tag['tag'], int(tag['count']))
+                for tag in dlcs_parse_xml(open(self.tags_file))['tags']])
+        if self.bundles_file and os.path.exists(self.bundles_file):
+            self.bundles = dict([(b['name'], b.get('tags', ''))
+                for b in dlcs_parse_xml(open(self.bundles_file))['bundles']])
+        self.loaded = True
+        self.changed = set()
+        self.mtimes = self.get_mtimes()
+
+    def ensure_loaded(self):
+        "Load the lists, again if a file was replaced since (i.e. by dlcs)."
+        if not self.loaded or (not self.changed and self.stale()):
+            self.load()
+
+    def get_mtimes(self):
+        mtimes = {}
+        for fn in (self.posts_file, self.tags_file, self.bundles_file):
+            if fn and os.path.exists(fn):
+                mtimes[fn] = os.path.getmtime(fn)
+        return mtimes
+
+    def stale(self):
+        "Tell wether the files changed since they were loaded or saved."
+        return self.get_mtimes() != self.mtimes
+
+    def save(self):
+        "Write the changed lists to their files."
+        self.lock.acquire()
+        try:
+            self._save()
+        finally:
+            self.lock.release()
+
+    def _save(self):
+        if 'posts' in self.changed:
+            self.write(self.posts_file, lambda fl: bookmarks.write_posts_xml(
+                self.posts.itervalues(), fl, self.info.get('user', '')))
+        if 'tags' in self.changed:
+            self.write(self.tags_file, self.write_tags)
+        if 'bundles' in self.changed:
+            self.write(self.bundles_file, self.write_bundles)
+        if self.changed:
+            self.mtimes = self.get_mtimes()
+        self.changed = set()
+
+    def write(self, filename, writer):
+        "Call ``writer`` with a temporary file, then move it to ``filename``."
+        tmpfile = filename + '.tmp'
+        fl = open(tmpfile, 'w')
+        try:
+            writer(fl)
+        finally:
+            fl.close()
+        os.rename(tmpfile, filename)
+
+    def write_tags(self, fl):
+        fl.write('<?xml version="1.0" encoding="UTF-8"?>\n<tags>\n')
+        for tag in sorted(self.tags):
+            fl.write(_encode('  <tag count="%i" tag=%s />\n' % (
+                self.tags[tag], quoteattr(tag))))
+        fl.write('</tags>\n')
+
+    def write_bundles(self, fl):
+        fl.write('<?xml version="1.0" encoding="UTF-8"?>\n<bundles>\n')
+        for name in sorted(self.bundles):
+            fl.write(_encode('  <bundle name=%s tags=%s />\n' % (
+                quoteattr(name), quoteattr(self.bundles[name]))))
+        fl.write('</bundles>\n')
+
+    ### Indexes
+
+    def index(self, post):
+        for tag in post.get('tag', '').split():
+            self.tagged.setdefault(tag, set()).add(post['href'])
+
+    def unindex(self, post):
+        for tag in post.get('tag', '').split():
+            urls = self.tagged.get(tag)
+            if urls:
+                urls.discard(post['href'])
+                if not urls:
+                    del self.tagged[tag]
+
+    def count(self, tags, delta):
+        "Adjust the tag counts."
+        if self.tags is None:
+            return
+        for tag in tags:
+            count = self.tags.get(tag, 0) + delta
+            if count > 0:
+                self.tags[tag] = count
+            elif tag in self.tags:
+                del self.tags[tag]
+        self.changed.add('tags')
+
+    def get_tagged(self, tag):
+        "Return the posts with ``tag``."
+        return [self.posts[url] for url in self.tagged.get(tag, ())]
+
+    def find_tags(self, tags, ignore_case=False):
+        "Return the tags in the index matching any of ``tags``."
+        if not ignore_case:
+            return [tag for tag in tags if tag in self.tagged]
+        lower = set([tag.lower() for tag in tags])
+        return [tag for tag in self.tagged if tag.lower() in lower]
+
+    ### Planning
+
+    def plan_retag(self, remove=(), add=(), urls=None):
+        """Return the API calls, as a list of ``(path, params)``, that remove
+        the tags in ``remove`` from and add the tags in ``add`` to the posts
+        for ``urls``. Without ``urls`` the tags are removed from all posts.
+
+        Each removed tag that does not occur outside of ``urls`` takes one
+        ``tags/delete`` call, or one ``tags/rename`` if the tag is on exactly
+        the given posts and there are tags to add. Only the posts these calls
+        don't take care of are replaced with a ``posts/add`` each, using the
+        local copy of the post. Tags the user did not name are never renamed.
+        URLs not in the collection are ignored.
+        """
+        self.ensure_loaded()
+        if self.posts is None:
+            raise ValueError("Post list not available")
+        remove = [tag for tag in remove if tag in self.tagged]
+        add = [tag for tag in add if tag not in remove]
+        if urls is None:
+            urls = set()
+            for tag in remove:
+                urls.update(self.tagged[tag])
+        else:
+            urls = set([url for url in urls if url in self.posts])
+
+        calls = []
+        server = {} # server-side changes by old tag, None for delete
+        for tag in remove:
+            if not self.tagged[tag] <= urls:
+                continue
+            if add and self.tagged[tag] == urls and add not in server.values():
+                server[tag] = add
+                calls.append(('tags/rename', {'old': tag, 'new': " ".join(add)}))
+            else:
+                server[tag] = None
+                calls.append(('tags/delete', {'tag': tag}))
+
+        for url in self.posts:
+            # keep the order of the collection
+            if url not in urls:
+                continue
+            post = self.posts[url]
+            tags = post.get('tag', '').split()
+            wanted = _merge([t for t in tags if t not in remove], add)
+            result = []
+            for tag in tags:
+                result = _merge(result, server.get(tag, [tag]) or [])
+            if set(result) != set(wanted):
+                calls.append(('posts/add', {'url': url,
+                    'description': post.get('description', ''),
+                    'extended': post.get('extended', ''),
+                    'tags': " ".join(wanted), 'dt': post.get('time', ''),
+                    'shared': post.get('shared', 'yes'), 'replace': 'yes'}))
+        return calls
+
+    ### Changes
+
+    def apply(self, path, params):
+        """Apply the change made by a successful request to an API path with
+        the (UTF-8 encoded) parameters. Requests that don't change the
+        collection are ignored.
+        """
+        if path not in self.handlers:
+            return
+        params = dict([(k, _decode(v)) for k, v in params.items()])
+        self.lock.acquire()
+        try:
+            self.ensure_loaded()
+            getattr(self, self.handlers[path])(**params)
+            if self.autosave:
+                self._save()
+        finally:
+            self.lock.release()
+
+    handlers = {
+        'posts/add': 'add_post',
+        'posts/delete': 'delete_post',
+        'tags/rename': 'rename_tag',
+        'tags/delete': 'delete_tag',
+        'tags/bundles/set': 'set_bundle',
+        'tags/bundles/delete': 'delete_bundle',
+    }
+
+    def add_post(self, url, description, extended='', tags='', dt='',
+            shared='yes', replace='no', **kwds):
+        "Add or replace a post, see ``DeliciousAPI.posts_add``."
+        post = {'href': url, 'description': description,
+                'hash': md5(_encode(url)).hexdigest(),
+                'time': dt or time.strftime(ISO_8601_DATETIME, time.gmtime())}
+        tags = " ".join(tags.split())
+        if tags:
+            post['tag'] = tags
+        if extended:
+            post['extended'] = extended
+        if shared == 'no':
+            post['shared'] = 'no'
+        old = None
+        if self.posts is not None:
+            old = self.posts.get(url)
+            if old:
+                self.unindex(old)
+            self.posts[url] = post
+            self.index(post)
+            self.changed.add('posts')
+        if old:
+            self.count(old.get('tag', '').split(), -1)
+        self.count(tags.split(), 1)
+
+    def delete_post(self, url, **kwds):
+        "Remove a post, see ``DeliciousAPI.posts_delete``."
+        if self.posts is None or url not in self.posts:
+            return
+        post = self.posts.pop(url)
+        self.unindex(post)
+        self.changed.add('posts')
+        self.count(post.get('tag', '').split(), -1)
+
+    def retag(self, old, new):
+        "Replace tag ``old`` by the tags in list ``new`` on all posts."
+        if self.posts is not None:
+            for url in list(self.tagged.get(old, ())):
+                post = self.posts[url]
+                self.unindex(post)
+                tags = []
+                for tag in post['tag'].split():
+                    if tag == old:
+                        tags.extend([t for t in new if t not in tags])
+                    elif tag not in tags:
+                        tags.append(tag)
+                post['tag'] = " ".join(tags)
+                self.index(post)
+                self.changed.add('posts')
+        if self.tags is not None and old in self.tags:
+            # counts follow the posts when available, else approximate
+            count = self.tags.pop(old)
+            for tag in new:
+                if self.tagged is not None:
+                    self.tags[tag] = len(self.tagged.get(tag, ()))
+                else:
+                    self.tags[tag] = self.tags.get(tag, 0) + count
+            self.changed.add('tags')
+
+    def rename_tag(self, old, new, **kwds):
+        "Rename a tag (to one or more tags), see ``DeliciousAPI.tags_rename``."
+        self.retag(old, new.split())
+
+    def delete_tag(self, tag, **kwds):
+        "Remove a tag from all posts, see ``DeliciousAPI.tags_delete``."
+        self.retag(tag, [])
+
+    def set_bundle(self, bundle, tags, **kwds):
+        "See ``DeliciousAPI.bundles_set``."
+        if self.bundles is not None:
+            self.bundles[bundle] = " ".join(tags.split())
+            self.changed.add('bundles')
+
+    def delete_bundle(self, bundle, **kwds):
+        "See ``DeliciousAPI.bundles_delete``."
+        if self.bundles is not None and bundle in self.bundles:
+            del self.bundles[bundle]
+            self.changed.add('bundles')
+
+
+def _merge(tags, more):
+    "Return the list ``tags`` extended with the new tags in ``more``."
+    return tags + [tag for tag in more if tag not in tags]
+
+def _encode(data):
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    return data
+
+def _decode(data):
+    if isinstance(data, str):
+        return data.decode('utf-8')
+    return data
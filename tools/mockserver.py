@@ -0,0 +1,679 @@
+#!/usr/bin/env python
+"""mockserver - A local del.icio.us server for load and regression testing.
+
+Implements the v1 API paths of ``DeliciousAPI.paths`` and the v2 feeds of
+``delicious_v2_feeds`` on top of in-memory collections, so the full client
+path (openers, authorization, connection pooling, 503 handling, retries and
+rate limiting) can be tested and benchmarked offline::
+
+    % dlcs_mockserver --posts 10000 --latency .05 --throttle-rate 1
+
+Or from Python::
+
+    server = MockDeliciousServer(latency=.01, throttle_rate=2)
+    server.add_user('testUser', 'testPwd', synthetic_posts(1000))
+    server.start()
+    api = DeliciousAPI('testUser', 'testPwd', api_url=server.api_url,
+        build_opener=server.build_opener)
+    ...
+    server.stop()
+
+Faults can be injected by rate (latency, jitter, throttle_rate,
+throttle_prob, drop_rate) or for the next requests only (`throttle_next`,
+`drop_next`). Throttled requests get a 503 with a Retry-After header,
+dropped connections are closed without an answer.
+"""
+import sys
+import cgi
+import time
+import random
+import optparse
+import threading
+import urllib
+import re
+import BaseHTTPServer
+import SocketServer
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+    # Python >= 2.5
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import pydelicious
+from pydelicious import ISO_8601_DATETIME
+
+
+DEFAULT_USER = 'testUser'
+DEFAULT_PASSWD = 'testPwd'
+
+WORDS = ('python', 'web', 'news', 'music', 'design', 'reference', 'howto',
+    'tools', 'linux', 'art', 'food', 'travel', 'science', 'video', 'blog',
+    'programming', 'photo', 'books', 'games', 'research')
+
+
+### Collections
+
+def synthetic_posts(count, seed=0, tags=50, start=1293840000, interval=3600):
+    """Generate ``count`` posts with up to four tags from a vocabulary of
+    ``tags`` words, one post per ``interval`` seconds before ``start``,
+    newest first. The same seed gives the same posts.
+    """
+    rnd = random.Random(seed)
+    vocabulary = ['%s%i' % (WORDS[i % len(WORDS)], i // len(WORDS))
+        for i in range(tags)]
+    for i in xrange(count):
+        href = 'http://example.org/%i/%i' % (seed, i)
+        post = {'href': href,
+            'description': 'Example page %i' % i,
+            'tag': " ".join(rnd.sample(vocabulary, rnd.randint(1, 4))),
+            'time': time.strftime(ISO_8601_DATETIME,
+                time.gmtime(start - i * interval)),
+            'hash': md5(href).hexdigest(),
+            'meta': md5(str(i)).hexdigest()}
+        if i % 3 == 0:
+            post['extended'] = 'Notes on page %i' % i
+        if i % 10 == 0:
+            post['shared'] = 'no'
+        yield post
+
+
+class Collection:
+
+    """The bookmarks of one user, answering v1 API requests."""
+
+    def __init__(self, user, posts=(), bundles=None):
+        self.user = user
+        self.posts = {}
+        for post in posts:
+            self.posts[post['href']] = post
+        self.bundles = dict(bundles or {})
+        self.update = time.time()
+        self.lock = threading.Lock()
+        self._sorted = None
+
+    def sorted_posts(self):
+        "Return the posts, newest first."
+        if self._sorted is None:
+            self._sorted = sorted(self.posts.values(),
+                key=lambda post: post.get('time', ''), reverse=True)
+        return self._sorted
+
+    def changed(self):
+        self._sorted = None
+        self.update = time.time()
+
+    def request(self, path, params):
+        "Return the XML answer for an API path."
+        handler = getattr(self, 'do_' + path.replace('/', '_'), None)
+        if not handler:
+            return result('unknown path')
+        self.lock.acquire()
+        try:
+            return handler(**params)
+        except TypeError, e:
+            # missing or unknown arguments
+            return result('something went wrong: %s' % e)
+        finally:
+            self.lock.release()
+
+    ### Tags
+
+    def tag_counts(self):
+        counts = {}
+        for post in self.posts.itervalues():
+            for tag in post.get('tag', '').split():
+                counts[tag] = counts.get(tag, 0) + 1
+        return counts
+
+    def do_tags_get(self):
+        return element_list('tags', 'tag', [{'tag': tag, 'count': count}
+            for tag, count in sorted(self.tag_counts().items())])
+
+    def do_tags_delete(self, tag):
+        return self.retag(tag, [])
+
+    def do_tags_rename(self, old, new):
+        return self.retag(old, new.split())
+
+    def retag(self, old, new):
+        for post in self.posts.itervalues():
+            tags = post.get('tag', '').split()
+            if old in tags:
+                # as the local stores do: keep the first of each tag
+                retagged = []
+                for tag in tags:
+                    if tag == old:
+                        retagged.extend([t for t in new if t not in retagged])
+                    elif tag not in retagged:
+                        retagged.append(tag)
+                post['tag'] = " ".join(retagged)
+        self.changed()
+        return result('done')
+
+    ### Posts
+
+    def do_posts_update(self):
+        return '<update time="%s" />' % format_time(self.update)
+
+    def do_posts_dates(self, tag=''):
+        dates = {}
+        for post in self.filter(tag):
+            day = post.get('time', '')[:10]
+            dates[day] = dates.get(day, 0) + 1
+        return element_list('dates', 'date', [{'date': day, 'count': count}
+            for day, count in sorted(dates.items(), reverse=True)],
+            {'tag': tag, 'user': self.user})
+
+    def filter(self, tag=''):
+        "Return the posts with all of the (space separated) tags."
+        tags = tag.split()
+        posts = self.sorted_posts()
+        if tags:
+            posts = [post for post in posts
+                if not [t for t in tags if t not in post.get('tag', '').split()]]
+        return posts
+
+    def do_posts_get(self, tag='', dt='', url='', hashes='', meta='no'):
+        if url:
+            posts = [self.posts[url]] if url in self.posts else []
+        elif hashes:
+            hashes = set(hashes.split())
+            posts = [post for post in self.sorted_posts()
+                if post['hash'] in hashes]
+        else:
+            posts = self.filter(tag)
+            if not dt and posts:
+                dt = posts[0]['time']
+            posts = [post for post in posts
+                if post.get('time', '')[:10] == dt[:10]]
+        return self.post_list(posts, meta == 'yes', {'dt': dt[:10],
+            'tag': tag, 'user': self.user})
+
+    def do_posts_recent(self, tag='', count='15'):
+        count = min(int(count), 100)
+        return self.post_list(self.filter(tag)[:count], False,
+            {'tag': tag, 'user': self.user})
+
+    def do_posts_all(self, tag='', start='0', results=None, fromdt='',
+            todt='', meta='no', hashes=None):
+        if hashes is not None:
+            return element_list('posts', 'post', [{'url': post['hash'],
+                'meta': post.get('meta', '')} for post in self.sorted_posts()])
+        posts = self.filter(tag)
+        if fromdt:
+            posts = [post for post in posts if post.get('time', '') >= fromdt]
+        if todt:
+            posts = [post for post in posts if post.get('time', '') <= todt]
+        total = len(posts)
+        start = int(start)
+        if results:
+            posts = posts[start:start + int(results)]
+        else:
+            posts = posts[start:]
+        return self.post_list(posts, meta == 'yes', {'tag': tag,
+            'user': self.user, 'update': format_time(self.update),
+            'total': total})
+
+    def post_list(self, posts, meta, attrs):
+        keys = ['href', 'description', 'extended', 'tag', 'time', 'shared',
+            'hash']
+        if meta:
+            keys.append('meta')
+        return element_list('posts', 'post', [dict([(key, post[key])
+            for key in keys if post.get(key)]) for post in posts], attrs)
+
+    def do_posts_add(self, url, description, extended='', tags='', dt='',
+            replace='yes', shared='yes'):
+        if url in self.posts and replace == 'no':
+            return result('item already exists')
+        post = {'href': url, 'description': description,
+            'tag': " ".join(tags.split()), 'hash': md5(url).hexdigest(),
+            'time': dt or format_time(time.time())}
+        post['meta'] = md5(repr(sorted(post.items()))).hexdigest()
+        if extended:
+            post['extended'] = extended
+        if shared == 'no':
+            post['shared'] = 'no'
+        self.posts[url] = post
+        self.changed()
+        return result('done')
+
+    def do_posts_delete(self, url):
+        if url not in self.posts:
+            return result('item not found')
+        del self.posts[url]
+        self.changed()
+        return result('done')
+
+    ### Bundles
+
+    def do_tags_bundles_all(self, bundle=''):
+        return element_list('bundles', 'bundle', [{'name': name,
+            'tags': tags} for name, tags in sorted(self.bundles.items())
+            if not bundle or bundle == name])
+
+    def do_tags_bundles_set(self, bundle, tags):
+        self.bundles[bundle] = " ".join(tags.split())
+        return '<result>ok</result>'
+
+    def do_tags_bundles_delete(self, bundle):
+        self.bundles.pop(bundle, None)
+        return result('done')
+
+
+def format_time(seconds):
+    return time.strftime(ISO_8601_DATETIME, time.gmtime(seconds))
+
+def result(code):
+    return '<result code=%s />' % quoteattr(code)
+
+def element_list(root, name, items, attrs=None):
+    "Return an XML document with an empty element for each item."
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>']
+    lines.append('<%s%s>' % (root, attributes(attrs or {})))
+    for item in items:
+        lines.append('  <%s%s />' % (name, attributes(item)))
+    lines.append('</%s>' % root)
+    return "\n".join(lines)
+
+def attributes(attrs):
+    return "".join([' %s=%s' % (k, quoteattr(_encode(v)))
+        for k, v in sorted(attrs.items())])
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+### Feeds
+
+def _feed_patterns():
+    """Compile the paths of the v2 feed templates to regular expressions,
+    the most specific first."""
+    patterns = []
+    for name, template in pydelicious.delicious_v2_feeds.items():
+        path = template.split('?')[0]
+        parts = re.split(r'%\((\w+)\)s', path)
+        regex = ''
+        for i, part in enumerate(parts):
+            if i % 2:
+                regex += '(?P<%s>[^/]+)' % part
+            else:
+                regex += re.escape(part)
+        literal = len("".join(parts[0::2]))
+        patterns.append((-literal, name, re.compile(regex + '$')))
+    patterns.sort()
+    return [(name, regex) for key, name, regex in patterns]
+
+feed_patterns = _feed_patterns()
+
+def match_feed(path):
+    "Return the feed name and the parameters in a feed path, or None."
+    for name, regex in feed_patterns:
+        match = regex.match(path)
+        if match:
+            params = match.groupdict()
+            for key, value in params.items():
+                params[key] = urllib.unquote_plus(value)
+            if params.get('format', 'json') in ('json', 'rss'):
+                return name, params
+
+
+class MockFeeds:
+
+    """Answers v2 feed requests from the collections of a server."""
+
+    def __init__(self, collections):
+        self.collections = collections
+
+    def all_posts(self):
+        posts = []
+        for collection in self.collections.values():
+            posts.extend([(post, collection.user) for post in
+                collection.sorted_posts() if post.get('shared') != 'no'])
+        posts.sort(key=lambda item: item[0].get('time', ''), reverse=True)
+        return posts
+
+    def user_posts(self, username, private=False):
+        collection = self.collections.get(username)
+        if not collection:
+            return []
+        return [(post, username) for post in collection.sorted_posts()
+            if private or post.get('shared') != 'no']
+
+    def request(self, name, params, query):
+        "Return the content type and body for a feed."
+        format = params.pop('format', 'json')
+        count = query.get('count', '15')
+        if name == 'urlinfo':
+            format = 'json'
+        private = 'key' in params or 'private' in query
+        tags = params.get('tag', '').replace('+', ' ').split()
+
+        if name in ('user_info', 'user_tags', 'urlinfo'):
+            return self.info(name, params)
+        elif name.startswith('user_network') or name in ('user_subscription',
+                'user_inbox'):
+            posts = []
+        elif name.startswith('user'):
+            posts = self.user_posts(params['username'], private)
+        elif name == 'url':
+            posts = [item for item in self.all_posts()
+                if item[0]['hash'] == params['urlmd5']]
+        else:
+            posts = self.all_posts()
+        if tags:
+            posts = [item for item in posts
+                if not [t for t in tags if t not in item[0].get('tag', '').split()]]
+        if count != 'all':
+            posts = posts[:min(int(count), 100)]
+
+        if format == 'rss':
+            return 'text/xml', rss(name, posts)
+        return 'application/json', json.dumps([{'u': post['href'],
+            'd': post.get('description', ''), 'n': post.get('extended', ''),
+            't': post.get('tag', '').split(), 'dt': post.get('time', ''),
+            'a': user} for post, user in posts])
+
+    def info(self, name, params):
+        if name == 'urlinfo':
+            posts = [item for item in self.all_posts()
+                if item[0]['hash'] == params['urlmd5']]
+            tags = {}
+            for post, user in posts:
+                for tag in post.get('tag', '').split():
+                    tags[tag] = tags.get(tag, 0) + 1
+            data = posts and [{'hash': params['urlmd5'],
+                'url': posts[0][0]['href'],
+                'title': posts[0][0].get('description', ''),
+                'total_posts': len(posts), 'top_tags': tags}] or []
+        else:
+            collection = self.collections.get(params['username'])
+            if not collection:
+                data = {}
+            elif name == 'user_tags':
+                data = collection.tag_counts()
+            else:
+                data = [{'id': 'items', 'n': len(collection.posts)}]
+        return 'application/json', json.dumps(data)
+
+
+def rss(name, posts):
+    items = []
+    for post, user in posts:
+        items.append('<item><title>%s</title><link>%s</link>'
+            '<dc:creator>%s</dc:creator><pubDate>%s</pubDate>%s</item>' % (
+            escape(post.get('description', '')), escape(post['href']),
+            escape(user), escape(post.get('time', '')),
+            "".join(['<category>%s</category>' % escape(tag)
+                for tag in post.get('tag', '').split()])))
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<rss version="2.0" xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        '<channel><title>%s</title>%s</channel></rss>' % (escape(name),
+            "".join(items)))
+
+
+### Server
+
+class MockRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    "Serves the v1 API below /v1/ and the v2 feeds below /v2/."
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    server_version = 'MockDelicious/' + pydelicious.__version__
+
+    def do_GET(self):
+        server = self.server
+        path, query = urllib.splitquery(self.path)
+        query = dict([(k, v[-1]) for k, v in
+            cgi.parse_qs(query or '', keep_blank_values=True).items()])
+
+        fault = server.fault()
+        latency = server.latency + random.uniform(0, server.jitter)
+        if latency:
+            time.sleep(latency)
+        if fault == 'drop':
+            # close the connection without an answer
+            self.close_connection = 1
+            return
+
+        if path.startswith('/v1/'):
+            user = self.authorize()
+            if not user:
+                self.send_answer(401, 'text/plain', 'Unauthorized')
+                return
+            if fault == 'throttle' or server.throttle(user):
+                self.send_answer(503, 'text/plain', 'Throttled',
+                    {'Retry-After': str(server.retry_after)})
+                return
+            body = server.collections[user].request(path[4:], query)
+            self.send_answer(200, 'text/xml', body)
+
+        elif path.startswith('/v2/'):
+            match = match_feed(path[4:])
+            if not match:
+                self.send_answer(404, 'text/plain', 'No such feed')
+                return
+            if fault == 'throttle':
+                self.send_answer(503, 'text/plain', 'Throttled',
+                    {'Retry-After': str(server.retry_after)})
+                return
+            content_type, body = server.feeds.request(match[0], match[1],
+                query)
+            self.send_answer(200, content_type, body)
+
+        else:
+            self.send_answer(404, 'text/plain', 'Not found')
+
+    def authorize(self):
+        "Return the user for valid Basic credentials, or None."
+        auth = self.headers.get('Authorization', '')
+        if not auth.startswith('Basic '):
+            return None
+        try:
+            user, passwd = auth[6:].decode('base64').split(':', 1)
+        except ValueError:
+            return None
+        if user in self.server.passwords and \
+                self.server.passwords[user] == passwd:
+            return user
+
+    def send_answer(self, code, content_type, body, headers={}):
+        self.server.count(code)
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
+
+
+class MockDeliciousServer(SocketServer.ThreadingMixIn,
+        BaseHTTPServer.HTTPServer):
+
+    """A threaded HTTP server with del.icio.us collections per user.
+
+    Fault injection:
+    :latency: seconds to wait before each answer
+    :jitter: up to this many seconds of random extra latency
+    :throttle_rate: requests per second per user before answering 503
+    :throttle_prob: chance of answering any request with 503
+    :retry_after: seconds in the Retry-After header of a 503
+    :drop_rate: chance of closing the connection instead of answering
+
+    ``stats`` counts the answers by status code, and 'dropped'.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, jitter=0,
+            throttle_rate=None, throttle_prob=0, retry_after=1, drop_rate=0,
+            seed=None, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MockRequestHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.throttle_prob = throttle_prob
+        self.retry_after = retry_after
+        self.drop_rate = drop_rate
+        self.verbose = verbose
+        self.random = random.Random(seed)
+        self.collections = {}
+        self.passwords = {}
+        self.feeds = MockFeeds(self.collections)
+        self.lock = threading.Lock()
+        self.lastcall = {}
+        self.faults = []
+        self.stats = {}
+        self.thread = None
+
+    def add_user(self, user=DEFAULT_USER, passwd=DEFAULT_PASSWD, posts=(),
+            bundles=None):
+        "Add a user and return the `Collection`."
+        self.passwords[user] = passwd
+        collection = self.collections[user] = Collection(user, posts, bundles)
+        return collection
+
+    def get_host(self):
+        return '%s:%i' % self.server_address
+    host = property(get_host)
+
+    def get_api_url(self):
+        return 'http://%s/v1' % self.host
+    api_url = property(get_api_url)
+
+    def get_feeds_url(self):
+        return 'http://%s/v2/' % self.host
+    feeds_url = property(get_feeds_url)
+
+    def build_opener(self, user, passwd, pool=None):
+        "An opener for this server, to use as ``DeliciousAPI`` build_opener."
+        return pydelicious.build_api_opener(self.host, user, passwd, pool=pool)
+
+    ### Faults
+
+    def throttle_next(self, count=1):
+        "Answer the next ``count`` requests with 503."
+        self.lock.acquire()
+        self.faults.extend(['throttle'] * count)
+        self.lock.release()
+
+    def drop_next(self, count=1):
+        "Drop the connection of the next ``count`` requests."
+        self.lock.acquire()
+        self.faults.extend(['drop'] * count)
+        self.lock.release()
+
+    def fault(self):
+        "Return the fault for this request: 'drop', 'throttle' or None."
+        self.lock.acquire()
+        try:
+            if self.faults:
+                fault = self.faults.pop(0)
+            elif self.drop_rate and self.random.random() < self.drop_rate:
+                fault = 'drop'
+            elif self.throttle_prob and \
+                    self.random.random() < self.throttle_prob:
+                fault = 'throttle'
+            else:
+                fault = None
+            if fault == 'drop':
+                self.stats['dropped'] = self.stats.get('dropped', 0) + 1
+            return fault
+        finally:
+            self.lock.release()
+
+    def throttle(self, user):
+        "Tell wether a request by ``user`` comes too soon after the last."
+        if not self.throttle_rate:
+            return False
+        self.lock.acquire()
+        try:
+            now = time.time()
+            if now - self.lastcall.get(user, 0) < 1.0 / self.throttle_rate:
+                return True
+            self.lastcall[user] = now
+            return False
+        finally:
+            self.lock.release()
+
+    def count(self, code):
+        self.lock.acquire()
+        self.stats[code] = self.stats.get(code, 0) + 1
+        self.lock.release()
+
+    ### Running
+
+    def start(self):
+        "Serve from a daemon thread."
+        self.thread = threading.Thread(target=self.serve_forever, args=(.05,))
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+### Main
+
+__usage__ = "%prog [options]"
+
+__options__ = [
+    (('-H', '--host'), {'default': '127.0.0.1'}),
+    (('-P', '--port'), {'type': 'int', 'default': 8080}),
+    (('-u', '--username'), {'default': DEFAULT_USER}),
+    (('-p', '--password'), {'default': DEFAULT_PASSWD}),
+    (('-n', '--posts'), {'type': 'int', 'default': 1000,
+        'help': "Number of synthetic posts [%default]"}),
+    (('--seed',), {'type': 'int', 'default': 0}),
+    (('--latency',), {'type': 'float', 'default': 0}),
+    (('--jitter',), {'type': 'float', 'default': 0}),
+    (('--throttle-rate',), {'type': 'float', 'dest': 'throttle_rate',
+        'help': "Requests per second per user before answering 503"}),
+    (('--throttle-prob',), {'type': 'float', 'dest': 'throttle_prob',
+        'default': 0}),
+    (('--retry-after',), {'type': 'int', 'dest': 'retry_after', 'default': 1}),
+    (('--drop-rate',), {'type': 'float', 'dest': 'drop_rate', 'default': 0}),
+    (('-v', '--verbose'), {'action': 'store_true', 'default': False}),
+]
+
+def main(argv):
+    parser = optparse.OptionParser(__usage__)
+    for opt in __options__:
+        parser.add_option(*opt[0], **opt[1])
+    opts, args = parser.parse_args(argv)
+
+    server = MockDeliciousServer((opts.host, opts.port), opts.latency,
+        opts.jitter, opts.throttle_rate, opts.throttle_prob,
+        opts.retry_after, opts.drop_rate, opts.seed, opts.verbose)
+    server.add_user(opts.username, opts.password,
+        synthetic_posts(opts.posts, opts.seed))
+    print >>sys.stderr, "Serving %i posts for %s at %s and %s" % (
+        opts.posts, opts.username, server.api_url, server.feeds_url)
+    server.serve_forever()
+
+def _main():
+    try:
+        sys.exit(main(sys.argv[1:]))
+    except KeyboardInterrupt:
+        print >>sys.stderr, "User interrupt"
+
+if __name__ == '__main__':
+    _main()
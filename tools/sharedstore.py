@@ -0,0 +1,282 @@
+"""Collections of many users in one local database.
+
+`SharedStore` keeps the posts of any number of accounts in a SQLite file.
+Each URL is stored once, keyed by its MD5 digest (the hash attribute of a
+post, and the ``urlmd5`` of the url feeds), together with the first
+description seen for it. Post rows per user refer to the URL by hash, and
+only keep a description of their own if it differs::
+
+    store = SharedStore(expanduser('~/.dlcs-shared.db'))
+    store.import_posts('alice', bookmarks.read_posts(open('alice.xml')))
+    store.import_posts('bob', bookmarks.read_posts(open('bob.xml')))
+    for user, score, common, total in store.mates('alice'):
+        ...
+
+Queries across users, like who else saved a URL or the `mates` of a user,
+are joins on the hash instead of feed requests. `UserStore` applies the
+changes made through a ``DeliciousAPI`` to the posts of one user, like
+`LocalStore`.
+"""
+import math
+import time
+from itertools import islice
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from pydelicious import ISO_8601_DATETIME
+try:
+    from pydelicious.tools import bookmarks
+except ImportError:
+    import bookmarks
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS urls (
+    hash TEXT PRIMARY KEY,
+    href TEXT NOT NULL,
+    description TEXT);
+CREATE TABLE IF NOT EXISTS posts (
+    user TEXT NOT NULL,
+    hash TEXT NOT NULL REFERENCES urls (hash),
+    description TEXT,
+    extended TEXT,
+    tag TEXT,
+    time TEXT,
+    shared INTEGER NOT NULL DEFAULT 1,
+    meta TEXT,
+    PRIMARY KEY (user, hash));
+CREATE INDEX IF NOT EXISTS posts_hash ON posts (hash);
+"""
+
+INSERT_URL = "INSERT OR IGNORE INTO urls (hash, href, description) " \
+    "VALUES (?, ?, ?)"
+
+# the description is left out if the URL has the same
+INSERT_POST = "INSERT OR REPLACE INTO posts (user, hash, description, " \
+    "extended, tag, time, shared, meta) VALUES (?, ?, NULLIF(?, " \
+    "(SELECT description FROM urls WHERE hash = ?)), ?, ?, ?, ?, ?)"
+
+SELECT_POSTS = "SELECT urls.href, COALESCE(posts.description, " \
+    "urls.description), posts.extended, posts.tag, posts.time, " \
+    "posts.shared, posts.hash, posts.meta FROM posts JOIN urls " \
+    "ON urls.hash = posts.hash"
+
+BATCH_SIZE = 1000
+"Posts inserted per statement by `SharedStore.import_posts`"
+
+
+class SharedStore:
+
+    """Posts of many users with deduplicated URLs, see the module
+    documentation. The database is opened on first use.
+    """
+
+    def __init__(self, filename):
+        if sqlite3 is None:
+            raise ImportError, "SharedStore needs the sqlite3 module"
+        self.filename = filename
+        self.db = None
+
+    def connect(self):
+        if not self.db:
+            self.db = sqlite3.connect(self.filename)
+            self.db.create_function('log', 1, math.log)
+            self.db.executescript(SCHEMA)
+        return self.db
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    ### Writing
+
+    def import_posts(self, user, posts, replace=True):
+        """Store the posts of ``user`` from any iterable, replacing those
+        stored before unless ``replace`` is false. Returns the number of
+        posts read.
+        """
+        db = self.connect()
+        count = 0
+        try:
+            if replace:
+                db.execute("DELETE FROM posts WHERE user = ?", (user,))
+            posts = iter(posts)
+            while True:
+                rows = [_row(user, post) for post in islice(posts, BATCH_SIZE)]
+                if not rows:
+                    break
+                db.executemany(INSERT_URL, [(row[1], row[-1], row[2])
+                    for row in rows])
+                db.executemany(INSERT_POST, [row[:3] + (row[1],) + row[3:-1]
+                    for row in rows])
+                count += len(rows)
+            if replace:
+                self.prune()
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        return count
+
+    def add_post(self, user, post):
+        "Add or replace one post of ``user``."
+        self.import_posts(user, [post], replace=False)
+
+    def delete_post(self, user, url):
+        db = self.connect()
+        db.execute("DELETE FROM posts WHERE user = ? AND hash = ?",
+            (user, bookmarks.post_hash({'href': url})))
+        self.prune()
+        db.commit()
+
+    def delete_user(self, user):
+        self.import_posts(user, [])
+
+    def prune(self):
+        "Remove the URLs no user has a post for."
+        self.connect().execute("DELETE FROM urls WHERE hash NOT IN "
+            "(SELECT hash FROM posts)")
+
+    ### Reading
+
+    def users(self):
+        return [row[0] for row in self.connect().execute(
+            "SELECT DISTINCT user FROM posts ORDER BY user")]
+
+    def posts(self, user):
+        "Yield the posts of ``user``, newest first."
+        for row in self.connect().execute(SELECT_POSTS + " WHERE "
+                "posts.user = ? ORDER BY posts.time DESC", (user,)):
+            yield _post(row)
+
+    def get_post(self, user, url):
+        "Return the post of ``user`` for ``url``, or None."
+        for row in self.connect().execute(SELECT_POSTS + " WHERE "
+                "posts.user = ? AND posts.hash = ?", (user,
+                bookmarks.post_hash({'href': url}))):
+            return _post(row)
+
+    def url_users(self, url):
+        "Return the users with a public post for ``url``."
+        return [row[0] for row in self.connect().execute("SELECT user FROM "
+            "posts WHERE hash = ? AND shared = 1 ORDER BY user",
+            (bookmarks.post_hash({'href': url}),))]
+
+    def stats(self):
+        "Return the number of users, URLs and posts."
+        db = self.connect()
+        return {'users': db.execute(
+                "SELECT COUNT(DISTINCT user) FROM posts").fetchone()[0],
+            'urls': db.execute("SELECT COUNT(*) FROM urls").fetchone()[0],
+            'posts': db.execute("SELECT COUNT(*) FROM posts").fetchone()[0]}
+
+    def mates(self, user, max_mates=15, min_bookmarks=1, min_common=1):
+        """Return the users with the most public posts in common with
+        ``user``, as a list of ``(user, score, common, total)`` by score.
+        URLs saved by few users weigh more, as in ``dlcs mates``.
+        """
+        rows = self.connect().execute("""
+            SELECT other.user,
+                SUM(1.0 / log((SELECT COUNT(*) FROM posts
+                    WHERE posts.hash = mine.hash AND posts.shared = 1) + 1)),
+                COUNT(*),
+                (SELECT COUNT(*) FROM posts WHERE posts.user = other.user)
+            FROM posts AS mine JOIN posts AS other
+                ON other.hash = mine.hash AND other.user != mine.user
+            WHERE mine.user = ? AND other.shared = 1
+            GROUP BY other.user HAVING COUNT(*) >= ?""", (user, min_common))
+        mates = [(other, weight * common / total, common, total)
+            for other, weight, common, total in rows
+            if total >= min_bookmarks]
+        mates.sort(key=lambda mate: mate[1], reverse=True)
+        return mates[:max_mates]
+
+    def user(self, user):
+        "Return the `UserStore` for ``user``."
+        return UserStore(self, user)
+
+
+class UserStore:
+
+    """The posts of one user in a `SharedStore`, kept up to date with the
+    changes made by a ``DeliciousAPI`` given this as ``store``. Changes are
+    committed right away.
+    """
+
+    def __init__(self, shared, user):
+        self.shared = shared
+        self.user = user
+
+    def apply(self, path, params):
+        "Apply the change made by a successful request, see `LocalStore`."
+        params = dict([(k, _decode(v)) for k, v in params.items()])
+        if path == 'posts/add':
+            self.shared.add_post(self.user, {'href': params['url'],
+                'description': params.get('description', ''),
+                'extended': params.get('extended', ''),
+                'tag': " ".join(params.get('tags', '').split()),
+                'time': params.get('dt') or time.strftime(ISO_8601_DATETIME,
+                    time.gmtime()),
+                'shared': params.get('shared', 'yes')})
+        elif path == 'posts/delete':
+            self.shared.delete_post(self.user, params['url'])
+        elif path == 'tags/rename':
+            self.retag(params['old'], params['new'].split())
+        elif path == 'tags/delete':
+            self.retag(params['tag'], [])
+
+    def retag(self, old, new):
+        """Replace tag ``old`` by the tags in list ``new`` on all posts.
+        Returns the number of posts changed."""
+        db = self.shared.connect()
+        pattern = '% ' + _like_escape(old) + ' %'
+        rows = db.execute("SELECT hash, tag FROM posts WHERE user = ? AND "
+            "' ' || tag || ' ' LIKE ? ESCAPE '\\'", (self.user, pattern))
+        changes = []
+        for hash, tag in rows.fetchall():
+            tags = []
+            for t in tag.split():
+                if t == old:
+                    tags.extend([n for n in new if n not in tags])
+                elif t not in tags:
+                    tags.append(t)
+            changes.append((" ".join(tags), self.user, hash))
+        db.executemany("UPDATE posts SET tag = ? WHERE user = ? AND hash = ?",
+            changes)
+        db.commit()
+        return len(changes)
+
+
+def _row(user, post):
+    "Return the row for a post, with its URL appended."
+    return (user, bookmarks.post_hash(post),
+        _decode(post.get('description', '')),
+        _decode(post.get('extended') or None), _decode(post.get('tag', '')),
+        post.get('time'), int(post.get('shared', 'yes') != 'no'),
+        post.get('meta'), _decode(post['href']))
+
+def _post(row):
+    post = {}
+    for key, value in zip(('href', 'description', 'extended', 'tag', 'time',
+            'shared', 'hash', 'meta'), row):
+        if key == 'shared':
+            if not value:
+                post['shared'] = 'no'
+        elif value:
+            post[key] = value
+    return post
+
+def _like_escape(text):
+    "Escape the LIKE wildcards in ``text``, for ``ESCAPE '\\'``."
+    for char in '\\%_':
+        text = text.replace(char, '\\' + char)
+    return text
+
+def _decode(data):
+    if isinstance(data, str):
+        return data.decode('utf-8')
+    return data
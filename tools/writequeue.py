@@ -0,0 +1,311 @@
+"""writequeue - Queue changes to a del.icio.us collection and send them later.
+
+Mutating API calls (see DLCS_IDEMPOTENT_PATHS for the others) made through
+`queued_api_request` are appended to a `WriteQueue`, a log file that is
+synced to disk before the call returns, and answered as successful right
+away. With a local store they are applied to the store as usual::
+
+    queue = WriteQueue(expanduser('~/.dlcs-queue'))
+    api = DeliciousAPI(user, passwd, store=store,
+        api_request=queued_api_request(queue))
+    api.posts_add(url, description, tags='queued')   # returns immediately
+
+`WriteQueue.flush` sends the queued calls through another API instance in
+batches, with superseded calls for the same URL or bundle left out, and
+retries throttled calls. It stops at network errors and when throttled
+too often, keeping the rest for the next flush. Calls the server refuses
+are moved to a '.failed' file next to the queue. A flush nobody waits for
+(i.e. in the background) can keep its `FlushResult` in a '.result' file,
+until `WriteQueue.pop_result` reports it.
+"""
+import os
+import time
+import fcntl
+from StringIO import StringIO
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import pydelicious
+from pydelicious import DLCS_IDEMPOTENT_PATHS, DeliciousError, \
+    PyDeliciousThrottled
+
+
+QUEUED_RESULT = '<?xml version="1.0" encoding="UTF-8"?>\n<result code="done" />\n'
+"Answer for queued calls"
+
+
+def queued_api_request(queue, api_request=None):
+    """Return an ``api_request`` function for `DeliciousAPI` that appends
+    mutating calls to ``queue``, and makes the others with ``api_request``
+    (default: `dlcs_api_request`).
+    """
+    def request(path, params=None, **kwds):
+        if path in DLCS_IDEMPOTENT_PATHS:
+            return (api_request or pydelicious.dlcs_api_request)(path,
+                params, **kwds)
+        queue.append(path, params or {})
+        return StringIO(QUEUED_RESULT)
+    return request
+
+
+class FlushResult:
+
+    """Outcome of `WriteQueue.flush`.
+
+    :sent: number of calls made
+    :coalesced: number of queued calls left out as superseded
+    :failed: list of ``(path, params, error message)`` refused by the server
+    :remaining: number of calls still queued
+    :error: the exception that stopped the flush, if any
+    """
+
+    def __init__(self):
+        self.sent = self.coalesced = self.remaining = 0
+        self.failed = []
+        self.error = None
+
+    def __str__(self):
+        return "%i sent, %i coalesced, %i failed, %i remaining" % (
+            self.sent, self.coalesced, len(self.failed), self.remaining)
+
+    def add(self, other):
+        "Add the outcome of a later flush."
+        self.sent += other.sent
+        self.coalesced += other.coalesced
+        self.failed.extend(other.failed)
+        self.remaining = other.remaining
+        self.error = other.error or self.error
+
+    def to_json(self):
+        return {'sent': self.sent, 'coalesced': self.coalesced,
+            'failed': self.failed, 'remaining': self.remaining,
+            'error': self.error and str(self.error) or None}
+
+def _flush_result(data):
+    "Return the `FlushResult` for its `FlushResult.to_json` data."
+    result = FlushResult()
+    result.sent, result.coalesced = data['sent'], data['coalesced']
+    result.failed = [tuple(failed) for failed in data['failed']]
+    result.remaining, result.error = data['remaining'], data['error']
+    return result
+
+
+class WriteQueue:
+
+    """Durable queue of API calls, one JSON object per line in ``filename``.
+    Appends and flushes from several processes are serialized with locks
+    on files next to it.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.failed_file = filename + '.failed'
+        self.result_file = filename + '.result'
+
+    ### Locking
+
+    def lock(self, suffix='.lock', block=True):
+        "Return the descriptor of the locked file, or None if busy."
+        fd = os.open(self.filename + suffix, os.O_WRONLY | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (not block and fcntl.LOCK_NB or 0))
+        except IOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def unlock(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    ### Log
+
+    def append(self, path, params):
+        "Append a call and sync it to disk."
+        entry = {'path': path, 'time': time.time(),
+            'params': dict([(k, _decode(v)) for k, v in params.items()])}
+        fd = self.lock()
+        try:
+            if os.path.exists(self.filename) and \
+                    os.path.getsize(self.filename):
+                fl = open(self.filename)
+                fl.seek(-1, 2)
+                if fl.read(1) != '\n':
+                    # end the torn line, see entries()
+                    open(self.filename, 'a').write('\n')
+                fl.close()
+            _write(self.filename, 'a', [entry])
+        finally:
+            self.unlock(fd)
+
+    def entries(self):
+        "Return the queued calls, oldest first."
+        if not os.path.exists(self.filename):
+            return []
+        entries = []
+        for line in open(self.filename):
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # torn write of a crashed process, never acknowledged
+                pass
+        return entries
+
+    def __len__(self):
+        return len(self.entries())
+
+    def remove(self, count, changed={}):
+        """Remove the first ``count`` calls, keeping those appended since.
+        ``changed`` has new versions of the calls kept, by index.
+        """
+        fd = self.lock()
+        try:
+            entries = self.entries()
+            for index, entry in changed.items():
+                entries[index] = entry
+            entries = entries[count:]
+            _write(self.filename + '.tmp', 'w', entries)
+            os.rename(self.filename + '.tmp', self.filename)
+        finally:
+            self.unlock(fd)
+
+    ### Sending
+
+    def flush(self, api, batch=100, tries=5, keep_result=False):
+        """Send the queued calls through ``api``, ``batch`` at a time, each
+        call tried up to ``tries`` times if throttled. Returns a
+        `FlushResult`, or None if another flush is running. With
+        ``keep_result`` the result is also added to the one kept for
+        `pop_result`.
+        """
+        flock = self.lock('.flush', block=False)
+        if flock is None:
+            return None
+        result = FlushResult()
+        try:
+            while True:
+                entries = self.entries()[:batch]
+                if not entries:
+                    break
+                calls = coalesce(entries)
+                done = 0
+                try:
+                    for index, path, params in calls:
+                        try:
+                            self.send(api, path, params, tries)
+                            result.sent += 1
+                        except DeliciousError, e:
+                            result.failed.append((path, params, str(e)))
+                            _write(self.failed_file, 'a', [entries[index]])
+                        done = index + 1
+                except Exception, e:
+                    # throttled or network trouble, keep the rest
+                    result.error = e
+                sent = [call for call in calls if call[0] < done]
+                result.coalesced += done - len(sent)
+                # calls kept that replace calls removed now should stay so
+                changed = {}
+                for index, path, params in calls[len(sent):]:
+                    if params != entries[index]['params']:
+                        changed[index] = dict(entries[index], params=params)
+                self.remove(done, changed)
+                if result.error:
+                    break
+            result.remaining = len(self)
+            if keep_result:
+                # before unlocking, so a flush waiting for this one sees it
+                self.keep_result(result)
+        finally:
+            self.unlock(flock)
+        return result
+
+    def keep_result(self, result):
+        "Add ``result`` to the kept result of earlier flushes."
+        fd = self.lock()
+        try:
+            kept = self.read_result()
+            if kept:
+                kept.add(result)
+                result = kept
+            _write(self.result_file + '.tmp', 'w', [result.to_json()])
+            os.rename(self.result_file + '.tmp', self.result_file)
+        finally:
+            self.unlock(fd)
+
+    def read_result(self):
+        if not os.path.exists(self.result_file):
+            return None
+        return _flush_result(json.load(open(self.result_file)))
+
+    def pop_result(self):
+        """Return the result kept by flushes since the last call, or None,
+        and forget it."""
+        fd = self.lock()
+        try:
+            result = self.read_result()
+            if result:
+                os.remove(self.result_file)
+            return result
+        finally:
+            self.unlock(fd)
+
+    def send(self, api, path, params, tries):
+        while True:
+            try:
+                return api.request(path, **params)
+            except PyDeliciousThrottled:
+                # the waiter of the API has backed off for the next try
+                tries -= 1
+                if tries <= 0:
+                    raise
+
+
+def coalesce(entries):
+    """Return the calls to make for the queued ``entries``, as a list of
+    ``(index, path, params)``. Of the posts/add and posts/delete calls for
+    a URL, and the bundle calls for a bundle name, only the last is made.
+    A post that was queued before is replaced.
+    """
+    last = {}
+    for index, entry in enumerate(entries):
+        key = _subject(entry)
+        if key:
+            last[key] = index
+    calls = []
+    for index, entry in enumerate(entries):
+        key = _subject(entry)
+        params = dict(entry['params'])
+        if key:
+            if last[key] != index:
+                continue
+            if entry['path'] == 'posts/add' and [e for e in entries[:index]
+                    if _subject(e) == key]:
+                params['replace'] = 'yes'
+        calls.append((index, entry['path'], params))
+    return calls
+
+def _subject(entry):
+    "Return what a call changes as a whole, or None."
+    path, params = entry['path'], entry['params']
+    if path in ('posts/add', 'posts/delete'):
+        return ('post', params.get('url'))
+    elif path in ('tags/bundles/set', 'tags/bundles/delete'):
+        return ('bundle', params.get('bundle'))
+
+def _write(filename, mode, entries):
+    fl = open(filename, mode)
+    try:
+        for entry in entries:
+            fl.write(json.dumps(entry, sort_keys=True) + '\n')
+        fl.flush()
+        os.fsync(fl.fileno())
+    finally:
+        fl.close()
+
+def _decode(data):
+    if isinstance(data, str):
+        return data.decode('utf-8')
+    return data